@@ -0,0 +1 @@
+"""Offline benchmark and load-test harness for server_script.py"""
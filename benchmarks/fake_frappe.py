@@ -0,0 +1,541 @@
+"""
+In-process stand-in for the part of the Frappe Server Script API that
+server_script.py uses.
+
+Data lives in SQLite, so frappe.get_all / frappe.db.sql run real queries
+that can be counted and timed. MariaDB functions the script relies on
+(date_format, sleep, timestamp, ...) are registered on each connection.
+This is a measuring instrument, not a Frappe emulator: permissions,
+hooks, naming rules and validation are not modelled (has_permission
+always allows).
+"""
+
+import datetime
+import json
+import math
+import random
+import re
+import sqlite3
+import threading
+import time
+
+
+class FrappeDict(dict):
+    """frappe._dict: a dict with attribute access"""
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            return None
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+
+class ValidationError(Exception):
+    pass
+
+
+class DoesNotExistError(ValidationError):
+    pass
+
+
+class PermissionError(ValidationError):  # noqa: A001 - mirrors frappe.PermissionError
+    pass
+
+
+# =============================================================================
+# SCHEMA
+# =============================================================================
+
+STANDARD_FIELDS = ["name", "owner", "creation", "modified", "modified_by", "docstatus", "idx",
+                   "_user_tags", "_comments", "_assign", "_liked_by"]
+CHILD_FIELDS = ["parent", "parentfield", "parenttype"]
+
+SCHEMA = {
+    "Patient": ["naming_series", "patient_name", "first_name", "last_name", "sex", "dob",
+                "blood_group", "mobile", "email", "status", "allergies", "medication",
+                "medical_history", "surgical_history", "occupation", "marital_status",
+                "tobacco_current_use", "alcohol_current_use", "patient_details", "inpatient_status"],
+    "Patient Encounter": ["naming_series", "title", "patient", "patient_name", "encounter_date",
+                          "encounter_time", "practitioner", "practitioner_name", "medical_department",
+                          "appointment", "encounter_comment", "company", "status", "amended_from"],
+    "Drug Prescription": ["drug_code", "drug_name", "dosage", "period", "dosage_form", "interval",
+                          "interval_uom", "comment"],
+    "Lab Prescription": ["lab_test_code", "lab_test_name", "lab_test_comment", "lab_test_created"],
+    "Procedure Prescription": ["procedure", "procedure_name", "date", "comments"],
+    "Patient Encounter Diagnosis": ["diagnosis"],
+    "Patient Encounter Symptom": ["complaint"],
+    "Patient Appointment": ["patient", "patient_name", "appointment_date", "appointment_time", "status",
+                            "practitioner", "practitioner_name", "department", "appointment_type", "notes"],
+    "Lab Test": ["patient", "patient_name", "lab_test_name", "template", "status", "result_date",
+                 "practitioner", "lab_test_comment"],
+    "Normal Test Result": ["lab_test_name", "lab_test_event", "result_value", "lab_test_uom", "normal_range"],
+    "Vital Signs": ["patient", "patient_name", "signs_date", "signs_time", "temperature", "pulse",
+                    "respiratory_rate", "bp_systolic", "bp_diastolic", "bp", "spo2", "height", "weight",
+                    "bmi", "vital_signs_note"],
+    "Prescription Duration": ["number", "period"],
+    "File": ["file_name", "file_url", "is_private", "content_hash", "file_size",
+             "attached_to_doctype", "attached_to_name"],
+    "Has Role": ["role"],
+    "DocType": ["module", "custom"],
+}
+
+CHILD_TABLES = {
+    "Patient Encounter": [("drug_prescription", "Drug Prescription"),
+                          ("lab_test_prescription", "Lab Prescription"),
+                          ("procedure_prescription", "Procedure Prescription"),
+                          ("diagnosis", "Patient Encounter Diagnosis"),
+                          ("symptoms", "Patient Encounter Symptom")],
+    "Lab Test": [("normal_test_items", "Normal Test Result")],
+}
+
+CHILD_DOCTYPES = {child for tables in CHILD_TABLES.values() for _, child in tables} | {"Has Role"}
+
+# Roughly the indexes ERPNext Healthcare ships with (Link fields are indexed)
+INDEXES = [
+    ("Patient Encounter", ["patient", "encounter_date"]),
+    ("Patient Appointment", ["patient", "appointment_date"]),
+    ("Lab Test", ["patient"]),
+    ("Vital Signs", ["patient", "signs_date"]),
+] + [(child, ["parent"]) for child in sorted(CHILD_DOCTYPES)]
+
+
+def table_columns(doctype):
+    return STANDARD_FIELDS + (CHILD_FIELDS if doctype in CHILD_DOCTYPES else []) + SCHEMA[doctype]
+
+
+def create_schema(conn):
+    for doctype in SCHEMA:
+        columns = ", ".join(f"`{column}`" for column in table_columns(doctype))
+        conn.execute(f"create table if not exists `tab{doctype}` ({columns}, primary key (`name`))")
+    for doctype, fields in INDEXES:
+        index_name = f"{doctype}_{'_'.join(fields)}".replace(" ", "_").lower()
+        columns = ", ".join(f"`{field}`" for field in fields)
+        conn.execute(f"create index if not exists `{index_name}` on `tab{doctype}` ({columns})")
+
+
+# =============================================================================
+# MARIADB FUNCTIONS
+# =============================================================================
+
+def parse_datetime(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime.combine(value, datetime.time())
+    return datetime.datetime.fromisoformat(str(value))
+
+
+def mysql_date_format(value, fmt):
+    if value is None:
+        return None
+    return datetime.date.fromisoformat(str(value)[:10]).strftime(fmt)
+
+
+def connect(path):
+    """Open a SQLite connection with the MariaDB functions the script calls"""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.create_function("date_format", 2, mysql_date_format)
+    conn.create_function("sleep", 1, lambda seconds: time.sleep(float(seconds)) or 0)
+    conn.create_function("floor", 1, lambda value: None if value is None else math.floor(value))
+    conn.create_function("timestamp", 2, lambda day, clock: None if day is None else f"{day} {clock}")
+    conn.create_function("unix_timestamp", 1,
+                         lambda value: None if value is None else parse_datetime(value).timestamp())
+    # Custom doctypes created by an earlier run (e.g. the patient snapshot)
+    for (table,) in conn.execute("select name from sqlite_master where type = 'table' and name like 'tab%'"):
+        if table[3:] not in SCHEMA:
+            columns = [row[1] for row in conn.execute(f"pragma table_info(`{table}`)")]
+            SCHEMA[table[3:]] = [column for column in columns if column not in STANDARD_FIELDS]
+    return conn
+
+
+# =============================================================================
+# DATABASE
+# =============================================================================
+
+class QueryCounter:
+    """Queries and time spent in SQLite for the current request"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.webhook_calls = 0
+        self.webhook_seconds = 0.0
+
+
+class FakeDB:
+    def __init__(self, conn, counter):
+        self.conn = conn
+        self.counter = counter
+
+    def execute(self, query, values=()):
+        started = time.perf_counter()
+        cursor = self.conn.execute(query, values)
+        rows = cursor.fetchall()
+        columns = [column[0] for column in cursor.description] if cursor.description else []
+        self.counter.queries += 1
+        self.counter.db_seconds += time.perf_counter() - started
+        return columns, rows
+
+    def sql(self, query, values=(), as_dict=False):
+        # Server Scripts get frappe.db.sql wrapped in read_sql (SELECT only)
+        if not query.strip().lower().startswith(("select", "explain")):
+            raise PermissionError("Only SELECT queries are allowed in Server Scripts")
+        params = ()
+        if isinstance(values, dict):
+            query = re.sub(r"%\((\w+)\)s", r":\1", query)
+            params = values
+        elif values:
+            query = query.replace("%s", "?")
+            params = tuple(values)
+        if values:
+            query = query.replace("%%", "%")
+        columns, rows = self.execute(query, params)
+        if as_dict:
+            return [FrappeDict(zip(columns, row)) for row in rows]
+        return [tuple(row) for row in rows]
+
+    def build_conditions(self, filters, params):
+        conditions = []
+        if not filters:
+            return conditions
+        if isinstance(filters, dict):
+            items = []
+            for field, value in filters.items():
+                if isinstance(value, (list, tuple)):
+                    items.append([field, value[0], value[1] if len(value) > 1 else None])
+                else:
+                    items.append([field, "=", value])
+        else:
+            items = [condition[1:] if len(condition) == 4 else condition for condition in filters]
+        for field, operator, value in items:
+            operator = operator.lower()
+            column = f"`{field}`"
+            if operator in ("in", "not in"):
+                if isinstance(value, str):
+                    value = [part.strip() for part in value.split(",")]
+                value = list(value) or [None]
+                conditions.append(f"{column} {operator} ({', '.join('?' for _ in value)})")
+                params.extend(value)
+            elif operator == "is":
+                conditions.append(f"ifnull({column}, '') {'!=' if value == 'set' else '='} ''")
+            elif operator == "between":
+                conditions.append(f"{column} between ? and ?")
+                params.extend([str(value[0]), str(value[1])])
+            else:
+                conditions.append(f"{column} {operator} ?")
+                params.append(str(value) if isinstance(value, datetime.date) else value)
+        return conditions
+
+    def get_all(self, doctype, filters=None, fields=None, order_by=None, limit=None,
+                limit_page_length=None, start=0, limit_start=0, or_filters=None,
+                group_by=None, pluck=None, **kwargs):
+        fields = [pluck] if pluck else (fields or ["name"])
+        params = []
+        where = self.build_conditions(filters, params)
+        if or_filters:
+            or_params = []
+            alternatives = self.build_conditions(or_filters, or_params)
+            if alternatives:
+                where.append("(" + " or ".join(alternatives) + ")")
+                params.extend(or_params)
+        query = f"select {', '.join(fields)} from `tab{doctype}`"
+        if where:
+            query += " where " + " and ".join(where)
+        if group_by:
+            query += f" group by {group_by}"
+        if order_by:
+            query += f" order by {order_by}"
+        limit = limit or limit_page_length
+        if limit:
+            query += f" limit {int(limit)} offset {int(start or limit_start or 0)}"
+        columns, rows = self.execute(query, params)
+        records = [FrappeDict(zip(columns, row)) for row in rows]
+        if pluck:
+            return [record[pluck] for record in records]
+        return records
+
+    def get_value(self, doctype, filters, fieldname="name", as_dict=False):
+        if isinstance(filters, str):
+            filters = {"name": filters}
+        fields = list(fieldname) if isinstance(fieldname, (list, tuple)) else [fieldname]
+        rows = self.get_all(doctype, filters=filters, fields=fields, limit=1)
+        if not rows:
+            return None
+        if as_dict:
+            return rows[0]
+        if len(fields) == 1:
+            return list(rows[0].values())[0]
+        return tuple(rows[0].values())
+
+    def exists(self, doctype, filters=None):
+        if isinstance(filters, str):
+            filters = {"name": filters}
+        rows = self.get_all(doctype, filters=filters, fields=["name"], limit=1)
+        return rows[0].name if rows else None
+
+    def count(self, doctype, filters=None):
+        params = []
+        where = self.build_conditions(filters, params)
+        query = f"select count(*) from `tab{doctype}`" + (" where " + " and ".join(where) if where else "")
+        return self.execute(query, params)[1][0][0]
+
+    def add_index(self, doctype, fields, index_name=None):
+        columns = [field.split("(")[0] for field in fields]
+        index_name = index_name or "_".join(columns) + "_index"
+        self.conn.execute(f"create index if not exists `{doctype}_{index_name}` on `tab{doctype}` "
+                          f"({', '.join(f'`{column}`' for column in columns)})")
+
+
+# =============================================================================
+# CACHE
+# =============================================================================
+
+class FakeCache:
+    """frappe.cache: JSON round-trips like Redis, shared across workers"""
+
+    def __init__(self):
+        self.store = {}
+        self.lock = threading.Lock()
+
+    def get_value(self, key):
+        with self.lock:
+            item = self.store.get(key)
+            if not item:
+                return None
+            value, expires = item
+            if expires and expires < time.time():
+                del self.store[key]
+                return None
+        return json.loads(value)
+
+    def set_value(self, key, value, expires_in_sec=None):
+        item = (json.dumps(value, default=str), time.time() + expires_in_sec if expires_in_sec else None)
+        with self.lock:
+            self.store[key] = item
+
+    def delete_value(self, key):
+        with self.lock:
+            self.store.pop(key, None)
+
+    # Raw Redis commands. Keys are not site-prefixed here, so make_key is the
+    # identity and get_value/delete_value see what set/incr wrote.
+
+    @staticmethod
+    def make_key(key, user=None, shared=False):
+        return key
+
+    def live_item(self, key):
+        item = self.store.get(key)
+        if item and item[1] and item[1] < time.time():
+            del self.store[key]
+            return None
+        return item
+
+    def set(self, name, value, ex=None, nx=False):
+        with self.lock:
+            if nx and self.live_item(name):
+                return None
+            self.store[name] = (json.dumps(value, default=str), time.time() + ex if ex else None)
+            return True
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            item = self.live_item(name)
+            value = (json.loads(item[0]) if item else 0) + amount
+            self.store[name] = (json.dumps(value), item[1] if item else None)
+            return value
+
+    def ttl(self, name):
+        """Seconds left, -1 without an expiry, -2 when the key does not exist (as Redis)"""
+        with self.lock:
+            item = self.live_item(name)
+            if not item:
+                return -2
+            return max(0, int(round(item[1] - time.time()))) if item[1] else -1
+
+    def delete_prefix(self, prefix):
+        with self.lock:
+            for key in [key for key in self.store if key.startswith(prefix)]:
+                del self.store[key]
+
+    def clear(self):
+        with self.lock:
+            self.store.clear()
+
+
+class FakeClock:
+    """
+    frappe.utils' notion of "now", shared across workers. advance() moves it
+    forward without sleeping, so token buckets refill between requests.
+    """
+
+    def __init__(self):
+        self.offset = 0.0
+        self.lock = threading.Lock()
+
+    def now(self):
+        return datetime.datetime.now() + datetime.timedelta(seconds=self.offset)
+
+    def advance(self, seconds):
+        with self.lock:
+            self.offset += seconds
+
+
+# =============================================================================
+# FRAPPE
+# =============================================================================
+
+class FakeDoc(FrappeDict):
+    def __init__(self, values, frappe=None, **kwargs):
+        super().__init__(values, **kwargs)
+        object.__setattr__(self, "frappe_ref", frappe)
+
+    def as_dict(self, **kwargs):
+        return json.loads(json.dumps(self, default=str), object_hook=FrappeDict)
+
+    def insert(self, **kwargs):
+        return object.__getattribute__(self, "frappe_ref").insert_doc(self)
+
+
+class FakeFrappe(FrappeDict):
+    """
+    The `frappe` object handed to the script. One instance per worker:
+    form_dict/response are per request, the cache is shared.
+    """
+
+    def __init__(self, conn, cache, webhook, user="Administrator", clock=None):
+        super().__init__()
+        clock = clock or FakeClock()
+        counter = QueryCounter()
+        db = FakeDB(conn, counter)
+        self.update(
+            counter=counter,
+            form_dict=FrappeDict(),
+            response=FrappeDict(),
+            flags=FrappeDict(),
+            session=FrappeDict(user=user),
+            request=FrappeDict(path="/api/method/mediwise_bot.query"),
+            cache=cache,
+            jobs=[],
+            errors=[],
+            utils=FrappeDict(
+                nowdate=lambda: datetime.date.today().isoformat(),
+                today=lambda: datetime.date.today().isoformat(),
+                now=lambda: clock.now().isoformat(sep=" "),
+                now_datetime=clock.now,
+                getdate=self.getdate,
+                get_datetime=parse_datetime,
+                add_days=lambda day, days: self.getdate(day) + datetime.timedelta(days=days),
+                add_to_date=self.add_to_date,
+                date_diff=lambda a, b: (self.getdate(a) - self.getdate(b)).days,
+                time_diff_in_seconds=lambda a, b: (parse_datetime(a) - parse_datetime(b)).total_seconds(),
+                cint=lambda value: int(float(value)) if value not in (None, "") else 0,
+                flt=lambda value, precision=None: (round(float(value or 0), precision)
+                                                   if precision is not None else float(value or 0)),
+                cstr=lambda value: "" if value is None else str(value),
+                get_url=lambda: "http://localhost:8000",
+            ),
+            db=FrappeDict(
+                sql=db.sql, get_all=db.get_all, get_list=db.get_all, get_value=db.get_value,
+                exists=db.exists, count=db.count, add_index=db.add_index, set_value=self.set_value,
+            ),
+            get_all=db.get_all,
+            get_list=db.get_all,
+            get_doc=self.get_doc,
+            get_meta=self.get_meta,
+            delete_doc=self.delete_doc,
+            has_permission=lambda doctype=None, ptype="read", doc=None, **kwargs: True,
+            make_post_request=self.make_post_request,
+            log_error=lambda title=None, message=None, **kwargs: self.errors.append((title, message)),
+            throw=self.throw,
+            enqueue=lambda method, **kwargs: self.jobs.append((method, kwargs)),
+            publish_realtime=lambda event, message=None, **kwargs: None,
+            ValidationError=ValidationError,
+            DoesNotExistError=DoesNotExistError,
+            PermissionError=PermissionError,
+        )
+        self.fdb = db
+        self.webhook = webhook
+
+    @staticmethod
+    def getdate(value=None):
+        if value is None:
+            return datetime.date.today()
+        if isinstance(value, datetime.datetime):
+            return value.date()
+        if isinstance(value, datetime.date):
+            return value
+        return datetime.date.fromisoformat(str(value)[:10])
+
+    @staticmethod
+    def add_to_date(date, days=0, hours=0, minutes=0, seconds=0, weeks=0, months=0, as_string=False):
+        shifted = parse_datetime(date) + datetime.timedelta(
+            days=days + weeks * 7 + months * 30, hours=hours, minutes=minutes, seconds=seconds)
+        return str(shifted) if as_string else shifted
+
+    @staticmethod
+    def throw(message, exc=None, **kwargs):
+        raise (exc or ValidationError)(message)
+
+    @staticmethod
+    def get_meta(doctype):
+        tables = [FrappeDict(fieldname=fieldname, options=child, fieldtype="Table")
+                  for fieldname, child in CHILD_TABLES.get(doctype, [])]
+        return FrappeDict(name=doctype, get_table_fields=lambda: tables)
+
+    def get_doc(self, doctype, name=None, **kwargs):
+        if isinstance(doctype, dict):
+            return FakeDoc(doctype, frappe=self)
+        filters = name if isinstance(name, dict) else {"name": name}
+        rows = self.fdb.get_all(doctype, filters=filters, fields=["*"], limit=1)
+        if not rows:
+            raise DoesNotExistError(f"{doctype} {name} not found")
+        doc = FakeDoc(rows[0], frappe=self, doctype=doctype)
+        for fieldname, child in CHILD_TABLES.get(doctype, []):
+            children = self.fdb.get_all(child, filters={"parent": doc["name"], "parentfield": fieldname},
+                                        fields=["*"], order_by="idx asc")
+            doc[fieldname] = [FrappeDict(row, doctype=child) for row in children]
+        return doc
+
+    def insert_doc(self, doc):
+        doctype = doc["doctype"]
+        if doctype == "DocType":
+            # Custom doctypes (e.g. the patient snapshot) become tables
+            SCHEMA[doc["name"]] = [field["fieldname"] for field in doc.get("fields", [])]
+            create_schema(self.fdb.conn)
+        elif not doc.get("name"):
+            doc["name"] = doc.get("patient") or f"{doctype[:3].upper()}-{random.randint(0, 10 ** 9)}"
+        columns = table_columns(doctype)
+        now = datetime.datetime.now().isoformat(sep=" ")
+        values = dict({column: doc.get(column) for column in columns}, creation=now, modified=now,
+                      docstatus=doc.get("docstatus") or 0)
+        self.fdb.execute(f"insert or replace into `tab{doctype}` ({', '.join(f'`{c}`' for c in columns)}) "
+                         f"values ({', '.join('?' for _ in columns)})", [values[c] for c in columns])
+        return doc
+
+    def set_value(self, doctype, name, values, value=None):
+        if not isinstance(values, dict):
+            values = {values: value}
+        columns = [column for column in SCHEMA[doctype] if column in values]
+        now = datetime.datetime.now().isoformat(sep=" ")
+        self.fdb.execute(f"update `tab{doctype}` set {', '.join(f'`{c}` = ?' for c in columns)}, modified = ? "
+                         "where name = ?", [values[c] for c in columns] + [now, name])
+
+    def delete_doc(self, doctype, name, **kwargs):
+        self.fdb.execute(f"delete from `tab{doctype}` where name = ?", [name])
+
+    def make_post_request(self, url, headers=None, data=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self.webhook(json.loads(data) if isinstance(data, str) else data)
+        finally:
+            self.counter.webhook_calls += 1
+            self.counter.webhook_seconds += time.perf_counter() - started
@@ -0,0 +1,92 @@
+"""
+Mock n8n RAG webhook with configurable latency.
+
+Used in-process by the benchmark runner, or standalone as a local HTTP
+server that a test ERPNext site's N8N_WEBHOOK_URL can point at:
+
+    python -m benchmarks.mock_webhook --port 5678 --latency-ms 800 --jitter-ms 200
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockWebhook:
+    """
+    Answers {"sessionId", "chatInput"} with {"output": ...} after
+    latency_ms +/- jitter_ms. A failure_rate share of calls raises, as a
+    dropped connection would, to exercise retries and the circuit breaker.
+    """
+
+    def __init__(self, latency_ms=0, jitter_ms=0, failure_rate=0.0, seed=7):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.prompt_chars = 0
+
+    def delay_seconds(self):
+        with self.lock:
+            jitter = self.random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0
+            failed = self.random.random() < self.failure_rate
+        return max(0.0, (self.latency_ms + jitter) / 1000.0), failed
+
+    def answer(self, payload):
+        chat_input = (payload or {}).get("chatInput") or ""
+        with self.lock:
+            self.calls += 1
+            self.prompt_chars += len(chat_input)
+        delay, failed = self.delay_seconds()
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise ConnectionError("mock webhook: simulated connection failure")
+        return {"output": f"Mock answer to a {len(chat_input)}-character prompt."}
+
+    __call__ = answer
+
+
+def serve(port, webhook):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            try:
+                answer = webhook.answer(json.loads(body or b"{}"))
+            except ConnectionError:
+                self.send_response(502)
+                self.end_headers()
+                return
+            data = json.dumps(answer).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    print(f"Mock n8n webhook on http://127.0.0.1:{port}/ "
+          f"(latency {webhook.latency_ms}±{webhook.jitter_ms} ms, failure rate {webhook.failure_rate})")
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=5678)
+    parser.add_argument("--latency-ms", type=float, default=800)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    serve(args.port, MockWebhook(args.latency_ms, args.jitter_ms, args.failure_rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,488 @@
+"""
+Offline benchmark and load test for server_script.py.
+
+Runs the script in-process against the fake frappe (benchmarks/fake_frappe.py),
+a seeded SQLite database and a mock n8n webhook, then reports per scenario:
+throughput, p50/p99 latency, DB queries and webhook calls per request.
+Results are compared with the stored baseline and regressions fail the run.
+
+    python -m benchmarks.run                          # small scale (10k patients)
+    python -m benchmarks.run --scale tiny --iterations 20
+    python -m benchmarks.run --concurrency 8 --webhook-latency-ms 800
+    python -m benchmarks.run --save-baseline          # accept the current numbers
+    python -m benchmarks.run --rate-limit             # let ai_query admission control reject
+    python -m benchmarks.run --rate-limit --request-interval-s 2   # ...with buckets refilling
+
+Latency is machine-dependent: keep baselines from one machine (e.g. CI).
+Query counts are deterministic for a given scale and seed.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+
+from benchmarks.fake_frappe import FakeCache, FakeClock, FakeFrappe, FrappeDict, connect
+from benchmarks.mock_webhook import MockWebhook
+from benchmarks.seed import SCALES, ensure_database
+
+try:
+    # Frappe runs Server Scripts through RestrictedPython; measure the same code path
+    from RestrictedPython import compile_restricted, safe_builtins
+    from RestrictedPython.Guards import guarded_iter_unpack_sequence
+except ImportError:
+    compile_restricted = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT_PATH = os.path.join(ROOT, "server_script.py")
+BASELINE_PATH = os.path.join(ROOT, "benchmarks", "baselines.json")
+RATE_LIMIT_PREFIX = "mediwise:ai_rate:"  # server_script.py AI_RATE_LIMIT_PREFIX
+# Admission control and circuit breaker state, cleared between scenarios so
+# one scenario's rejections or open circuit do not leak into the next
+# (AI_RATE_LIMIT_PREFIX, AI_SLOTS_KEY, AI_BREAKER_KEY / AI_BREAKER_TRIAL_KEY)
+RESILIENCE_PREFIXES = [RATE_LIMIT_PREFIX, "mediwise:ai_webhook_slots", "mediwise:rag_breaker"]
+
+# Builtins Frappe adds on top of RestrictedPython's safe_builtins
+FRAPPE_BUILTINS = ["abs", "all", "any", "bool", "dict", "enumerate", "isinstance", "issubclass", "list",
+                   "max", "min", "range", "set", "sorted", "sum", "tuple"]
+
+
+# =============================================================================
+# SCRIPT EXECUTION
+# =============================================================================
+
+def guarded_getattr(obj, name, default=None):
+    if name.startswith("_") or name in ("format", "format_map", "mro"):
+        raise AttributeError(f'"{name}" is an invalid attribute name because it starts with "_"')
+    return getattr(obj, name) if default is None else getattr(obj, name, default)
+
+
+def guarded_getitem(obj, key):
+    if isinstance(key, str) and key.startswith("_"):
+        raise SyntaxError("Key starts with _")
+    return obj[key]
+
+
+class ServerScript:
+    """server_script.py compiled once, executed once per request like an API Server Script"""
+
+    def __init__(self, path, restricted=True):
+        with open(path) as source:
+            code = source.read()
+        self.restricted = restricted and compile_restricted is not None
+        if self.restricted:
+            self.code = compile_restricted(code, filename=path, mode="exec")
+        else:
+            self.code = compile(code, path, "exec")
+
+    def script_globals(self, frappe):
+        scope = {"frappe": frappe, "json": FrappeDict(loads=json.loads, dumps=json.dumps), "_dict": FrappeDict}
+        if self.restricted:
+            builtins = dict(safe_builtins)
+            builtins.update({name: __builtins__[name] if isinstance(__builtins__, dict)
+                             else getattr(__builtins__, name) for name in FRAPPE_BUILTINS})
+            scope.update(__builtins__=builtins, _getattr_=guarded_getattr, _getitem_=guarded_getitem,
+                         _write_=lambda obj: obj, _getiter_=iter,
+                         _iter_unpack_sequence_=guarded_iter_unpack_sequence)
+        return scope
+
+    def execute(self, frappe, form_dict, background=False):
+        """Run one request; returns (response, error)"""
+        frappe.form_dict = FrappeDict(form_dict)
+        frappe.response = FrappeDict()
+        frappe.request = FrappeDict() if background else FrappeDict(path="/api/method/mediwise_bot.query")
+        try:
+            exec(self.code, self.script_globals(frappe))
+            return dict(frappe.response), None
+        except Exception as error:  # frappe.throw and friends become error responses
+            return {"status": "error", "message": str(error)}, error
+
+
+# =============================================================================
+# SCENARIOS
+# =============================================================================
+
+def patient_query(query_type, pool="typical", hot=None, options=None, **parameters):
+    """Random patients from a pool; hot=N repeats the first N so caches get hits"""
+    def build(rnd, pools, iteration):
+        patients = pools[pool] or pools["typical"]
+        if hot:
+            patients = patients[:hot]
+        return {"query_type": query_type, "options": options or {},
+                "parameters": dict(parameters, patient_id=rnd.choice(patients))}
+    return build
+
+
+def search_query(rnd, pools, iteration):
+    prefix = rnd.choice(pools["typical"])[:9] if iteration % 2 else rnd.choice(["Ma", "Sh", "Om", "Li", "Kh"])
+    return {"query_type": "search_patients", "parameters": {"search_term": prefix, "limit": 20}}
+
+
+def open_patient_batch(rnd, pools, iteration):
+    # What the web UI sends when a patient is selected
+    return {"query_type": "batch", "parameters": {
+        "patient_id": rnd.choice(pools["typical"]),
+        "queries": [
+            {"id": "summary", "query_type": "get_patient_summary",
+             "options": {"exclude_standard": True, "exclude_empty": True}},
+            {"id": "prescriptions", "query_type": "get_active_prescriptions"},
+            {"id": "vitals", "query_type": "get_vital_signs_history"}
+        ]
+    }}
+
+
+def ai_query(background=False):
+    def build(rnd, pools, iteration):
+        # A distinct question per iteration, so duplicate coalescing does not answer it
+        parameters = {"patient_id": rnd.choice(pools["typical"]), "session_id": f"bench-{iteration}",
+                      "user_query": f"Summarise the key concerns (benchmark question {iteration})"}
+        if background:
+            parameters["background"] = True
+        return {"query_type": "ai_query", "parameters": parameters}
+    return build
+
+
+def repeated_ai_query(rnd, pools, iteration):
+    # The same question in the same session, as a double-click or a retry sends it
+    return {"query_type": "ai_query", "parameters": {
+        "patient_id": pools["typical"][0], "session_id": "bench-repeated",
+        "user_query": "Summarise the key concerns (repeated benchmark question)"
+    }}
+
+
+SCENARIOS = {
+    "search_patients": search_query,
+    "get_patient_summary": patient_query("get_patient_summary", refresh=True),
+    "get_patient_summary[cached]": patient_query("get_patient_summary", hot=5),
+    "get_patient_summary[deep]": patient_query("get_patient_summary", pool="deep", refresh=True),
+    "get_patient_details": patient_query("get_patient_details"),
+    "get_patient_encounters": patient_query("get_patient_encounters"),
+    "get_patient_encounters[deep]": patient_query("get_patient_encounters", pool="deep"),
+    "analyze_patient_history[deep]": patient_query("analyze_patient_history", pool="deep"),
+    "get_active_prescriptions": patient_query("get_active_prescriptions"),
+    "get_lab_tests": patient_query("get_lab_tests"),
+    "get_vital_signs_history": patient_query("get_vital_signs_history"),
+    "get_vital_signs_history[trend,deep]": patient_query("get_vital_signs_history", pool="deep", mode="trend"),
+    "batch[open_patient]": open_patient_batch,
+    "ai_query": ai_query(),
+    "ai_query[background]": ai_query(background=True),
+    "ai_query[repeated]": repeated_ai_query,
+    "ai_query[rate_limited]": ai_query(),
+    "ai_query[slow_webhook]": ai_query(),
+    "ai_query[flaky_webhook]": ai_query(),
+    "ai_query[webhook_down]": ai_query(),
+}
+
+# Per-scenario overrides of the command line: mock webhook knobs (latency_ms,
+# jitter_ms, failure_rate), admission control (rate_limit, request_interval_s)
+# and warmup. These cover the retry, circuit breaker, coalescing and token
+# bucket paths, whose regressions show up as webhook calls, errors or 429s.
+SCENARIO_SETTINGS = {
+    # A user asking every 2s (30/min) against the 20/min user bucket
+    "ai_query[rate_limited]": {"rate_limit": True, "request_interval_s": 2},
+    "ai_query[slow_webhook]": {"latency_ms": 100, "jitter_ms": 20},
+    # Some calls need a retry, few exhaust them
+    "ai_query[flaky_webhook]": {"failure_rate": 0.3},
+    # n8n is down: the breaker opens after AI_BREAKER_THRESHOLD failed calls
+    "ai_query[webhook_down]": {"failure_rate": 1.0, "warmup": 0},
+}
+
+
+# =============================================================================
+# RUNNER
+# =============================================================================
+
+class Worker:
+    """One simulated web worker: its own DB connection and frappe object"""
+
+    def __init__(self, script, db_path, cache, webhook, rate_limit=False, clock=None, request_interval=0):
+        self.script = script
+        self.conn = connect(db_path)
+        self.clock = clock or FakeClock()
+        self.frappe = FakeFrappe(self.conn, cache, webhook, clock=self.clock)
+        self.rate_limit = rate_limit
+        self.request_interval = request_interval
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def request(self, form_dict):
+        frappe = self.frappe
+        if not self.rate_limit:
+            # One simulated user sends every request: refill the ai_query token
+            # buckets so admission control runs (and is timed) but never rejects
+            frappe.cache.delete_prefix(RATE_LIMIT_PREFIX)
+        # Simulated time between requests (no sleeping), so the buckets refill
+        self.clock.advance(self.request_interval)
+        frappe.counter.reset()
+        started = time.perf_counter()
+        response, error = self.script.execute(frappe, form_dict)
+        sample = {
+            "seconds": time.perf_counter() - started,
+            "queries": frappe.counter.queries,
+            "db_seconds": frappe.counter.db_seconds,
+            "webhook_calls": frappe.counter.webhook_calls,
+            # A 429 from admission control is the limiter working, not a failure
+            "rate_limited": response.get("code") == "rate_limited",
+            "error": bool(error) or (response.get("status") == "error" and response.get("code") != "rate_limited")
+        }
+        # Background jobs run after the request, as an RQ worker would
+        jobs = list(frappe.jobs)
+        frappe.jobs.clear()
+        for method, job in jobs:
+            job_form = {"query_type": job.get("query_type"), "parameters": job.get("parameters") or {}}
+            frappe.counter.reset()
+            job_started = time.perf_counter()
+            self.script.execute(frappe, job_form, background=True)
+            sample.setdefault("jobs", []).append({
+                "seconds": time.perf_counter() - job_started,
+                "queries": frappe.counter.queries,
+                "webhook_calls": frappe.counter.webhook_calls
+            })
+        return sample, response
+
+
+def ensure_snapshot_database(db_path, script):
+    """
+    Copy of the seeded database with setup_patient_snapshots (and its
+    backfill) applied, so the plain seeded database stays untouched
+    """
+    snapshot_path = db_path.replace(".sqlite", "-snapshots.sqlite")
+    if os.path.exists(snapshot_path):
+        return snapshot_path
+    print("Setting up and backfilling patient snapshots...", file=sys.stderr)
+    partial = snapshot_path + ".partial"
+    shutil.copyfile(db_path, partial)
+    worker = Worker(script, partial, FakeCache(), MockWebhook())
+    sample, response = worker.request({"query_type": "setup_patient_snapshots", "parameters": {}})
+    if sample["error"]:
+        raise RuntimeError(f"setup_patient_snapshots failed: {response.get('message')}")
+    worker.close()
+    os.replace(partial, snapshot_path)
+    return snapshot_path
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(share * len(ordered) + 0.5)) - 1))]
+
+
+def apply_settings(settings, workers, webhook):
+    """Apply a scenario's overrides; returns what they replaced, for restore_settings"""
+    saved = {"webhook": {}, "workers": {}}
+    for knob in ["latency_ms", "jitter_ms", "failure_rate"]:
+        if knob in settings:
+            saved["webhook"][knob] = getattr(webhook, knob)
+            setattr(webhook, knob, settings[knob])
+    for knob, attribute in [("rate_limit", "rate_limit"), ("request_interval_s", "request_interval")]:
+        if knob in settings:
+            saved["workers"][attribute] = getattr(workers[0], attribute)
+            for worker in workers:
+                setattr(worker, attribute, settings[knob])
+    return saved
+
+
+def restore_settings(saved, workers, webhook):
+    for knob, value in saved["webhook"].items():
+        setattr(webhook, knob, value)
+    for attribute, value in saved["workers"].items():
+        for worker in workers:
+            setattr(worker, attribute, value)
+    for prefix in RESILIENCE_PREFIXES:
+        workers[0].frappe.cache.delete_prefix(prefix)
+
+
+def run_scenario(name, build, workers, pools, iterations, warmup, seed):
+    rnd = random.Random(f"{seed}:{name}")
+    requests = [build(rnd, pools, index) for index in range(warmup + iterations)]
+    for form_dict in requests[:warmup]:
+        workers[0].request(form_dict)
+
+    measured = requests[warmup:]
+    samples = []
+    lock = threading.Lock()
+    position = {"next": 0}
+
+    def work(worker):
+        while True:
+            with lock:
+                index = position["next"]
+                position["next"] = index + 1
+            if index >= len(measured):
+                return
+            sample, response = worker.request(measured[index])
+            with lock:
+                samples.append(sample)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=work, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = [sample["seconds"] * 1000 for sample in samples]
+    job_samples = [job for sample in samples for job in sample.get("jobs", [])]
+    result = {
+        "requests": len(samples),
+        "throughput": round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+        "queries": round(sum(sample["queries"] for sample in samples) / len(samples), 2),
+        "db_ms": round(sum(sample["db_seconds"] for sample in samples) * 1000 / len(samples), 2),
+        "webhook_calls": round(sum(sample["webhook_calls"] for sample in samples) / len(samples), 2),
+        "errors": sum(1 for sample in samples if sample["error"]),
+        "rate_limited": sum(1 for sample in samples if sample["rate_limited"])
+    }
+    if job_samples:
+        result["job_p50_ms"] = round(percentile([job["seconds"] * 1000 for job in job_samples], 0.50), 2)
+        result["job_queries"] = round(sum(job["queries"] for job in job_samples) / len(job_samples), 2)
+        result["webhook_calls"] = round(
+            result["webhook_calls"] + sum(job["webhook_calls"] for job in job_samples) / len(samples), 2)
+    return result
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    Regressions: more queries or webhook calls than the baseline, p50 latency
+    beyond the tolerance, more errors, or a 429 count that moved by more than
+    10% of the requests (either way: the limiter leaks or over-rejects)
+    """
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if not expected:
+            continue
+        if result["queries"] > expected["queries"]:
+            regressions.append(f"{name}: {result['queries']} queries/request (baseline {expected['queries']})")
+        if result["p50_ms"] > expected["p50_ms"] * (1 + tolerance) and result["p50_ms"] - expected["p50_ms"] > 1:
+            regressions.append(f"{name}: p50 {result['p50_ms']} ms (baseline {expected['p50_ms']} ms, "
+                               f"tolerance {round(tolerance * 100)}%)")
+        if result["webhook_calls"] > expected.get("webhook_calls", 0) * 1.1 + 0.02:
+            regressions.append(f"{name}: {result['webhook_calls']} webhook calls/request "
+                               f"(baseline {expected.get('webhook_calls', 0)})")
+        if result["errors"] > expected.get("errors", 0):
+            regressions.append(f"{name}: {result['errors']} errors (baseline {expected.get('errors', 0)})")
+        rate_limited = result.get("rate_limited", 0)
+        if abs(rate_limited - expected.get("rate_limited", 0)) > max(2, result["requests"] // 10):
+            regressions.append(f"{name}: {rate_limited} rate-limited (baseline {expected.get('rate_limited', 0)})")
+    return regressions
+
+
+def print_report(results, baseline):
+    header = (f"{'scenario':<38}{'req/s':>9}{'p50 ms':>10}{'p99 ms':>10}{'queries':>9}{'db ms':>9}{'hooks':>7}"
+              f"{'err':>5}{'429':>5}")
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        expected = baseline.get(name)
+        delta = ""
+        if expected and expected["p50_ms"]:
+            delta = f"  ({(result['p50_ms'] / expected['p50_ms'] - 1) * 100:+.0f}% p50)"
+        print(f"{name:<38}{result['throughput']:>9}{result['p50_ms']:>10}{result['p99_ms']:>10}"
+              f"{result['queries']:>9}{result['db_ms']:>9}{result['webhook_calls']:>7}{result['errors']:>5}"
+              f"{result.get('rate_limited', 0):>5}{delta}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for server_script.py")
+    parser.add_argument("--scale", choices=list(SCALES), default="small")
+    parser.add_argument("--iterations", type=int, default=50, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=1, help="simulated web workers")
+    parser.add_argument("--webhook-latency-ms", type=float, default=0)
+    parser.add_argument("--webhook-jitter-ms", type=float, default=0)
+    parser.add_argument("--scenario", action="append", help="run only these scenarios (repeatable)")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--snapshots", action="store_true",
+                        help="run setup_patient_snapshots (and its backfill) before measuring")
+    parser.add_argument("--unrestricted", action="store_true", help="plain exec instead of RestrictedPython")
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="keep ai_query token buckets between requests (rejections are reported as 429)")
+    parser.add_argument("--request-interval-s", type=float, default=0,
+                        help="simulated seconds between requests, so token buckets refill (no real sleep)")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 slowdown (0.25 = 25%%)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args(argv)
+
+    def progress(done, total):
+        print(f"  seeded {done:,}/{total:,} patients", file=sys.stderr)
+
+    print(f"Preparing {args.scale} database ({SCALES[args.scale]['patients']:,} patients)...", file=sys.stderr)
+    db_path, pools = ensure_database(args.scale, args.seed, progress)
+
+    script = ServerScript(SCRIPT_PATH, restricted=not args.unrestricted)
+    if not script.restricted:
+        print("RestrictedPython not available (or --unrestricted): running with plain exec", file=sys.stderr)
+    if args.snapshots:
+        db_path = ensure_snapshot_database(db_path, script)
+    cache = FakeCache()
+    webhook = MockWebhook(args.webhook_latency_ms, args.webhook_jitter_ms, seed=args.seed)
+    clock = FakeClock()
+    workers = [Worker(script, db_path, cache, webhook, args.rate_limit, clock, args.request_interval_s)
+               for _ in range(max(1, args.concurrency))]
+
+    names = args.scenario or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+
+    results = {}
+    for name in names:
+        settings = SCENARIO_SETTINGS.get(name, {})
+        saved = apply_settings(settings, workers, webhook)
+        # Failures and jitter depend on the scenario alone, not on what ran before it
+        webhook.random.seed(f"{args.seed}:{name}")
+        try:
+            results[name] = run_scenario(name, SCENARIOS[name], workers, pools, args.iterations,
+                                         settings.get("warmup", args.warmup), args.seed)
+        finally:
+            restore_settings(saved, workers, webhook)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as stored:
+            baselines = json.load(stored)
+    baseline_key = (f"{args.scale}/concurrency={max(1, args.concurrency)}/webhook={args.webhook_latency_ms:g}ms"
+                    + ("/snapshots" if args.snapshots else ""))
+    baseline = baselines.get(baseline_key, {})
+
+    if args.json:
+        print(json.dumps({"baseline_key": baseline_key, "results": results}, indent=2))
+    else:
+        print_report(results, baseline)
+
+    if args.save_baseline:
+        baselines[baseline_key] = dict(baseline, **results)
+        with open(args.baseline, "w") as stored:
+            json.dump(baselines, stored, indent=2, sort_keys=True)
+            stored.write("\n")
+        print(f"\nBaseline saved under {baseline_key}", file=sys.stderr)
+        return 0
+
+    if not baseline:
+        print(f"\nNo baseline for {baseline_key} (run with --save-baseline to store one)", file=sys.stderr)
+        return 0
+
+    regressions = compare_with_baseline(results, baseline, args.tolerance)
+    if regressions:
+        print("\nRegressions against baseline:", file=sys.stderr)
+        for regression in regressions:
+            print(f"  {regression}", file=sys.stderr)
+        return 1
+    print("\nNo regressions against baseline", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,232 @@
+"""
+Synthetic ERPNext Healthcare data at benchmark scale.
+
+Most patients get a short history; a small share gets a deep one
+(hundreds of encounters and vital signs) so the per-patient queries are
+measured on both. Dates are relative to the day of seeding, so seeded
+databases are cached per scale and per day.
+"""
+
+import datetime
+import os
+import random
+
+from benchmarks.fake_frappe import connect, create_schema
+
+# patients, mean encounters / vital signs per typical patient, share and depth of deep histories
+SCALES = {
+    "tiny": {"patients": 500, "encounters": 6, "vitals": 20, "deep_share": 0.02, "deep_encounters": 150,
+             "deep_vitals": 1000},
+    "small": {"patients": 10_000, "encounters": 6, "vitals": 20, "deep_share": 0.02, "deep_encounters": 150,
+              "deep_vitals": 1000},
+    "medium": {"patients": 100_000, "encounters": 6, "vitals": 20, "deep_share": 0.02, "deep_encounters": 300,
+               "deep_vitals": 2000},
+    "large": {"patients": 1_000_000, "encounters": 6, "vitals": 20, "deep_share": 0.01, "deep_encounters": 500,
+              "deep_vitals": 5000},
+}
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".data")
+
+FIRST_NAMES = ["Aarav", "Maya", "Liam", "Sofia", "Noah", "Zara", "Omar", "Elena", "Kenji", "Amara",
+               "Lucas", "Priya", "Mateo", "Hana", "Yusuf", "Chloe", "Ravi", "Ines", "Tariq", "Lena"]
+LAST_NAMES = ["Sharma", "Garcia", "Okafor", "Nguyen", "Smith", "Haddad", "Kowalski", "Tanaka", "Silva",
+              "Mensah", "Ivanova", "Rahman", "Fischer", "Costa", "Ali", "Moreau", "Khan", "Berg"]
+DRUGS = ["Paracetamol", "Amoxicillin", "Metformin", "Lisinopril", "Atorvastatin", "Omeprazole",
+         "Amlodipine", "Salbutamol", "Sertraline", "Levothyroxine"]
+DIAGNOSES = ["Hypertension", "Type 2 Diabetes", "Asthma", "Migraine", "Gastritis", "Hypothyroidism",
+             "Depression", "Osteoarthritis", "Upper respiratory infection", "Hyperlipidemia"]
+COMPLAINTS = ["Headache", "Cough", "Fatigue", "Chest pain", "Fever", "Back pain", "Dizziness", "Nausea"]
+DURATIONS = [("5 Day", 5, "Day"), ("1 Week", 1, "Week"), ("1 Month", 1, "Month"), ("3 Month", 3, "Month")]
+PRACTITIONERS = [f"HLC-PRAC-{index:03d}" for index in range(40)]
+
+BATCH_ROWS = 20_000
+
+
+def database_path(scale, seed):
+    return os.path.join(DATA_DIR, f"{scale}-seed{seed}-{datetime.date.today().isoformat()}.sqlite")
+
+
+def insert_rows(conn, doctype, columns, rows):
+    conn.executemany(
+        f"insert into `tab{doctype}` ({', '.join(f'`{column}`' for column in columns)}) "
+        f"values ({', '.join('?' for _ in columns)})",
+        rows
+    )
+
+
+class Batches:
+    """Buffers rows per doctype and flushes them with executemany"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.pending = {}
+
+    def add(self, doctype, columns, row):
+        key = (doctype, tuple(columns))
+        rows = self.pending.setdefault(key, [])
+        rows.append(row)
+        if len(rows) >= BATCH_ROWS:
+            self.flush(key)
+
+    def flush(self, key=None):
+        for pending_key in [key] if key else list(self.pending):
+            insert_rows(self.conn, pending_key[0], pending_key[1], self.pending.pop(pending_key, []))
+
+
+PATIENT_COLUMNS = ["name", "owner", "creation", "modified", "modified_by", "docstatus", "idx", "naming_series",
+                   "patient_name", "first_name", "last_name", "sex", "dob", "blood_group", "mobile", "email",
+                   "status", "allergies", "medical_history"]
+ENCOUNTER_COLUMNS = ["name", "owner", "creation", "modified", "modified_by", "docstatus", "idx", "naming_series",
+                     "title", "patient", "patient_name", "encounter_date", "encounter_time", "practitioner",
+                     "practitioner_name", "medical_department", "encounter_comment", "status"]
+CHILD_COLUMNS = ["name", "parent", "parentfield", "parenttype", "idx", "docstatus", "modified"]
+APPOINTMENT_COLUMNS = ["name", "owner", "creation", "modified", "docstatus", "idx", "patient", "patient_name",
+                       "appointment_date", "appointment_time", "status", "practitioner"]
+LAB_TEST_COLUMNS = ["name", "owner", "creation", "modified", "docstatus", "idx", "patient", "lab_test_name",
+                    "template", "status", "result_date"]
+VITALS_COLUMNS = ["name", "owner", "creation", "modified", "docstatus", "idx", "patient", "signs_date",
+                  "signs_time", "temperature", "pulse", "respiratory_rate", "bp_systolic", "bp_diastolic", "spo2"]
+
+
+def seed_patient(batches, rnd, index, today, encounters, vitals):
+    patient = f"PAT-{index:07d}"
+    first_name = rnd.choice(FIRST_NAMES)
+    last_name = rnd.choice(LAST_NAMES)
+    patient_name = f"{first_name} {last_name}"
+    stamp = f"{today - datetime.timedelta(days=index % 365)} 09:00:00"
+    batches.add("Patient", PATIENT_COLUMNS, (
+        patient, "Administrator", stamp, stamp, "Administrator", 0, 0, "PAT-",
+        patient_name, first_name, last_name, rnd.choice(["Male", "Female"]),
+        str(today - datetime.timedelta(days=rnd.randint(365, 365 * 90))), rnd.choice(["A+", "O+", "B-", "AB+", ""]),
+        f"9{index:09d}", f"{first_name.lower()}.{last_name.lower()}{index}@example.com", "Active",
+        "Penicillin" if rnd.random() < 0.15 else "", rnd.choice(["", "", "Hypertension since 2015", "Asthma"])
+    ))
+
+    chronic = rnd.sample(DIAGNOSES, 2)
+    day = today
+    for number in range(encounters):
+        day = day - datetime.timedelta(days=rnd.randint(3, 45))
+        encounter = f"HLC-ENC-{index:07d}-{number:04d}"
+        when = f"{day} 10:30:00"
+        practitioner = rnd.choice(PRACTITIONERS)
+        batches.add("Patient Encounter", ENCOUNTER_COLUMNS, (
+            encounter, "Administrator", when, when, "Administrator", 1, 0, "HLC-ENC-",
+            f"{patient_name} on {day}", patient, patient_name, str(day), "10:30:00", practitioner,
+            f"Dr. {practitioner[-3:]}", "General Medicine",
+            f"Patient reports {rnd.choice(COMPLAINTS).lower()} for {rnd.randint(1, 14)} days", "Completed"
+        ))
+        for row in range(rnd.randint(1, 3)):
+            drug = rnd.choice(DRUGS)
+            batches.add("Drug Prescription", CHILD_COLUMNS + ["drug_code", "drug_name", "dosage", "period",
+                                                              "dosage_form", "interval", "interval_uom"], (
+                f"{encounter}-D{row}", encounter, "drug_prescription", "Patient Encounter", row + 1, 1, when,
+                drug, drug, "1-0-1", rnd.choice(DURATIONS)[0], "Tablet", 1, "Day"
+            ))
+        batches.add("Patient Encounter Diagnosis", CHILD_COLUMNS + ["diagnosis"], (
+            f"{encounter}-X", encounter, "diagnosis", "Patient Encounter", 1, 1, when,
+            rnd.choice(chronic) if rnd.random() < 0.6 else rnd.choice(DIAGNOSES)
+        ))
+        batches.add("Patient Encounter Symptom", CHILD_COLUMNS + ["complaint"], (
+            f"{encounter}-S", encounter, "symptoms", "Patient Encounter", 1, 1, when, rnd.choice(COMPLAINTS)
+        ))
+        if rnd.random() < 0.3:
+            batches.add("Lab Prescription", CHILD_COLUMNS + ["lab_test_code", "lab_test_name"], (
+                f"{encounter}-L", encounter, "lab_test_prescription", "Patient Encounter", 1, 1, when,
+                "CBC", "Complete Blood Count"
+            ))
+
+    for number in range(2 if rnd.random() < 0.5 else 0):
+        day = today + datetime.timedelta(days=rnd.randint(1, 60))
+        stamp = f"{today} 08:00:00"
+        batches.add("Patient Appointment", APPOINTMENT_COLUMNS, (
+            f"HLC-APP-{index:07d}-{number}", "Administrator", stamp, stamp, 0, 0, patient, patient_name,
+            str(day), "09:00:00", "Scheduled", rnd.choice(PRACTITIONERS)
+        ))
+
+    for number in range(max(1, encounters // 3)):
+        day = today - datetime.timedelta(days=number * 30 + rnd.randint(0, 20))
+        stamp = f"{day} 11:00:00"
+        lab_test = f"HLC-LAB-{index:07d}-{number:04d}"
+        completed = number > 0 or rnd.random() < 0.5
+        batches.add("Lab Test", LAB_TEST_COLUMNS, (
+            lab_test, "Administrator", stamp, stamp, 1 if completed else 0, 0, patient, "Complete Blood Count",
+            "CBC", "Completed" if completed else "Draft", str(day) if completed else None
+        ))
+        batches.add("Normal Test Result", CHILD_COLUMNS + ["lab_test_name", "result_value", "lab_test_uom",
+                                                           "normal_range"], (
+            f"{lab_test}-R", lab_test, "normal_test_items", "Lab Test", 1, 1, stamp, "Hemoglobin",
+            str(round(rnd.uniform(10, 17), 1)), "g/dL", "13.5-17.5"
+        ))
+
+    reading = datetime.datetime.combine(today, datetime.time(8))
+    for number in range(vitals):
+        reading = reading - datetime.timedelta(hours=rnd.randint(4, 36))
+        stamp = str(reading)
+        batches.add("Vital Signs", VITALS_COLUMNS, (
+            f"HLC-VTS-{index:07d}-{number:05d}", "Administrator", stamp, stamp, 1, 0, patient,
+            str(reading.date()), str(reading.time()), round(rnd.gauss(37.0, 0.5), 1), rnd.randint(55, 115),
+            rnd.randint(12, 22), rnd.randint(100, 165), rnd.randint(60, 100), rnd.randint(90, 100)
+        ))
+
+    return patient
+
+
+def seed_database(path, scale="small", seed=7, progress=None):
+    """
+    Create and fill a SQLite database. Returns {"typical": [...], "deep": [...]}
+    patient IDs, which are also stored in the database for reuse.
+    """
+    config = SCALES[scale]
+    rnd = random.Random(seed)
+    today = datetime.date.today()
+    conn = connect(path)
+    create_schema(conn)
+    conn.execute("create table if not exists `bench_patients` (`name` primary key, `kind`)")
+
+    stamp = f"{today} 00:00:00"
+    insert_rows(conn, "Prescription Duration", ["name", "number", "period", "modified"],
+                [(name, number, period, stamp) for name, number, period in DURATIONS])
+
+    batches = Batches(conn)
+    kinds = []
+    for index in range(config["patients"]):
+        deep = rnd.random() < config["deep_share"]
+        if deep:
+            encounters = config["deep_encounters"]
+            vitals = config["deep_vitals"]
+        else:
+            encounters = max(0, int(rnd.expovariate(1 / config["encounters"])))
+            vitals = max(0, int(rnd.expovariate(1 / config["vitals"])))
+        patient = seed_patient(batches, rnd, index, today, encounters, vitals)
+        kinds.append((patient, "deep" if deep else "typical"))
+        if progress and index % 10_000 == 0:
+            progress(index, config["patients"])
+    batches.flush()
+
+    conn.executemany("insert into `bench_patients` values (?, ?)", kinds)
+    conn.commit()
+    conn.close()
+    return load_patient_pools(path)
+
+
+def load_patient_pools(path):
+    conn = connect(path)
+    pools = {"typical": [], "deep": []}
+    for name, kind in conn.execute("select `name`, `kind` from `bench_patients` order by `name`"):
+        pools[kind].append(name)
+    conn.close()
+    return pools
+
+
+def ensure_database(scale="small", seed=7, progress=None):
+    """Path and patient pools of a seeded database, seeding it on first use"""
+    path = database_path(scale, seed)
+    if os.path.exists(path):
+        return path, load_patient_pools(path)
+    os.makedirs(DATA_DIR, exist_ok=True)
+    partial = path + ".partial"
+    if os.path.exists(partial):
+        os.remove(partial)
+    seed_database(partial, scale, seed, progress)
+    os.replace(partial, path)
+    return path, load_patient_pools(path)
@@ -0,0 +1,74 @@
+"""
+MediWise AI Bot - Doc Event Script
+==================================
+
+Purpose: Keep MediWise's server-side patient cache and patient snapshots in sync with ERPNext Healthcare
+Type: Server Script (DocType Event)
+
+⚠️ DEPLOYMENT INSTRUCTIONS:
+1. Go to ERPNext → Server Script → New
+2. Script Type: DocType Event
+3. Paste this entire script
+4. Enable and Save
+5. Repeat for every Reference Document Type / DocType Event pair below
+   (Frappe binds one doctype and one event per Server Script):
+
+   Reference Document Type: Patient, Patient Encounter, Patient Appointment,
+                            Lab Test, Vital Signs
+   DocType Event:           After Save, After Save (Submitted Document),
+                            After Cancel, After Delete
+
+   ("After Save" also fires on insert and submit.)
+
+⚠️ CONFIGURATION:
+- PATIENT_CACHE_PREFIX must match the value in server_script.py
+- API_METHOD must match the API Method of the server_script.py Server Script
+
+NOTE: frappe and doc are pre-loaded in DocType Event Server Scripts, no imports needed
+"""
+
+# pylint: disable=all
+# type: ignore
+# pyright: reportUndefinedVariable=false
+# The above comments suppress linter warnings for frappe/doc which are pre-loaded in Server Scripts
+
+PATIENT_CACHE_PREFIX = "mediwise:patient_summary:"  # ⚠️ must match server_script.py
+API_METHOD = "mediwise_bot.query"  # ⚠️ must match server_script.py
+
+# Patient snapshot sections each doctype feeds (see server_script.py).
+# Appointments are not part of the snapshot, so they only drop the cache.
+SNAPSHOT_SECTIONS_BY_DOCTYPE = {
+    "Patient": ["profile"],
+    "Patient Encounter": ["visits", "conditions", "medications"],
+    "Lab Test": ["labs"],
+    "Vital Signs": ["vitals"]
+}
+
+# Resolve the patient this document belongs to
+if doc.doctype == "Patient":
+    patient_id = doc.name
+else:
+    patient_id = doc.get("patient")
+
+# Drop the cached summary so the next open rebuilds it from the database.
+# A cache failure must never block saving clinical data.
+if patient_id:
+    try:
+        frappe.cache.delete_value(f"{PATIENT_CACHE_PREFIX}{patient_id}")
+    except Exception:
+        pass
+
+# Queue an incremental refresh of the affected snapshot sections. It runs after
+# this transaction commits, so the worker reads the saved document.
+snapshot_sections = SNAPSHOT_SECTIONS_BY_DOCTYPE.get(doc.doctype)
+if patient_id and snapshot_sections:
+    try:
+        frappe.enqueue(
+            API_METHOD,
+            queue="short",
+            enqueue_after_commit=True,
+            query_type="refresh_patient_snapshot",
+            parameters={"patient_id": patient_id, "sections": snapshot_sections}
+        )
+    except Exception:
+        pass
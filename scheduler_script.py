@@ -0,0 +1,43 @@
+"""
+MediWise AI Bot - Scheduler Script
+==================================
+
+Purpose: Pre-generate the AI overview of patients with upcoming appointments, so opening them is instant
+Type: Server Script (Scheduler Event)
+
+⚠️ DEPLOYMENT INSTRUCTIONS:
+1. Go to ERPNext → Server Script → New
+2. Script Type: Scheduler Event
+3. Event Frequency: Cron
+4. Cron Format: */30 6-20 * * *   (every 30 minutes during clinic hours)
+5. Paste this entire script
+6. Enable and Save
+
+⚠️ CONFIGURATION:
+- API_METHOD must match the API Method of the server_script.py Server Script
+- The look-ahead window, number of parallel jobs and patient cap are set in
+  server_script.py (APPOINTMENT PRE-ANALYSIS CONFIGURATION)
+
+NOTE: frappe is pre-loaded in Scheduler Event Server Scripts, no imports needed
+"""
+
+# pylint: disable=all
+# type: ignore
+# pyright: reportUndefinedVariable=false
+# The above comments suppress linter warnings for frappe which is pre-loaded in Server Scripts
+
+API_METHOD = "mediwise_bot.query"  # ⚠️ must match server_script.py
+
+# The run itself lives in server_script.py: "preanalyze_appointments" finds the
+# upcoming patients and fans them out to a bounded number of background jobs.
+# Overviews that are still current are skipped, so overlapping runs are cheap.
+try:
+    frappe.enqueue(
+        API_METHOD,
+        queue="long",
+        timeout=600,
+        query_type="preanalyze_appointments",
+        parameters={}
+    )
+except Exception:
+    frappe.log_error(title="MediWise AI Bot - Pre-analysis Scheduling Error")
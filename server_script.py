@@ -41,6 +41,2969 @@ NOTE: frappe and json are pre-loaded in Server Scripts, no imports needed
 # Get from your n8n workflow webhook node
 N8N_WEBHOOK_URL = "our_n8n_weebhook"
 
+# ⚠️ Must match this Server Script's "API Method" - background jobs re-enter through it
+API_METHOD = "mediwise_bot.query"
+
+AI_FALLBACK_MESSAGE = "AI assistant temporarily unavailable. Please try again."
+
+# Background mode ("background": true): the webhook call runs in an RQ worker
+# and the caller polls ai_query_status (or listens for the realtime event)
+AI_JOB_PREFIX = "mediwise:ai_job:"
+AI_JOB_TTL = 3600  # seconds a finished answer stays retrievable
+AI_JOB_QUEUE = "long"
+AI_JOB_TIMEOUT = 300  # seconds
+AI_JOB_REALTIME_EVENT = "mediwise_ai_job"
+
+# Webhook resilience: connection errors and 5xx responses are retried with
+# jittered exponential backoff; after AI_BREAKER_THRESHOLD consecutive failed
+# calls the circuit opens and ai_query fails fast with the fallback message
+# for AI_BREAKER_COOLDOWN seconds. The circuit is then half-open: the first
+# caller takes the trial lease and makes a single call, without retries, while
+# everyone else keeps failing fast. Success closes the circuit, failure opens
+# it for another cooldown. A trial that never returns (a hung n8n, killed
+# worker) frees the lease after AI_BREAKER_TRIAL_SECONDS.
+# frappe.make_post_request takes no timeout, so a call cannot be cut short; an
+# answer slower than AI_WEBHOOK_SLOW_SECONDS is still used but counts as a
+# failure, so an n8n that has stopped answering in time does trip the breaker.
+AI_WEBHOOK_MAX_RETRIES = 2
+AI_WEBHOOK_BACKOFF_SECONDS = 0.25
+AI_WEBHOOK_MAX_BACKOFF_SECONDS = 4
+AI_BREAKER_KEY = "mediwise:rag_breaker"
+AI_BREAKER_TRIAL_KEY = "mediwise:rag_breaker_trial"
+AI_BREAKER_THRESHOLD = 5
+AI_BREAKER_COOLDOWN = 30  # seconds
+AI_BREAKER_TRIAL_SECONDS = 120
+AI_WEBHOOK_SLOW_SECONDS = 60
+
+# Session-aware context: the full patient JSON is sent once per session_id;
+# follow-up turns send only what changed (or nothing) and rely on the n8n
+# session memory for the rest. Pass "resend_context": true to force a resend.
+AI_SESSION_CONTEXT_DEDUP = True
+AI_SESSION_PREFIX = "mediwise:ai_session:"
+AI_SESSION_TTL = 43200  # seconds - roughly one clinic shift
+# An initial-load overview answered from the memo or a pre-analysis never passed
+# through this session's n8n memory. It is kept as the session's seed and put in
+# front of the session's next webhook turn, so follow-ups can refer to it.
+AI_SESSION_SEED_PREFIX = "mediwise:ai_session_seed:"
+
+# Duplicate suppression: identical ai_query requests (same user, session,
+# question, context hash and file) share one LLM call. While one is in flight as
+# a background job, duplicates get its job_id to poll. A synchronous duplicate of
+# a synchronous call gets "status": "pending" with "code": "duplicate_in_flight"
+# at once, rather than holding a web worker, and asks again after retry_after.
+# Finished answers are memoised for a short TTL. The initial-load overview is
+# keyed on the chart instead of the session, since it is deterministic for an
+# unchanged chart. Pass "refresh": true to force a new answer.
+AI_MEMO_PREFIX = "mediwise:ai_memo:"
+AI_INFLIGHT_PREFIX = "mediwise:ai_inflight:"
+AI_MEMO_TTL = 120  # seconds
+AI_INITIAL_MEMO_TTL = 3600  # seconds
+AI_COALESCE_RETRY_AFTER = 2  # seconds; the client asks again after a "duplicate_in_flight"
+
+# Admission control: an ai_query that will call the webhook (memoised and
+# coalesced answers are free) takes one token from each of three buckets - the
+# user's, the chat session's and the site's - which refill continuously up to
+# their burst size. Webhook calls in flight are capped site-wide; initial-load
+# overviews may only use AI_OVERVIEW_SLOT_SHARE of the slots, so interactive
+# questions keep priority when many patients are opened.
+# Rejected requests get HTTP 429, "code": "rate_limited" and a retry_after.
+AI_RATE_LIMIT_ENABLED = True
+AI_RATE_LIMIT_PREFIX = "mediwise:ai_rate:"
+AI_RATE_LIMITS = {
+    "user": {"per_minute": 20, "burst": 10},
+    "session": {"per_minute": 10, "burst": 6},
+    "site": {"per_minute": 300, "burst": 60}
+}
+AI_SLOTS_KEY = "mediwise:ai_webhook_slots"
+AI_MAX_INFLIGHT_WEBHOOKS = 8
+AI_OVERVIEW_SLOT_SHARE = 0.5
+AI_JOB_SLOT_WAIT_SECONDS = 120  # how long a background job waits for a free slot (web requests never wait)
+AI_SLOT_POLL_SECONDS = 0.5
+AI_SLOT_RETRY_AFTER = 5  # seconds suggested when every slot is busy
+
+# Prompt compaction: metadata and empty fields are stripped, repeated child rows
+# collapsed, and encounters/labs/appointments admitted newest-first until the
+# patient data fits the budget. Override per request with "token_budget".
+AI_CONTEXT_TOKEN_BUDGET = 6000  # approximate tokens of patient data per prompt
+CHARS_PER_TOKEN = 4  # rough estimate for English text / JSON
+CONTEXT_MAX_TEXT_CHARS = 2000  # longer free-text fields are truncated
+CONTEXT_METADATA_FIELDS = [
+    "owner", "modified", "modified_by", "idx", "doctype", "docstatus",
+    "naming_series", "parent", "parentfield", "parenttype", "amended_from"
+]
+# Sections that are always sent in full; list sections are ranked and trimmed
+CONTEXT_ALWAYS_KEEP = ["patient", "alerts"]
+# Query keywords that give a section twice the share of the budget
+CONTEXT_SECTION_KEYWORDS = {
+    "recent_encounters": ["visit", "encounter", "history", "diagnos", "symptom", "complain",
+                          "medic", "drug", "prescri", "dose", "procedure"],
+    "pending_lab_tests": ["lab", "test", "result", "blood", "report"],
+    "upcoming_appointments": ["appointment", "schedule", "follow", "next visit"]
+}
+
+# Uploaded files: text files are read from Frappe's file storage once and the
+# extracted text is cached by the File's content_hash, so the same upload is
+# never re-read (across turns or patients) and n8n needs no access to it. Text
+# over AI_FILE_TOKEN_BUDGET is chunked and the chunks most relevant to the
+# question are sent. Server Scripts cannot import parsers, so PDF, Office and
+# image files are still passed to n8n by URL.
+AI_FILE_TEXT_EXTENSIONS = ["txt", "text", "csv", "tsv", "md", "json", "xml", "html", "htm", "log", "hl7"]
+AI_FILE_MAX_BYTES = 2 * 1024 * 1024  # larger text files are passed by URL
+AI_FILE_PREFIX = "mediwise:file_text:"
+AI_FILE_TTL = 7 * 24 * 3600  # seconds
+AI_FILE_TOKEN_BUDGET = 3000  # approximate tokens of file text per prompt
+AI_FILE_CHUNK_CHARS = 2000
+
+
+# =============================================================================
+# PATIENT SEARCH CONFIGURATION
+# =============================================================================
+
+# search_patients does indexed PREFIX matching on name / patient ID / last name
+# / mobile / email with keyset (cursor) pagination. Run the setup_search_indexes
+# query_type once (System Manager) to create the supporting indexes.
+SEARCH_DEFAULT_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_MATCH_FIELDS = ["patient_name", "name", "last_name", "mobile", "email"]
+SEARCH_INDEX_FIELDS = ["patient_name", "last_name", "mobile", "email"]
+
+
+# =============================================================================
+# PATIENT HISTORY ANALYSIS CONFIGURATION
+# =============================================================================
+
+# analyze_patient_history is computed from grouped SQL aggregates, so its cost
+# does not grow with the number of visits. Ranked lists are cut to this length.
+HISTORY_TOP_LIMIT = 5
+
+
+# =============================================================================
+# RESPONSE SHAPING CONFIGURATION
+# =============================================================================
+
+# Read queries accept an "options" dict that slims their payload:
+#   "profile": "full" (default) or "lite" (sidebar fields only, no metadata/empties)
+#   "fields": {"<DocType>": ["field", ...]} allowlists, per doctype
+#   "exclude_standard": drop owner/modified/idx/docstatus/parent... and _fields
+#   "exclude_empty": drop None / "" / [] / {} values
+#   "encoding": "json" (default) or "columnar" (record lists as columns + rows)
+PAYLOAD_STANDARD_FIELDS = [
+    "owner", "modified", "modified_by", "idx", "doctype", "docstatus",
+    "naming_series", "parent", "parentfield", "parenttype", "amended_from"
+]
+PAYLOAD_LITE_FIELDS = {
+    "Patient": ["name", "patient_name", "sex", "dob", "blood_group", "mobile", "email",
+                "allergies", "medical_history", "surgical_history", "medication"],
+    "Patient Encounter": ["name", "title", "encounter_date", "encounter_time", "practitioner",
+                          "practitioner_name", "medical_department", "status", "encounter_comment",
+                          "symptoms", "diagnosis", "drug_prescription", "lab_test_prescription",
+                          "procedure_prescription"],
+    "Patient Appointment": ["name", "title", "appointment_date", "appointment_time", "appointment_type",
+                            "practitioner", "practitioner_name", "department", "status", "duration", "notes"],
+    "Patient Encounter Symptom": ["complaint"],
+    "Patient Encounter Diagnosis": ["diagnosis"],
+    "Drug Prescription": ["drug_code", "drug_name", "dosage", "period", "dosage_form"],
+    "Lab Prescription": ["lab_test_code", "lab_test_name"],
+    "Procedure Prescription": ["procedure", "procedure_name"]
+}
+PAYLOAD_PROFILES = {
+    "full": {"fields": {}, "exclude_standard": False, "exclude_empty": False, "encoding": "json"},
+    "lite": {"fields": PAYLOAD_LITE_FIELDS, "exclude_standard": True, "exclude_empty": True, "encoding": "json"}
+}
+
+
+# =============================================================================
+# VITAL SIGNS TREND CONFIGURATION
+# =============================================================================
+
+# get_vital_signs_history with "mode": "trend" (and the summary's vital_trends
+# section) aggregates a time window in the database instead of shipping raw
+# rows: per-metric count/min/max/mean, least-squares slope and out-of-range
+# counts come from ONE grouped query, the chart series from one bucketed query.
+VITALS_TREND_DAYS = 30  # default window
+VITALS_TREND_MAX_DAYS = 365
+VITALS_TREND_POINTS = 48  # default number of chart buckets
+VITALS_TREND_MAX_POINTS = 500
+VITALS_ROLLING_WINDOW = 3  # buckets per rolling mean
+# A change over the window smaller than this share of the normal range is "stable"
+VITALS_STABLE_FRACTION = 0.05
+VITALS_TREND_METRICS = {
+    "temperature": {"label": "Temperature", "unit": "°C", "low": 36.1, "high": 37.8},
+    "pulse": {"label": "Pulse", "unit": "bpm", "low": 60, "high": 100},
+    "respiratory_rate": {"label": "Respiratory rate", "unit": "breaths/min", "low": 12, "high": 20},
+    "bp_systolic": {"label": "Systolic BP", "unit": "mmHg", "low": 90, "high": 140},
+    "bp_diastolic": {"label": "Diastolic BP", "unit": "mmHg", "low": 60, "high": 90},
+    "spo2": {"label": "SpO2", "unit": "%", "low": 95, "high": 100}
+}
+
+
+# =============================================================================
+# PATIENT SNAPSHOT CONFIGURATION
+# =============================================================================
+
+# Derived clinical facts (allergies, chronic conditions, last visit, active
+# medications, recent labs, latest vitals) are kept per patient in one row of
+# the "MediWise Patient Snapshot" doctype. doc_event_script.py queues a refresh
+# of just the sections a changed document affects. Run the
+# setup_patient_snapshots query_type once (System Manager) to create the
+# doctype and backfill every existing patient.
+SNAPSHOT_DOCTYPE = "MediWise Patient Snapshot"
+SNAPSHOT_SECTIONS = ["profile", "visits", "conditions", "medications", "labs", "vitals"]
+SNAPSHOT_CHRONIC_MIN_VISITS = 2  # a diagnosis recorded at this many visits is listed as chronic
+SNAPSHOT_QUEUE = "long"
+SNAPSHOT_BACKFILL_TIMEOUT = 3600  # seconds
+SNAPSHOT_BACKFILL_PAGE_SIZE = 200
+# A patient without a snapshot row (created since the backfill) is derived in
+# memory by the read that finds it missing; the row is stored by a job, queued
+# at most once per patient within this many seconds
+SNAPSHOT_PENDING_PREFIX = "mediwise:snapshot_pending:"
+SNAPSHOT_PENDING_TTL = 300
+
+
+# =============================================================================
+# PATIENT RETRIEVAL CONFIGURATION
+# =============================================================================
+
+# Follow-up ai_query turns send the core of the chart (profile, alerts,
+# clinical snapshot) plus only the records most relevant to the question,
+# ranked by BM25 over a per-patient index of encounters, notes, diagnoses,
+# prescriptions and lab results. The index lives in Redis and covers the
+# newest AI_INDEX_MAX_RECORDS records. It is built by a background job (queued
+# at the initial load, or by the first question that finds no index); until it
+# exists follow-ups get the core sections only. After that each turn brings it
+# up to date: only records whose "modified" changed are re-indexed, and a turn
+# with more than AI_INDEX_INLINE_UPDATES of them leaves the work to the job.
+# Initial-load overviews and "context_strategy": "full" still send the whole chart.
+AI_CONTEXT_STRATEGY = "retrieval"  # or "full"
+AI_INDEX_PREFIX = "mediwise:patient_index:"
+AI_INDEX_BUILDING_PREFIX = "mediwise:patient_index_building:"
+AI_INDEX_TTL = 7 * 24 * 3600  # seconds
+AI_INDEX_MAX_RECORDS = 400  # newest encounters + lab tests per patient
+AI_INDEX_BATCH_SIZE = 50  # documents bulk-loaded per batch
+AI_INDEX_INLINE_UPDATES = 10
+AI_INDEX_PASSAGE_CHARS = 2000  # longer passages are cut, bounding the Redis entry
+AI_INDEX_QUEUE = "short"
+AI_INDEX_JOB_TIMEOUT = 600  # seconds
+AI_RETRIEVAL_CORE_SECTIONS = ["patient", "alerts", "clinical_snapshot"]
+AI_RETRIEVAL_TOP_K = 8
+AI_RETRIEVAL_TOKEN_BUDGET = 2500  # approximate tokens of retrieved records per prompt
+BM25_K1 = 1.2
+BM25_B = 0.75
+RETRIEVAL_STOPWORDS = [
+    "an", "as", "at", "be", "by", "do", "he", "if", "in", "is", "it", "me", "my", "no", "of", "on", "or",
+    "so", "to", "us", "we", "she", "him", "the", "and", "not", "but", "can", "you", "our", "its", "for", "with", "was", "were", "are", "has", "have", "had", "this", "that",
+    "what", "which", "when", "who", "how", "does", "did", "any", "all", "from", "about",
+    "patient", "patients", "please", "tell", "show", "give", "there", "their", "his", "her"
+]
+
+
+# =============================================================================
+# APPOINTMENT PRE-ANALYSIS CONFIGURATION
+# =============================================================================
+
+# scheduler_script.py periodically queues "preanalyze_appointments", which finds
+# the patients with an appointment in the next PREANALYSIS_HORIZON_HOURS and
+# spreads them over PREANALYSIS_CONCURRENCY background jobs. Each job generates
+# the initial-load overview of its patients one at a time, using the
+# non-interactive share of the webhook slots (see AI_RATE_LIMITS). An overview is
+# stored with the context_version of the chart it describes; opening the patient
+# returns it instantly while that version is current, otherwise ai_query
+# generates one live as before.
+PREANALYSIS_PREFIX = "mediwise:ai_preanalysis:"
+PREANALYSIS_RUNNING_PREFIX = "mediwise:ai_preanalysis_running:"
+PREANALYSIS_HORIZON_HOURS = 12
+PREANALYSIS_MAX_PATIENTS = 300
+PREANALYSIS_CONCURRENCY = 3
+PREANALYSIS_APPOINTMENT_STATUSES = ["Open", "Scheduled", "Confirmed"]
+PREANALYSIS_TTL = 24 * 3600  # seconds
+PREANALYSIS_QUEUE = "long"
+PREANALYSIS_JOB_TIMEOUT = 3600  # seconds
+
+
+# =============================================================================
+# BATCH CONFIGURATION
+# =============================================================================
+
+# A "batch" request runs several read-only query types in one HTTP call, e.g.
+# summary + prescriptions + vitals when a patient is opened
+BATCH_MAX_QUERIES = 10
+
+
+# =============================================================================
+# PATIENT CONTEXT CACHE CONFIGURATION
+# =============================================================================
+
+# Assembled get_patient_summary payloads are cached in Redis (frappe.cache) per
+# patient. Entries are dropped by doc_event_script.py whenever a linked Patient,
+# Patient Encounter, Patient Appointment, Lab Test or Vital Signs doc changes;
+# the TTL is only a safety net (e.g. "upcoming" appointments rolling over).
+PATIENT_CACHE_PREFIX = "mediwise:patient_summary:"  # ⚠️ must match doc_event_script.py
+PATIENT_CACHE_TTL = 600  # seconds
+CACHE_STATS_KEY = "mediwise:cache_stats"
+
+
+# =============================================================================
+# REQUEST METRICS CONFIGURATION
+# =============================================================================
+
+# Every request is timed: wall time, database calls and time, webhook calls and
+# latency, prompt and response sizes, cache hits and per-phase time. Send
+# "debug": true next to query_type to get these back under "metrics". With
+# METRICS_ENABLED they are also aggregated per query type in Redis and served
+# by the "metrics" query type in Prometheus text format.
+METRICS_ENABLED = True
+METRICS_PREFIX = "mediwise:metrics:"
+METRICS_INDEX_KEY = "mediwise:metrics_index"
+METRICS_LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]  # seconds
+# Serialising the response to measure it costs as much as Frappe's own
+# rendering, so only debug requests and about one in N others are measured
+METRICS_RESPONSE_SAMPLE_EVERY = 20
+
+# Per-request counters exported as mediwise_<name>_total
+METRICS_COUNTERS = {
+    "errors": "Requests answered with status error",
+    "db_calls": "Database calls made by the script",
+    "db_seconds": "Time spent in database calls",
+    "webhook_calls": "n8n webhook attempts, including retries",
+    "webhook_seconds": "Time spent waiting for the n8n webhook",
+    "cache_hits": "Patient summary cache hits",
+    "cache_misses": "Patient summary cache misses",
+    "prompt_chars": "Characters of prompt sent to the n8n webhook",
+    "rate_limited": "AI queries turned away by admission control",
+    "response_bytes": "Bytes of JSON response, summed over the measured requests",
+    "response_samples": "Requests whose response size was measured"
+}
+
+
+# =============================================================================
+# CACHE HELPERS
+# =============================================================================
+
+# A Redis outage must never break patient data retrieval, so every cache call
+# degrades to a miss / no-op instead of raising.
+
+def cache_get(key):
+    try:
+        return frappe.cache.get_value(key)
+    except Exception:
+        return None
+
+
+def cache_set(key, value, ttl=None):
+    try:
+        frappe.cache.set_value(key, value, expires_in_sec=ttl)
+    except Exception:
+        pass
+
+
+def cache_delete(key):
+    try:
+        frappe.cache.delete_value(key)
+    except Exception:
+        pass
+
+
+def record_cache_event(event):
+    """Bump the shared hit/miss counter (read-modify-write, so approximate under load)"""
+    stats = cache_get(CACHE_STATS_KEY) or {"hits": 0, "misses": 0}
+    stats[event] = stats.get(event, 0) + 1
+    cache_set(CACHE_STATS_KEY, stats)
+    
+    request_event = "cache_hits" if event == "hits" else "cache_misses"
+    METRICS[request_event] = METRICS[request_event] + 1
+
+
+# =============================================================================
+# REQUEST METRICS
+# =============================================================================
+
+# Collected for the current request (module state lives for one request, see
+# REQUEST_MEMO). Database reads go through the db_* wrappers below so their
+# count and time are known; MariaDB sleep() waits are deliberately not counted.
+METRICS = {
+    "started": frappe.utils.now_datetime(),
+    "record": True,
+    "db_calls": 0,
+    "db_seconds": 0.0,
+    "webhook_calls": 0,
+    "webhook_seconds": 0.0,
+    "webhook_durations": [],
+    "cache_hits": 0,
+    "cache_misses": 0,
+    "prompt_chars": 0,
+    "rate_limited": 0,
+    "response_bytes": 0,
+    "response_samples": 0,
+    "phases": {}
+}
+
+
+def seconds_since(started):
+    return (frappe.utils.now_datetime() - started).total_seconds()
+
+
+def record_db_call(started):
+    METRICS["db_calls"] = METRICS["db_calls"] + 1
+    METRICS["db_seconds"] = METRICS["db_seconds"] + seconds_since(started)
+
+
+def record_phase(phase, started):
+    """Add the time since started to a named phase (e.g. prompt_build)"""
+    phases = METRICS["phases"]
+    phases[phase] = phases.get(phase, 0.0) + seconds_since(started)
+
+
+def db_sql(query, values=(), as_dict=False):
+    started = frappe.utils.now_datetime()
+    try:
+        return frappe.db.sql(query, values, as_dict=as_dict)
+    finally:
+        record_db_call(started)
+
+
+def db_get_all(doctype, filters=None, fields=None, order_by=None, limit=None):
+    started = frappe.utils.now_datetime()
+    try:
+        return frappe.get_all(doctype, filters=filters, fields=fields, order_by=order_by, limit=limit)
+    finally:
+        record_db_call(started)
+
+
+def db_get_value(doctype, name, fieldname="name", as_dict=False):
+    started = frappe.utils.now_datetime()
+    try:
+        return frappe.db.get_value(doctype, name, fieldname, as_dict=as_dict)
+    finally:
+        record_db_call(started)
+
+
+def db_exists(doctype, name):
+    started = frappe.utils.now_datetime()
+    try:
+        return frappe.db.exists(doctype, name)
+    finally:
+        record_db_call(started)
+
+
+def request_metrics_report():
+    """This request's metrics as returned under "metrics" with "debug": true"""
+    return {
+        "wall_ms": round(seconds_since(METRICS["started"]) * 1000, 1),
+        "db_calls": METRICS["db_calls"],
+        "db_ms": round(METRICS["db_seconds"] * 1000, 1),
+        "webhook_calls": METRICS["webhook_calls"],
+        "webhook_ms": round(METRICS["webhook_seconds"] * 1000, 1),
+        "cache_hits": METRICS["cache_hits"],
+        "cache_misses": METRICS["cache_misses"],
+        "prompt_chars": METRICS["prompt_chars"],
+        "response_bytes": METRICS["response_bytes"],
+        "phases_ms": {phase: round(seconds * 1000, 1) for phase, seconds in METRICS["phases"].items()}
+    }
+
+
+def add_to_histogram(buckets, value):
+    """Count value into cumulative (Prometheus "le") buckets"""
+    buckets = buckets or [0] * len(METRICS_LATENCY_BUCKETS)
+    for index, bound in enumerate(METRICS_LATENCY_BUCKETS):
+        if value <= bound:
+            buckets[index] = buckets[index] + 1
+    return buckets
+
+
+def store_request_metrics(query_type, wall_seconds, failed):
+    """
+    Fold this request into the per-query-type aggregates in Redis
+    (read-modify-write, so approximate under load like the cache stats)
+    """
+    key = METRICS_PREFIX + query_type
+    stats = cache_get(key) or {}
+    # A new (or expired) aggregate is the only time the index can lack this type
+    if not stats:
+        known = cache_get(METRICS_INDEX_KEY) or []
+        if query_type not in known:
+            cache_set(METRICS_INDEX_KEY, sorted(known + [query_type]))
+    
+    stats["requests"] = stats.get("requests", 0) + 1
+    stats["duration_seconds"] = stats.get("duration_seconds", 0.0) + wall_seconds
+    stats["duration_buckets"] = add_to_histogram(stats.get("duration_buckets"), wall_seconds)
+    for duration in METRICS["webhook_durations"]:
+        stats["webhook_buckets"] = add_to_histogram(stats.get("webhook_buckets"), duration)
+    
+    counters = dict(METRICS)
+    counters["errors"] = 1 if failed else 0
+    for counter in METRICS_COUNTERS:
+        stats[counter] = stats.get(counter, 0) + counters[counter]
+    cache_set(key, stats)
+
+
+def finish_request_metrics(query_type, debug, raised=False):
+    """
+    Attach (debug) and aggregate the metrics of the request that just ran.
+    raised: the request is ending in an exception (see fail_request) rather
+    than an error response; it counts as an error all the same.
+    """
+    if not METRICS["record"] or not query_type:
+        return
+    # Recorded once, whatever path the request takes out
+    METRICS["record"] = False
+    
+    wall_seconds = seconds_since(METRICS["started"])
+    sampled = frappe.utils.now_datetime().microsecond % METRICS_RESPONSE_SAMPLE_EVERY == 0
+    if not raised and (debug or sampled):
+        METRICS["response_bytes"] = len(to_compact_json(frappe.response))
+        METRICS["response_samples"] = 1
+    if debug and not raised:
+        frappe.response["metrics"] = request_metrics_report()
+    if METRICS_ENABLED:
+        store_request_metrics(query_type, wall_seconds, raised or frappe.response.get("status") == "error")
+
+
+def fail_request(query_type, message, exc=None):
+    """frappe.throw for the dispatch below, recording the failed request first"""
+    finish_request_metrics(query_type, False, True)
+    if exc:
+        frappe.throw(message, exc)
+    frappe.throw(message)
+
+
+def call_recorded(query_type, handler, parameters):
+    """Run a read handler; a request it fails with an exception is still recorded"""
+    try:
+        return handler(parameters)
+    except Exception:
+        finish_request_metrics(query_type, False, True)
+        raise
+
+
+def render_prometheus_metrics():
+    """All stored aggregates in the Prometheus text exposition format"""
+    query_types = cache_get(METRICS_INDEX_KEY) or []
+    stats_by_type = {query_type: cache_get(METRICS_PREFIX + query_type) or {} for query_type in query_types}
+    lines = []
+    
+    histograms = [
+        ("request_duration_seconds", "Wall time of MediWise requests", "duration_buckets", "requests", "duration_seconds"),
+        ("webhook_duration_seconds", "Latency of n8n webhook attempts", "webhook_buckets", "webhook_calls", "webhook_seconds")
+    ]
+    for name, help_text, buckets_field, count_field, sum_field in histograms:
+        lines.append(f"# HELP mediwise_{name} {help_text}")
+        lines.append(f"# TYPE mediwise_{name} histogram")
+        for query_type in query_types:
+            stats = stats_by_type[query_type]
+            if not stats.get(buckets_field):
+                continue
+            label = 'query_type="' + query_type + '"'
+            for index, bound in enumerate(METRICS_LATENCY_BUCKETS):
+                lines.append(f"mediwise_{name}_bucket{{{label},le=\"{bound}\"}} {stats[buckets_field][index]}")
+            lines.append(f"mediwise_{name}_bucket{{{label},le=\"+Inf\"}} {stats.get(count_field, 0)}")
+            lines.append(f"mediwise_{name}_sum{{{label}}} {round(stats.get(sum_field, 0.0), 6)}")
+            lines.append(f"mediwise_{name}_count{{{label}}} {stats.get(count_field, 0)}")
+    
+    for counter, help_text in METRICS_COUNTERS.items():
+        lines.append(f"# HELP mediwise_{counter}_total {help_text}")
+        lines.append(f"# TYPE mediwise_{counter}_total counter")
+        for query_type in query_types:
+            value = stats_by_type[query_type].get(counter, 0)
+            if isinstance(value, float):
+                value = round(value, 6)
+            label = 'query_type="' + query_type + '"'
+            lines.append(f"mediwise_{counter}_total{{{label}}} {value}")
+    
+    return "\n".join(lines) + "\n"
+
+
+# =============================================================================
+# PERMISSIONS
+# =============================================================================
+
+def is_system_manager():
+    """Guard for maintenance query types"""
+    if frappe.session.user == "Administrator":
+        return True
+    return bool(db_get_all(
+        "Has Role",
+        filters={"parent": frappe.session.user, "parenttype": "User", "role": "System Manager"},
+        limit=1
+    ))
+
+
+# =============================================================================
+# PATIENT CONTEXT FINGERPRINTS
+# =============================================================================
+
+def to_compact_json(value):
+    """Compact, key-sorted JSON (no indentation) - stable input for hashing and prompts"""
+    return json.dumps(value, separators=(",", ":"), sort_keys=True, default=str)
+
+
+def stable_hash(text):
+    """64-bit FNV-1a hex digest - identical across workers, unlike the builtin hash()"""
+    value = 0xcbf29ce484222325
+    for char in text:
+        value = ((value ^ ord(char)) * 0x100000001b3) & 0xFFFFFFFFFFFFFFFF
+    return f"{value:016x}"
+
+
+def context_record_key(item, index):
+    """Child records are matched across turns by docname, falling back to position"""
+    if isinstance(item, dict) and item.get("name"):
+        return str(item.get("name"))
+    return str(index)
+
+
+def fingerprint_context(patient_context):
+    """
+    Hash every top-level section of the patient context, and every record in
+    list sections, so two versions of the same chart can be diffed cheaply.
+    """
+    sections = {}
+    for key, value in patient_context.items():
+        if isinstance(value, list):
+            records = {}
+            for index, item in enumerate(value):
+                records[context_record_key(item, index)] = stable_hash(to_compact_json(item))
+            sections[key] = {"hash": fingerprint_records_hash(records), "records": records}
+        else:
+            sections[key] = {"hash": stable_hash(to_compact_json(value)), "records": None}
+    
+    return {"hash": fingerprint_sections_hash(sections), "sections": sections}
+
+
+def fingerprint_records_hash(records):
+    return stable_hash("|".join(sorted(k + ":" + h for k, h in records.items())))
+
+
+def fingerprint_sections_hash(sections):
+    return stable_hash("|".join(sorted(k + ":" + v["hash"] for k, v in sections.items())))
+
+
+def restrict_fingerprint(fingerprint, keys):
+    """The part of a fingerprint that covers only the given sections"""
+    sections = {k: v for k, v in (fingerprint.get("sections") or {}).items() if k in keys}
+    return {"hash": fingerprint_sections_hash(sections), "sections": sections}
+
+
+def merge_fingerprints(previous, fingerprint):
+    """previous with the sections of fingerprint replaced - what the session has now seen"""
+    sections = dict((previous or {}).get("sections") or {})
+    sections.update(fingerprint["sections"])
+    return {"hash": fingerprint_sections_hash(sections), "sections": sections}
+
+
+def carry_omitted_records(fingerprint, previous, omitted_names):
+    """
+    Records compaction left out for length are not deleted from the chart.
+    Keep the session's earlier view of them, so the delta does not report
+    them as removed and a turn that only drops them stays "unchanged".
+    """
+    previous_sections = (previous or {}).get("sections") or {}
+    sections = dict(fingerprint["sections"])
+    for key, names in (omitted_names or {}).items():
+        old = previous_sections.get(key)
+        section = sections.get(key)
+        if not old or not section or old.get("records") is None or section["records"] is None:
+            continue
+        records = dict(section["records"])
+        for name in names:
+            if name in old["records"] and name not in records:
+                records[name] = old["records"][name]
+        sections[key] = {"hash": fingerprint_records_hash(records), "records": records}
+    return {"hash": fingerprint_sections_hash(sections), "sections": sections}
+
+
+def build_context_delta(patient_context, fingerprint, previous):
+    """Return only the sections / records that differ from a previously sent fingerprint"""
+    delta = {}
+    previous_sections = previous.get("sections") or {}
+    
+    for key, section in fingerprint["sections"].items():
+        old = previous_sections.get(key)
+        if old and old.get("hash") == section["hash"]:
+            continue
+        
+        value = patient_context.get(key)
+        if section["records"] is None or not old or old.get("records") is None:
+            delta[key] = value
+            continue
+        
+        # List section: send changed/new records and the names of removed ones
+        changed = []
+        for index, item in enumerate(value):
+            record_key = context_record_key(item, index)
+            if old["records"].get(record_key) != section["records"][record_key]:
+                changed.append(item)
+        removed = [k for k in old["records"] if k not in section["records"]]
+        
+        entry = {}
+        if changed:
+            entry["added_or_updated"] = changed
+        if removed:
+            entry["removed"] = removed
+        delta[key] = entry
+    
+    for key in previous_sections:
+        if key not in fingerprint["sections"]:
+            delta[key] = None
+    
+    return delta
+
+
+# =============================================================================
+# PROMPT CONTEXT COMPACTION
+# =============================================================================
+
+def estimate_tokens(value):
+    """Cheap token estimate of a value's compact JSON form"""
+    text = value if isinstance(value, str) else to_compact_json(value)
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def is_empty_value(value):
+    return value is None or value == "" or value == [] or value == {}
+
+
+def strip_context_value(value, depth=0):
+    """
+    Recursively drop standard metadata, underscore fields and empty values,
+    truncate very long text and collapse identical rows within a list.
+    Child-table rows (dicts nested inside a record's list, depth >= 4) also
+    lose their random docname, which carries no meaning for the LLM.
+    """
+    if isinstance(value, dict):
+        cleaned = {}
+        for key, item in value.items():
+            if key in CONTEXT_METADATA_FIELDS or key.startswith("_"):
+                continue
+            if key == "name" and depth >= 4:
+                continue
+            item = strip_context_value(item, depth + 1)
+            if not is_empty_value(item):
+                cleaned[key] = item
+        return cleaned
+    
+    if isinstance(value, list):
+        cleaned = []
+        seen = set()
+        for item in value:
+            item = strip_context_value(item, depth + 1)
+            if is_empty_value(item):
+                continue
+            signature = to_compact_json(item)
+            if signature not in seen:
+                seen.add(signature)
+                cleaned.append(item)
+        return cleaned
+    
+    if isinstance(value, str):
+        value = value.strip()
+        if len(value) > CONTEXT_MAX_TEXT_CHARS:
+            value = value[:CONTEXT_MAX_TEXT_CHARS] + "…"
+    
+    return value
+
+
+def drop_repeated_child_rows(records):
+    """
+    Records are ordered newest first. A child row (e.g. the same drug at the
+    same dosage) already present in a newer record is removed from the older
+    one and only counted under "repeated_in_newer_records".
+    """
+    seen = set()
+    for record in records:
+        if not isinstance(record, dict):
+            continue
+        
+        record_signatures = []
+        repeats = {}
+        for key in list(record.keys()):
+            rows = record[key]
+            if not isinstance(rows, list) or not rows or not isinstance(rows[0], dict):
+                continue
+            kept = []
+            for row in rows:
+                signature = key + to_compact_json(row)
+                if signature in seen:
+                    repeats[key] = repeats.get(key, 0) + 1
+                else:
+                    kept.append(row)
+                    record_signatures.append(signature)
+            if kept:
+                record[key] = kept
+            else:
+                record.pop(key, None)
+        
+        if repeats:
+            record["repeated_in_newer_records"] = repeats
+        for signature in record_signatures:
+            seen.add(signature)
+
+
+def compact_patient_context(patient_context, token_budget, user_query=""):
+    """
+    Shrink a patient context to fit token_budget.
+
+    Returns {"context": compacted dict, "report": before/after size report,
+    "omitted_names": docnames of the records left out for length, by section}.
+    Always-kept sections (patient, alerts) and scalar sections stay whole; list
+    sections are admitted round-robin, newest record first, with sections the
+    question is about getting two records per round.
+    """
+    before_tokens = estimate_tokens(patient_context)
+    context = strip_context_value(patient_context)
+    
+    encounters = context.get("recent_encounters")
+    if isinstance(encounters, list):
+        encounters = sorted(
+            encounters,
+            key=lambda enc: str(enc.get("encounter_date") or "") if isinstance(enc, dict) else "",
+            reverse=True
+        )
+        context["recent_encounters"] = encounters
+    
+    for key, value in context.items():
+        if key not in CONTEXT_ALWAYS_KEEP and isinstance(value, list):
+            drop_repeated_child_rows(value)
+    
+    omitted = {}
+    omitted_names = {}
+    if estimate_tokens(context) > token_budget:
+        compacted = {}
+        ranked_sections = []
+        for key, value in context.items():
+            if key in CONTEXT_ALWAYS_KEEP or not isinstance(value, list):
+                compacted[key] = value
+            else:
+                compacted[key] = []
+                ranked_sections.append(key)
+        
+        query_text = (user_query or "").lower()
+        boosted = []
+        for key in ranked_sections:
+            for keyword in CONTEXT_SECTION_KEYWORDS.get(key, []):
+                if keyword in query_text:
+                    boosted.append(key)
+                    break
+        ranked_sections = boosted + [key for key in ranked_sections if key not in boosted]
+        
+        queues = {key: list(context[key]) for key in ranked_sections}
+        used_tokens = estimate_tokens(compacted)
+        while any(queues[key] for key in ranked_sections):
+            for key in ranked_sections:
+                slots = 2 if key in boosted else 1
+                for slot in range(slots):
+                    if not queues[key]:
+                        break
+                    item = queues[key].pop(0)
+                    cost = estimate_tokens(item) + 1
+                    if used_tokens + cost <= token_budget:
+                        compacted[key].append(item)
+                        used_tokens = used_tokens + cost
+                    else:
+                        omitted[key] = omitted.get(key, 0) + 1
+                        if isinstance(item, dict) and item.get("name"):
+                            omitted_names[key] = omitted_names.get(key, []) + [str(item.get("name"))]
+        
+        if omitted:
+            # Tell the LLM what it is not seeing
+            compacted["omitted_for_length"] = omitted
+        context = compacted
+    
+    return {
+        "context": context,
+        "report": {
+            "before_tokens": before_tokens,
+            "after_tokens": estimate_tokens(context),
+            "token_budget": token_budget,
+            "omitted_records": omitted
+        },
+        "omitted_names": omitted_names
+    }
+
+
+# =============================================================================
+# RAG WEBHOOK CLIENT
+# =============================================================================
+
+def extract_ai_response(webhook_response):
+    """Pull the answer text out of the webhook body"""
+    # Expected format: {"output": "AI response text"}
+    ai_response = None
+    if isinstance(webhook_response, dict):
+        if "output" in webhook_response:
+            ai_response = webhook_response["output"]
+        elif "message" in webhook_response:
+            # Handle alternative response format
+            ai_response = webhook_response["message"]
+        elif "response" in webhook_response:
+            ai_response = webhook_response["response"]
+        else:
+            # If response structure is unexpected, try to get any text field
+            for key in ["text", "content", "result", "data"]:
+                if key in webhook_response:
+                    value = webhook_response[key]
+                    if isinstance(value, str):
+                        ai_response = value
+                        break
+                    elif isinstance(value, dict) and "text" in value:
+                        ai_response = value["text"]
+                        break
+    
+    # If still no response, use the whole response as string
+    if not ai_response:
+        if isinstance(webhook_response, str):
+            ai_response = webhook_response
+        else:
+            ai_response = json.dumps(webhook_response)
+    
+    return ai_response
+
+
+def split_text_chunks(text, size):
+    """Split text into ~size-character chunks on word boundaries"""
+    chunks = []
+    current = ""
+    for word in text.split(" "):
+        candidate = f"{current} {word}" if current else word
+        if current and len(candidate) > size:
+            chunks.append(current + " ")
+            current = word
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def rag_breaker_retry_after():
+    """
+    Seconds until the circuit breaker lets calls through again (0 = closed, or
+    half-open with the trial lease free)
+    """
+    state = cache_get(AI_BREAKER_KEY)
+    if not state or not state.get("open_until"):
+        return 0
+    now = frappe.utils.now_datetime()
+    remaining = frappe.utils.time_diff_in_seconds(state["open_until"], now)
+    if remaining <= 0:
+        # Half-open: only the trial call in progress (if any) holds others back
+        remaining = breaker_trial_lease_seconds()
+    return int(remaining) + 1 if remaining > 0 else 0
+
+
+def breaker_trial_lease_seconds():
+    """Seconds left on the half-open trial lease (0 when nobody holds it)"""
+    try:
+        return max(frappe.cache.ttl(frappe.cache.make_key(AI_BREAKER_TRIAL_KEY)), 0)
+    except Exception:
+        return 0
+
+
+def take_breaker_trial_lease():
+    """
+    The lease is a raw Redis SET NX EX, not a cache_set: of callers racing
+    for it, exactly one gets True
+    """
+    try:
+        return bool(frappe.cache.set(
+            frappe.cache.make_key(AI_BREAKER_TRIAL_KEY),
+            frappe.session.user,
+            ex=AI_BREAKER_TRIAL_SECONDS,
+            nx=True
+        ))
+    except Exception:
+        return False
+
+
+def ensure_rag_circuit_closed():
+    retry_after = rag_breaker_retry_after()
+    if retry_after:
+        raise Exception(f"RAG webhook unavailable after repeated failures (circuit open, retry in {retry_after}s)")
+
+
+def admit_rag_call():
+    """
+    Let one webhook call through the circuit breaker: returns False when the
+    circuit is closed, True when this caller holds the half-open trial lease,
+    and raises while the circuit is open or another caller holds the lease
+    """
+    ensure_rag_circuit_closed()
+    state = cache_get(AI_BREAKER_KEY)
+    if not state or not state.get("open_until"):
+        return False
+    
+    if not take_breaker_trial_lease():
+        raise Exception("RAG webhook unavailable after repeated failures (circuit half-open, trial call in progress)")
+    return True
+
+
+def record_rag_outcome(success):
+    """Track consecutive webhook failures; open the circuit at the threshold"""
+    state = cache_get(AI_BREAKER_KEY)
+    if success:
+        if state:
+            cache_delete(AI_BREAKER_KEY)
+            cache_delete(AI_BREAKER_TRIAL_KEY)
+        return
+    
+    failures = (state or {}).get("failures", 0) + 1
+    state = {"failures": failures, "open_until": None}
+    if failures >= AI_BREAKER_THRESHOLD:
+        state["open_until"] = str(frappe.utils.add_to_date(
+            frappe.utils.now_datetime(), seconds=AI_BREAKER_COOLDOWN
+        ))
+        cache_delete(AI_BREAKER_TRIAL_KEY)
+    cache_set(AI_BREAKER_KEY, state, AI_BREAKER_COOLDOWN * 10)
+
+
+def webhook_error_status(error):
+    """HTTP status of a failed request, or None for connection-level errors"""
+    try:
+        return error.response.status_code
+    except Exception:
+        return None
+
+
+def backoff_wait(attempt, seed):
+    """Sleep base * 2^attempt scaled by 0.5-1.5x jitter (capped)"""
+    jitter = int(stable_hash(f"{seed}|{attempt}|{frappe.utils.now_datetime()}")[:4], 16) / 65535.0
+    delay = min(AI_WEBHOOK_BACKOFF_SECONDS * (2 ** attempt) * (0.5 + jitter), AI_WEBHOOK_MAX_BACKOFF_SECONDS)
+    # Server Scripts cannot import time; MariaDB's SLEEP() blocks without spinning
+    frappe.db.sql("select sleep(%s)", (round(delay, 3),))
+
+
+def record_webhook_attempt(started):
+    duration = seconds_since(started)
+    METRICS["webhook_calls"] = METRICS["webhook_calls"] + 1
+    METRICS["webhook_seconds"] = METRICS["webhook_seconds"] + duration
+    METRICS["webhook_durations"].append(duration)
+
+
+def post_to_rag_webhook(data, charged_session=None):
+    """
+    frappe.make_post_request with bounded retries and the circuit breaker.
+    charged_session: the session whose rate-limit tokens paid for this call,
+    refunded if the breaker turns it away.
+    """
+    try:
+        trial = admit_rag_call()
+    except Exception:
+        # Nothing reached n8n: the retry must not find the buckets drained
+        if charged_session:
+            refund_rate_tokens(charged_session)
+        raise
+    
+    attempt = 0
+    while True:
+        started = frappe.utils.now_datetime()
+        try:
+            webhook_response = frappe.make_post_request(
+                N8N_WEBHOOK_URL,
+                headers={
+                    "Content-Type": "application/json"
+                },
+                data=data
+            )
+            record_webhook_attempt(started)
+            # Too slow to be healthy: the answer is used, but the breaker counts a
+            # failure (a slow trial re-opens the circuit)
+            record_rag_outcome(seconds_since(started) <= AI_WEBHOOK_SLOW_SECONDS)
+            return webhook_response
+        except Exception as e:
+            record_webhook_attempt(started)
+            # Only transient failures are retried: connection errors and 5xx.
+            # 4xx and undecodable bodies (ValueError) fail immediately.
+            status = webhook_error_status(e)
+            if isinstance(e, ValueError) or (status is not None and status < 500):
+                # n8n answered, so a trial call proved nothing either way: free
+                # the lease for the next caller
+                if trial:
+                    cache_delete(AI_BREAKER_TRIAL_KEY)
+                raise
+            # A trial is a single call: its failure re-opens the circuit
+            if trial or attempt >= AI_WEBHOOK_MAX_RETRIES:
+                record_rag_outcome(False)
+                raise
+            attempt = attempt + 1
+            backoff_wait(attempt, data[:64])
+
+
+def call_rag_webhook(session_id, chat_input, charged=False):
+    """
+    POST one chat turn to the n8n RAG webhook and return the answer text.
+    charged: the call took session_id's rate-limit tokens (see post_to_rag_webhook).
+    """
+    METRICS["prompt_chars"] = METRICS["prompt_chars"] + len(chat_input)
+    webhook_response = post_to_rag_webhook(json.dumps({
+        "sessionId": session_id,
+        "chatInput": chat_input
+    }), session_id if charged else None)
+    
+    # Parse webhook response
+    if isinstance(webhook_response, str):
+        webhook_response = json.loads(webhook_response)
+    
+    return extract_ai_response(webhook_response)
+
+
+def publish_ai_event(event, message, user):
+    """Best-effort realtime push - clients fall back to polling ai_query_status"""
+    try:
+        frappe.publish_realtime(event, message, user=user)
+    except Exception:
+        pass
+
+
+# =============================================================================
+# UPLOADED FILES
+# =============================================================================
+
+def file_extension(file_name):
+    return file_name.rsplit(".", 1)[-1].lower() if file_name and "." in file_name else ""
+
+
+def describe_file_type(file_name, file_type):
+    """Type hint shown after the file name in the prompt"""
+    if file_type:
+        return f" (type: {file_type})"
+    if not file_name:
+        return ""
+    ext = file_extension(file_name)
+    if ext in ['jpg', 'jpeg', 'png', 'gif', 'webp']:
+        return " (image)"
+    if ext == 'pdf':
+        return " (PDF document)"
+    if ext in ['doc', 'docx']:
+        return " (Word document)"
+    if ext == 'txt':
+        return " (text file)"
+    if ext in ['xls', 'xlsx']:
+        return " (Excel file)"
+    return " (file)"
+
+
+def site_file_path(file_url):
+    """/files/... or /private/files/... part of a (possibly absolute) file URL"""
+    for marker in ["/private/files/", "/files/"]:
+        position = file_url.find(marker)
+        if position >= 0:
+            return file_url[position:]
+    return None
+
+
+def chunk_file_text(text):
+    """Paragraph-aligned chunks of at most ~AI_FILE_CHUNK_CHARS"""
+    chunks = []
+    current = ""
+    for paragraph in text.replace("\r\n", "\n").split("\n\n"):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        pieces = [paragraph] if len(paragraph) <= AI_FILE_CHUNK_CHARS else split_text_chunks(paragraph, AI_FILE_CHUNK_CHARS)
+        for piece in pieces:
+            if current and len(current) + len(piece) + 2 > AI_FILE_CHUNK_CHARS:
+                chunks.append(current)
+                current = piece
+            else:
+                current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def load_file_text(file_url):
+    """
+    Extracted text of an uploaded text file as {"file_name", "content_hash",
+    "chunks", "chars"}, served from the content-hash cache when possible.
+    Returns None when the file is not a readable text file.
+    """
+    file_path = site_file_path(file_url)
+    if not file_path:
+        return None
+    record = db_get_value(
+        "File",
+        {"file_url": file_path},
+        ["name", "file_name", "file_size", "content_hash"],
+        as_dict=True
+    )
+    if not record:
+        return None
+    # Cached text is shared between users, so check access to this File first
+    if not frappe.has_permission("File", "read", record.name):
+        frappe.throw(f"Not permitted to read file {record.file_name}", frappe.PermissionError)
+    if file_extension(record.file_name) not in AI_FILE_TEXT_EXTENSIONS:
+        return None
+    if frappe.utils.cint(record.file_size) > AI_FILE_MAX_BYTES:
+        return None
+    
+    cache_key = AI_FILE_PREFIX + (record.content_hash or stable_hash(f"{record.name}|{file_path}"))
+    extracted = cache_get(cache_key)
+    if extracted:
+        return extracted
+    
+    started = frappe.utils.now_datetime()
+    content = frappe.get_doc("File", record.name).get_content()
+    record_db_call(started)
+    if isinstance(content, bytes):
+        content = content.decode("utf-8", "replace")
+    started = frappe.utils.now_datetime()
+    extracted = {
+        "file_name": record.file_name,
+        "content_hash": record.content_hash,
+        "chunks": chunk_file_text(content),
+        "chars": len(content)
+    }
+    record_phase("file_extract", started)
+    cache_set(cache_key, extracted, AI_FILE_TTL)
+    return extracted
+
+
+def select_file_chunks(chunks, user_query, token_budget):
+    """
+    All chunks if they fit the budget, otherwise the ones sharing most words
+    with the question (earlier chunks win ties), in document order. Words
+    found in most chunks ("patient", "about", ...) carry no signal and are
+    ignored.
+    """
+    if estimate_tokens("".join(chunks)) <= token_budget:
+        return list(range(len(chunks)))
+    
+    texts = [chunk.lower() for chunk in chunks]
+    terms = [term.strip("?.,:;!()") for term in (user_query or "").lower().split()]
+    terms = [
+        term for term in set(terms)
+        if len(term) > 2 and sum(1 for text in texts if term in text) <= len(texts) / 2
+    ]
+    scored = []
+    for index, text in enumerate(texts):
+        scored.append((-sum(text.count(term) for term in terms), index))
+    
+    selected = []
+    used = 0
+    for negative_score, index in sorted(scored):
+        tokens = estimate_tokens(chunks[index])
+        if used + tokens > token_budget:
+            continue
+        selected.append(index)
+        used = used + tokens
+    return sorted(selected)
+
+
+def build_file_context(file_url, file_name, file_type, user_query):
+    """Prompt block for an uploaded file: its text when readable here, else its URL"""
+    extracted = load_file_text(file_url)
+    file_name = file_name or (extracted or {}).get("file_name")
+    display_name = file_name or 'Uploaded file'
+    
+    if extracted and extracted["chunks"]:
+        chunks = extracted["chunks"]
+        selected = select_file_chunks(chunks, user_query, AI_FILE_TOKEN_BUDGET)
+        if len(selected) == len(chunks):
+            coverage = "full text"
+        else:
+            coverage = f"sections {', '.join(str(index + 1) for index in selected)} of {len(chunks)}, chosen for the question"
+        file_text = "\n\n".join(f"[section {index + 1}]\n{chunks[index]}" for index in selected)
+        return f"""
+
+IMPORTANT: A file has been uploaded for analysis:
+- File Name: {display_name}{describe_file_type(file_name, file_type)}
+- Content ({coverage}):
+{file_text}
+
+Please analyze this file in the context of the patient's medical data."""
+    
+    # Build full public URL if relative
+    if file_url.startswith('/'):
+        full_file_url = f"{frappe.utils.get_url()}{file_url}"  # noqa: F821
+    else:
+        full_file_url = file_url
+    
+    return f"""
+
+IMPORTANT: A file has been uploaded for analysis:
+- File Name: {display_name}{describe_file_type(file_name, file_type)}
+- File URL: {full_file_url}
+
+Please analyze this file in the context of the patient's medical data."""
+
+
+# =============================================================================
+# AI PROMPTS
+# =============================================================================
+
+def full_context_block(patient_context, context_hash):
+    """The whole (compacted) chart, as sent on the first turn of a session"""
+    return f"""COMPLETE PATIENT DATA (RAW JSON, context hash {context_hash}):
+{to_compact_json(patient_context)}"""
+
+
+def initial_load_chat_input(context_block):
+    """Prompt for the overview shown when a patient is opened"""
+    return f"""I've just opened this patient's medical record. Please analyze their complete profile and provide:
+
+{context_block}
+
+Please provide:
+1. A brief overview of the patient
+2. Key alerts or concerns (allergies, chronic conditions)
+3. Important points from their medical history
+4. Any recommendations for the doctor's attention
+
+Keep it concise and actionable."""
+
+
+# =============================================================================
+# AI REQUEST COALESCING
+# =============================================================================
+
+def remember_session_overview(session_id, ai_response):
+    """Seed a session with an overview it was shown from the memo or a pre-analysis"""
+    if session_id and ai_response:
+        cache_set(AI_SESSION_SEED_PREFIX + session_id, ai_response, AI_SESSION_TTL)
+
+
+def ai_request_key(user, session_id, patient_id, user_query, context_hash, file_url, is_initial_load):
+    """Identity of an ai_query for in-flight coalescing and answer memoisation"""
+    if is_initial_load:
+        # Same chart, same overview - whichever session asks for it
+        return stable_hash(f"initial|{user}|{patient_id}|{context_hash}|{file_url or ''}")
+    return stable_hash(f"{user}|{session_id}|{user_query}|{context_hash}|{file_url or ''}")
+
+
+# =============================================================================
+# AI ADMISSION CONTROL
+# =============================================================================
+
+# Bucket and slot state is read-modify-write like the cache stats, so limits
+# are approximate under heavy contention - close enough to protect n8n.
+
+def rate_bucket_limits(session_id):
+    """The request's token bucket keys, mapped to their AI_RATE_LIMITS entry"""
+    identities = {"user": frappe.session.user, "session": session_id, "site": "all"}
+    return {
+        f"{AI_RATE_LIMIT_PREFIX}{scope}:{identities.get(scope)}": limit
+        for scope, limit in AI_RATE_LIMITS.items()
+    }
+
+
+def take_rate_tokens(session_id):
+    """
+    Take one token from the user, session and site buckets. Returns 0 when
+    admitted, otherwise the seconds until every bucket has a token again
+    (and takes nothing).
+    """
+    now = frappe.utils.now_datetime()
+    buckets = []
+    wait = 0
+    for key, limit in rate_bucket_limits(session_id).items():
+        rate = limit["per_minute"] / 60.0
+        tokens = limit["burst"]
+        state = cache_get(key)
+        if state:
+            elapsed = max(frappe.utils.time_diff_in_seconds(now, state["updated"]), 0)
+            tokens = min(limit["burst"], state["tokens"] + elapsed * rate)
+        if tokens < 1:
+            wait = max(wait, (1 - tokens) / rate)
+        # An untouched bucket is full again after burst / rate seconds
+        buckets.append({"key": key, "tokens": tokens, "ttl": int(limit["burst"] / rate) + 1})
+    
+    if wait:
+        return int(wait) + 1
+    for bucket in buckets:
+        cache_set(bucket["key"], {"tokens": bucket["tokens"] - 1, "updated": str(now)}, bucket["ttl"])
+    return 0
+
+
+def refund_rate_tokens(session_id):
+    """Give back the tokens of a request that was admitted but then found no webhook slot"""
+    for key, limit in rate_bucket_limits(session_id).items():
+        state = cache_get(key)
+        if state:
+            rate = limit["per_minute"] / 60.0
+            state["tokens"] = min(limit["burst"], state["tokens"] + 1)
+            cache_set(key, state, int(limit["burst"] / rate) + 1)
+
+
+def acquire_webhook_slot(interactive):
+    """Lease a webhook slot; returns its id, or None when the request's share of slots is taken"""
+    now = frappe.utils.now_datetime()
+    slots = {}
+    for slot_id, expires in (cache_get(AI_SLOTS_KEY) or {}).items():
+        # A lease outlives the job timeout, so a crashed worker's slot frees itself
+        if frappe.utils.get_datetime(expires) > now:
+            slots[slot_id] = expires
+    
+    limit = AI_MAX_INFLIGHT_WEBHOOKS
+    if not interactive:
+        limit = max(1, int(AI_MAX_INFLIGHT_WEBHOOKS * AI_OVERVIEW_SLOT_SHARE))
+    if len(slots) >= limit:
+        return None
+    
+    slot_id = stable_hash(f"{frappe.session.user}|{now}|{len(slots)}")
+    slots[slot_id] = str(frappe.utils.add_to_date(now, seconds=AI_JOB_TIMEOUT + 60))
+    cache_set(AI_SLOTS_KEY, slots, AI_JOB_TIMEOUT + 60)
+    return slot_id
+
+
+def wait_for_webhook_slot(interactive, wait_seconds):
+    """acquire_webhook_slot, polling for up to wait_seconds"""
+    waited = 0
+    while True:
+        slot_id = acquire_webhook_slot(interactive)
+        if slot_id or waited >= wait_seconds:
+            return slot_id
+        frappe.db.sql("select sleep(%s)", (AI_SLOT_POLL_SECONDS,))
+        waited = waited + AI_SLOT_POLL_SECONDS
+
+
+def release_webhook_slot(slot_id):
+    if not slot_id:
+        return
+    slots = cache_get(AI_SLOTS_KEY) or {}
+    if slots.pop(slot_id, None):
+        cache_set(AI_SLOTS_KEY, slots, AI_JOB_TIMEOUT + 60)
+
+
+def reject_rate_limited(query_type, message, retry_after):
+    """HTTP 429 with a retry hint (the body carries it too, for fetch clients)"""
+    METRICS["rate_limited"] = METRICS["rate_limited"] + 1
+    frappe.response["http_status_code"] = 429
+    frappe.response.update({
+        "status": "error",
+        "query_type": query_type,
+        "code": "rate_limited",
+        "message": message,
+        "retry_after": retry_after,
+        "fallback_message": AI_FALLBACK_MESSAGE
+    })
+
+
+# =============================================================================
+# RESPONSE SHAPING
+# =============================================================================
+
+def resolve_payload_options(options):
+    """Merge request options over their profile into one shaping plan"""
+    options = options or {}
+    profile = options.get("profile") or "full"
+    if profile not in PAYLOAD_PROFILES:
+        frappe.throw(f"Unknown payload profile '{profile}'")
+    
+    plan = dict(PAYLOAD_PROFILES[profile])
+    for key in ["exclude_standard", "exclude_empty", "encoding"]:
+        if options.get(key) is not None:
+            plan[key] = options.get(key)
+    
+    fields = dict(plan["fields"])
+    fields.update(options.get("fields") or {})
+    plan["fields"] = fields
+    
+    if plan["encoding"] not in ["json", "columnar"]:
+        frappe.throw(f"Unknown payload encoding '{plan['encoding']}'")
+    return plan
+
+
+def project_value(value, plan):
+    """
+    Apply field allowlists (matched on each record's "doctype") and drop
+    standard metadata / empty values. Returns new containers, so cached
+    payloads are never modified.
+    """
+    if isinstance(value, dict):
+        allowed = plan["fields"].get(value.get("doctype")) if value.get("doctype") else None
+        projected = {}
+        for key, item in value.items():
+            if allowed is not None and key not in allowed:
+                continue
+            if plan["exclude_standard"] and (key in PAYLOAD_STANDARD_FIELDS or key.startswith("_")):
+                continue
+            item = project_value(item, plan)
+            if plan["exclude_empty"] and is_empty_value(item):
+                continue
+            projected[key] = item
+        return projected
+    
+    if isinstance(value, list):
+        return [project_value(item, plan) for item in value]
+    
+    return value
+
+
+def encode_columnar(value):
+    """Turn every non-empty list of records into {"columns": [...], "rows": [[...], ...]}"""
+    if isinstance(value, dict):
+        return {key: encode_columnar(item) for key, item in value.items()}
+    
+    if isinstance(value, list):
+        if value and all(isinstance(item, dict) for item in value):
+            columns = []
+            seen = set()
+            for item in value:
+                for key in item:
+                    if key not in seen:
+                        seen.add(key)
+                        columns.append(key)
+            return {
+                "columns": columns,
+                "rows": [[encode_columnar(item.get(column)) for column in columns] for item in value]
+            }
+        return [encode_columnar(item) for item in value]
+    
+    return value
+
+
+def shape_response(result, options):
+    """Slim a read query's response according to its "options" (see RESPONSE SHAPING CONFIGURATION)"""
+    plan = resolve_payload_options(options)
+    if result.get("status") != "success" or result.get("unchanged"):
+        return result
+    
+    started = frappe.utils.now_datetime()
+    data = result.get("data")
+    if plan["fields"] or plan["exclude_standard"] or plan["exclude_empty"]:
+        data = project_value(data, plan)
+    
+    shaped = dict(result)
+    if plan["encoding"] == "columnar":
+        data = encode_columnar(data)
+        shaped["encoding"] = "columnar"
+    shaped["data"] = data
+    record_phase("shaping", started)
+    return shaped
+
+
+# =============================================================================
+# REQUEST MEMO
+# =============================================================================
+
+# The script runs once per HTTP request, so module state lives exactly as long
+# as one request. Lookups shared by several sub-queries of a batch are memoised
+# here and loaded only once.
+REQUEST_MEMO = {}
+
+
+def get_patient_doc(patient_id):
+    """Load the Patient doc once per request (raises DoesNotExistError if missing)"""
+    memo_key = f"patient:{patient_id}"
+    if memo_key not in REQUEST_MEMO:
+        started = frappe.utils.now_datetime()
+        REQUEST_MEMO[memo_key] = frappe.get_doc("Patient", patient_id)
+        record_db_call(started)
+    return REQUEST_MEMO[memo_key]
+
+
+# =============================================================================
+# BULK DOCUMENT LOADING
+# =============================================================================
+
+def load_docs_bulk(doctype, filters, order_by=None, limit=None):
+    """
+    Load complete documents (parent fields + every child table) as raw dicts.
+
+    Replaces the "get names, then frappe.get_doc() + as_dict() per row" pattern:
+    all parent rows come back in ONE query and each child table in ONE
+    `parent in (...)` query, then rows are regrouped in memory. The result has
+    the same shape as Document.as_dict(), so the frontend sees no difference.
+    """
+    parents = db_get_all(
+        doctype,
+        filters=filters,
+        fields=["*"],
+        order_by=order_by,
+        limit=limit
+    )
+    if not parents:
+        return []
+    
+    parent_names = []
+    docs_by_name = {}
+    for row in parents:
+        row["doctype"] = doctype
+        parent_names.append(row.name)
+        docs_by_name[row.name] = row
+    
+    # One query per child table (drug_prescription, lab_test_prescription, ...)
+    for table_field in frappe.get_meta(doctype).get_table_fields():
+        fieldname = table_field.fieldname
+        child_doctype = table_field.options
+        for row in parents:
+            row[fieldname] = []
+        
+        children = db_get_all(
+            child_doctype,
+            filters={
+                "parent": ["in", parent_names],
+                "parenttype": doctype,
+                "parentfield": fieldname
+            },
+            fields=["*"],
+            order_by="idx asc"
+        )
+        for child in children:
+            child["doctype"] = child_doctype
+            parent_doc = docs_by_name.get(child.parent)
+            if parent_doc is not None:
+                parent_doc[fieldname].append(child)
+    
+    return parents
+
+
+# =============================================================================
+# INCREMENTAL SYNC
+# =============================================================================
+
+# List queries (encounters, lab tests, vital signs) return a "sync_token": the
+# newest "modified" among their records. Sending it back as "since" returns
+# only records modified at or after it, so a client can patch the list it
+# already holds instead of fetching it again. Changed records come back in the
+# query's usual order and limit; a client that merges them and re-applies the
+# order and limit ends up with exactly the full list.
+
+def sync_filters(patient_id, since, exclude_cancelled=True):
+    """
+    Filters for a patient's list query. With `since`, cancelled records are
+    included as well, so they can be reported under "removed".
+    """
+    filters = {"patient": patient_id}
+    if since:
+        try:
+            frappe.utils.get_datetime(since)
+        except Exception:
+            frappe.throw("Invalid since timestamp")
+        filters["modified"] = [">=", since]
+    elif exclude_cancelled:
+        filters["docstatus"] = ["!=", 2]
+    return filters
+
+
+def sync_list_data(key, rows, since, exclude_cancelled=True, bookkeeping_fields=None):
+    """
+    List payload with its sync_token; with `since`, cancelled rows become
+    "removed" names. bookkeeping_fields are dropped from the rows afterwards
+    (fields fetched only for the sync, e.g. modified and docstatus).
+    """
+    token = since or ""
+    for row in rows:
+        modified = str(row.get("modified") or "")
+        if modified > token:
+            token = modified
+    
+    data = {}
+    if since:
+        removed = []
+        if exclude_cancelled:
+            removed = [row.get("name") for row in rows if row.get("docstatus") == 2]
+            rows = [row for row in rows if row.get("docstatus") != 2]
+        data = {"incremental": True, "since": since, "removed": removed}
+    for row in rows:
+        for field in bookkeeping_fields or []:
+            row.pop(field, None)
+    data[key] = rows
+    data["count"] = len(rows)
+    data["sync_token"] = token or None
+    return data
+
+
+# =============================================================================
+# PRESCRIPTIONS
+# =============================================================================
+
+def load_recent_prescriptions(patient_id):
+    """
+    Medications from the last 90 days of submitted encounters, one entry per
+    drug (its most recent prescription), with the date it stays active until.
+    """
+    # One query: encounter header + drug rows + duration definition
+    rows = db_sql(
+        """select coalesce(dp.`drug_name`, dp.`drug_code`) as medication,
+            dp.`drug_code`, dp.`dosage`, dp.`dosage_form`, dp.`period`,
+            dp.`interval`, dp.`interval_uom`,
+            e.`name` as encounter, e.`encounter_date`, e.`practitioner`,
+            pd.`number` as period_number, pd.`period` as period_unit
+        from `tabDrug Prescription` dp
+        join `tabPatient Encounter` e on e.`name` = dp.`parent`
+        left join `tabPrescription Duration` pd on pd.`name` = dp.`period`
+        where e.`patient` = %(patient)s
+            and e.`docstatus` = 1
+            and e.`encounter_date` >= %(since)s
+            and dp.`parenttype` = 'Patient Encounter'
+        order by e.`encounter_date` desc, e.`name` desc, dp.`idx` asc""",
+        {
+            "patient": patient_id,
+            "since": str(frappe.utils.add_days(frappe.utils.nowdate(), -90))
+        },
+        as_dict=True
+    )
+    
+    # Repeat prescriptions of the same drug collapse into the most recent one
+    today = frappe.utils.getdate(frappe.utils.nowdate())
+    period_days = {"Hour": 1 / 24, "Day": 1, "Week": 7, "Month": 30, "Year": 365}
+    prescriptions = []
+    by_drug = {}
+    for row in rows:
+        drug_key = row.drug_code or row.medication
+        if drug_key in by_drug:
+            by_drug[drug_key]["times_prescribed"] = by_drug[drug_key]["times_prescribed"] + 1
+            continue
+        
+        # The prescription stays active for its Prescription Duration
+        active_until = None
+        still_active = None
+        if row.period_number and row.period_unit in period_days:
+            duration_days = int(round(frappe.utils.flt(row.period_number) * period_days[row.period_unit]))
+            active_until = frappe.utils.getdate(frappe.utils.add_days(row.encounter_date, duration_days))
+            still_active = active_until >= today
+        
+        med_info = {
+            "medication": row.medication,
+            "drug_code": row.drug_code,
+            "dosage": row.dosage,
+            "dosage_form": row.dosage_form,
+            "period": row.period,
+            "interval": row.interval,
+            "interval_uom": row.interval_uom,
+            "practitioner": row.practitioner,
+            "encounter": row.encounter,
+            "prescribed_date": str(row.encounter_date),
+            "active_until": str(active_until) if active_until else None,
+            "still_active": still_active,
+            "times_prescribed": 1
+        }
+        by_drug[drug_key] = med_info
+        prescriptions.append(med_info)
+    
+    return prescriptions
+
+
+def mark_still_active(prescriptions):
+    """Re-evaluate still_active against today (stored snapshots age)"""
+    today = str(frappe.utils.nowdate())
+    marked = []
+    for prescription in prescriptions:
+        prescription = dict(prescription)
+        active_until = prescription.get("active_until")
+        prescription["still_active"] = str(active_until) >= today if active_until else None
+        marked.append(prescription)
+    return marked
+
+
+# =============================================================================
+# VITAL SIGNS TRENDS
+# =============================================================================
+
+def vital_value_sql(metric):
+    """Numeric value of a Vital Signs column (ERPNext stores most as Data fields)"""
+    return f"cast(nullif(`{metric}`, '') as decimal(10, 2))"
+
+
+def classify_trend(slope_per_day, days, metric_config):
+    """rising / falling / stable, judged against the width of the normal range"""
+    if slope_per_day is None:
+        return None
+    change = slope_per_day * days
+    if abs(change) < (metric_config["high"] - metric_config["low"]) * VITALS_STABLE_FRACTION:
+        return "stable"
+    return "rising" if change > 0 else "falling"
+
+
+def build_vital_trends(patient_id, days=VITALS_TREND_DAYS, points=VITALS_TREND_POINTS, include_series=True):
+    """
+    Per-metric statistics for the last `days` of Vital Signs, computed by the
+    database in one pass over the window rather than row by row in Python.
+
+    The slope (units per day) is an ordinary least-squares fit whose sums
+    (n, Σx, Σy, Σxy, Σx²) are accumulated in the same aggregate query. With
+    include_series the window is also downsampled into at most `points`
+    buckets (mean per bucket) plus a trailing rolling mean for charting.
+    """
+    since = str(frappe.utils.add_days(frappe.utils.nowdate(), -days))
+    values = {"patient": patient_id, "since": since}
+    reading_time = "timestamp(`signs_date`, coalesce(`signs_time`, '00:00:00'))"
+    where_clause = """where `patient` = %(patient)s and `docstatus` != 2 and `signs_date` >= %(since)s"""
+    
+    # Query 1: every statistic for every metric, one row
+    x_days = f"((unix_timestamp({reading_time}) - unix_timestamp(%(since)s)) / 86400)"
+    columns = [
+        "count(*) as readings",
+        f"min({reading_time}) as first_reading",
+        f"max({reading_time}) as last_reading"
+    ]
+    for metric, config in VITALS_TREND_METRICS.items():
+        value = vital_value_sql(metric)
+        x_when_value = f"case when {value} is not null then {x_days} end"
+        columns = columns + [
+            f"count({value}) as {metric}_count",
+            f"min({value}) as {metric}_min",
+            f"max({value}) as {metric}_max",
+            f"avg({value}) as {metric}_mean",
+            f"sum(case when {value} < {config['low']} or {value} > {config['high']} then 1 else 0 end)"
+            f" as {metric}_out_of_range",
+            f"sum({x_when_value}) as {metric}_sx",
+            f"sum({value}) as {metric}_sy",
+            f"sum({x_when_value} * {value}) as {metric}_sxy",
+            f"sum({x_when_value} * {x_when_value}) as {metric}_sxx"
+        ]
+    totals = db_sql(
+        f"select {', '.join(columns)} from `tabVital Signs` {where_clause}",
+        values,
+        as_dict=True
+    )[0]
+    
+    result = {
+        "mode": "trend",
+        "window_days": days,
+        "since": since,
+        "readings": frappe.utils.cint(totals.readings),
+        "first_reading": str(totals.first_reading) if totals.first_reading else None,
+        "last_reading": str(totals.last_reading) if totals.last_reading else None,
+        "metrics": {}
+    }
+    if not result["readings"]:
+        return result
+    
+    # Query 2: most recent reading, for "latest" values and flags
+    latest_columns = [f"{vital_value_sql(metric)} as {metric}" for metric in VITALS_TREND_METRICS]
+    latest = db_sql(
+        f"""select {', '.join(latest_columns)}
+        from `tabVital Signs` {where_clause}
+        order by `signs_date` desc, `signs_time` desc
+        limit 1""",
+        values,
+        as_dict=True
+    )[0]
+    
+    for metric, config in VITALS_TREND_METRICS.items():
+        n = frappe.utils.cint(totals.get(f"{metric}_count"))
+        if not n:
+            continue
+        
+        slope = None
+        if n > 1:
+            sx = frappe.utils.flt(totals.get(f"{metric}_sx"))
+            sy = frappe.utils.flt(totals.get(f"{metric}_sy"))
+            denominator = n * frappe.utils.flt(totals.get(f"{metric}_sxx")) - sx * sx
+            if denominator:
+                slope = (n * frappe.utils.flt(totals.get(f"{metric}_sxy")) - sx * sy) / denominator
+        
+        latest_value = latest.get(metric)
+        result["metrics"][metric] = {
+            "label": config["label"],
+            "unit": config["unit"],
+            "normal_range": [config["low"], config["high"]],
+            "count": n,
+            "min": frappe.utils.flt(totals.get(f"{metric}_min"), 2),
+            "max": frappe.utils.flt(totals.get(f"{metric}_max"), 2),
+            "mean": frappe.utils.flt(totals.get(f"{metric}_mean"), 2),
+            "latest": frappe.utils.flt(latest_value, 2) if latest_value is not None else None,
+            "slope_per_day": round(slope, 4) if slope is not None else None,
+            "trend": classify_trend(slope, days, config),
+            "out_of_range_count": frappe.utils.cint(totals.get(f"{metric}_out_of_range")),
+            "latest_out_of_range": (
+                latest_value is not None
+                and (frappe.utils.flt(latest_value) < config["low"] or frappe.utils.flt(latest_value) > config["high"])
+            )
+        }
+    
+    if not include_series:
+        return result
+    
+    # Query 3: downsample the window into fixed-width buckets for charting
+    bucket_seconds = max(int((days * 86400 + points - 1) / points), 1)
+    bucket_columns = [f"avg({vital_value_sql(metric)}) as {metric}" for metric in result["metrics"]]
+    buckets = db_sql(
+        f"""select floor((unix_timestamp({reading_time}) - unix_timestamp(%(since)s)) / {bucket_seconds}) as bucket,
+            {', '.join(bucket_columns)}
+        from `tabVital Signs` {where_clause}
+        group by bucket
+        order by bucket""",
+        values,
+        as_dict=True
+    )
+    
+    result["bucket_seconds"] = bucket_seconds
+    result["series_times"] = [
+        str(frappe.utils.add_to_date(since, seconds=frappe.utils.cint(row.bucket) * bucket_seconds))
+        for row in buckets
+    ]
+    for metric in result["metrics"]:
+        series = [frappe.utils.flt(row.get(metric), 2) if row.get(metric) is not None else None for row in buckets]
+        rolling = []
+        for index in range(len(series)):
+            window = [value for value in series[max(0, index - VITALS_ROLLING_WINDOW + 1):index + 1] if value is not None]
+            rolling.append(round(sum(window) / len(window), 2) if window else None)
+        result["metrics"][metric]["series"] = series
+        result["metrics"][metric]["rolling_mean"] = rolling
+    
+    return result
+
+
+# =============================================================================
+# PATIENT SNAPSHOT
+# =============================================================================
+
+def snapshot_doctype_installed():
+    """True once setup_patient_snapshots has created the snapshot doctype"""
+    if "snapshot_installed" not in REQUEST_MEMO:
+        REQUEST_MEMO["snapshot_installed"] = bool(db_exists("DocType", SNAPSHOT_DOCTYPE))
+    return REQUEST_MEMO["snapshot_installed"]
+
+
+def compute_snapshot_section(patient_id, section):
+    """Derive one snapshot section from the source doctypes"""
+    if section == "profile":
+        profile = db_get_value("Patient", patient_id, ["patient_name", "allergies"], as_dict=True)
+        return dict(profile) if profile else {}
+    
+    if section == "visits":
+        visits = db_sql(
+            """select count(*) as visit_count, max(`encounter_date`) as last_visit
+            from `tabPatient Encounter`
+            where `patient` = %(patient)s and `docstatus` = 1""",
+            {"patient": patient_id},
+            as_dict=True
+        )[0]
+        return {
+            "visit_count": frappe.utils.cint(visits.visit_count),
+            "last_visit": str(visits.last_visit) if visits.last_visit else None
+        }
+    
+    if section == "conditions":
+        # Diagnoses that keep coming back across visits
+        return db_sql(
+            """select d.`diagnosis`, count(distinct e.`name`) as visits, max(e.`encounter_date`) as last_seen
+            from `tabPatient Encounter Diagnosis` d
+            join `tabPatient Encounter` e on e.`name` = d.`parent`
+            where e.`patient` = %(patient)s and e.`docstatus` = 1
+                and d.`parenttype` = 'Patient Encounter'
+            group by d.`diagnosis`
+            having count(distinct e.`name`) >= %(min_visits)s
+            order by visits desc, last_seen desc""",
+            {"patient": patient_id, "min_visits": SNAPSHOT_CHRONIC_MIN_VISITS},
+            as_dict=True
+        )
+    
+    if section == "medications":
+        return load_recent_prescriptions(patient_id)
+    
+    if section == "labs":
+        return db_get_all(
+            "Lab Test",
+            filters={"patient": patient_id},
+            fields=["name", "lab_test_name", "status", "result_date", "creation"],
+            order_by="creation desc",
+            limit=5
+        )
+    
+    if section == "vitals":
+        latest = db_get_all(
+            "Vital Signs",
+            filters={"patient": patient_id, "docstatus": ["!=", 2]},
+            fields=["signs_date", "signs_time"] + list(VITALS_TREND_METRICS.keys()),
+            order_by="signs_date desc, signs_time desc",
+            limit=1
+        )
+        return latest[0] if latest else {}
+    
+    frappe.throw(f"Unknown snapshot section '{section}'")
+
+
+def refresh_patient_snapshot(patient_id, sections=None):
+    """
+    Recompute `sections` (default: all) of a patient's snapshot and store it.
+    Untouched sections keep their stored values, so a new vitals reading only
+    costs the vitals query. Returns the snapshot, or None once the patient has
+    been deleted (its snapshot row is removed too).
+    """
+    stored = db_get_value(SNAPSHOT_DOCTYPE, patient_id, ["name", "snapshot"], as_dict=True)
+    
+    if not db_exists("Patient", patient_id):
+        if stored:
+            frappe.delete_doc(SNAPSHOT_DOCTYPE, patient_id, ignore_permissions=True)
+        cache_delete(PATIENT_CACHE_PREFIX + patient_id)
+        return None
+    
+    snapshot = json.loads(stored.snapshot) if stored and stored.snapshot else {}
+    for section in SNAPSHOT_SECTIONS:
+        if section not in snapshot or not sections or section in sections:
+            snapshot[section] = compute_snapshot_section(patient_id, section)
+    
+    # Store and return the same JSON-safe form (dates as strings)
+    snapshot_json = to_compact_json(snapshot)
+    snapshot = json.loads(snapshot_json)
+    values = {
+        "patient_name": snapshot["profile"].get("patient_name"),
+        "last_visit": snapshot["visits"].get("last_visit"),
+        "visit_count": snapshot["visits"].get("visit_count"),
+        "refreshed_on": frappe.utils.now(),
+        "snapshot": snapshot_json
+    }
+    
+    if stored:
+        frappe.db.set_value(SNAPSHOT_DOCTYPE, patient_id, values)
+    else:
+        snapshot_doc = frappe.get_doc({"doctype": SNAPSHOT_DOCTYPE, "patient": patient_id})
+        snapshot_doc.update(values)
+        try:
+            snapshot_doc.insert(ignore_permissions=True)
+        except Exception:
+            # A concurrent refresh (backfill, doc event) inserted the row first
+            if not db_exists(SNAPSHOT_DOCTYPE, patient_id):
+                raise
+            frappe.db.set_value(SNAPSHOT_DOCTYPE, patient_id, values)
+    
+    # The cached summary embeds the snapshot
+    cache_delete(PATIENT_CACHE_PREFIX + patient_id)
+    return snapshot
+
+
+def queue_snapshot_refresh(patient_id):
+    """Queue a refresh_patient_snapshot job unless one was queued for the patient recently"""
+    pending_key = SNAPSHOT_PENDING_PREFIX + patient_id
+    if cache_get(pending_key):
+        return
+    cache_set(pending_key, True, SNAPSHOT_PENDING_TTL)
+    frappe.enqueue(
+        API_METHOD,
+        queue="short",
+        query_type="refresh_patient_snapshot",
+        parameters={"patient_id": patient_id}
+    )
+
+
+def get_patient_snapshot(patient_id):
+    """
+    The patient's snapshot in one row read. A missing row is derived in memory
+    and stored by a queued job, so reads never write; before
+    setup_patient_snapshots has run, the snapshot is always derived in memory.
+    """
+    memo_key = f"snapshot:{patient_id}"
+    if memo_key in REQUEST_MEMO:
+        return REQUEST_MEMO[memo_key]
+    
+    snapshot = None
+    if snapshot_doctype_installed():
+        stored = db_get_value(SNAPSHOT_DOCTYPE, patient_id, "snapshot")
+        if stored:
+            snapshot = json.loads(stored)
+        else:
+            queue_snapshot_refresh(patient_id)
+    if snapshot is None:
+        snapshot = json.loads(to_compact_json(
+            {section: compute_snapshot_section(patient_id, section) for section in SNAPSHOT_SECTIONS}
+        ))
+    
+    REQUEST_MEMO[memo_key] = snapshot
+    return snapshot
+
+
+def build_patient_alerts(snapshot):
+    """Alerts for the patient panel and the AI prompt, read from the snapshot"""
+    alerts = []
+    allergies = (snapshot.get("profile") or {}).get("allergies")
+    if allergies:
+        alerts.append({
+            "type": "allergy",
+            "severity": "high",
+            "message": f"Allergies: {allergies}"
+        })
+    
+    latest_vitals = snapshot.get("vitals") or {}
+    for metric, config in VITALS_TREND_METRICS.items():
+        value = latest_vitals.get(metric)
+        if value in [None, ""]:
+            continue
+        reading = frappe.utils.flt(value)
+        if reading < config["low"] or reading > config["high"]:
+            alerts.append({
+                "type": "vital_sign",
+                "severity": "medium",
+                "message": f"Latest {config['label']}: {value} {config['unit']}"
+                           f" (normal {config['low']}-{config['high']})"
+            })
+    
+    return alerts
+
+
+# =============================================================================
+# PATIENT SUMMARY ASSEMBLY
+# =============================================================================
+
+def build_patient_summary(patient_id):
+    """Assemble the full get_patient_summary payload straight from the database"""
+    # Get patient - get ALL fields as raw dict
+    patient = get_patient_doc(patient_id)
+    started = frappe.utils.now_datetime()
+    patient_data = patient.as_dict()
+    record_phase("as_dict", started)
+    
+    # Get ALL encounter data as raw dicts (including all child tables) - NO TRANSFORMATION
+    # Bulk-loaded: one query for the encounters + one per child table
+    encounters = load_docs_bulk(
+        "Patient Encounter",
+        filters={"patient": patient_id, "docstatus": ["!=", 2]},
+        order_by="encounter_date desc",
+        limit=5
+    )
+    
+    # Get ALL appointment data as raw dicts (including all fields) - NO TRANSFORMATION
+    appointments = load_docs_bulk(
+        "Patient Appointment",
+        filters={
+            "patient": patient_id,
+            "appointment_date": [">=", frappe.utils.nowdate()],
+            "status": ["in", ["Open", "Scheduled", "Confirmed"]]
+        },
+        order_by="appointment_date asc",
+        limit=5
+    )
+    
+    # Derived facts (allergies, conditions, medications, labs, latest vitals)
+    # come from the patient's snapshot row
+    snapshot = get_patient_snapshot(patient_id)
+    visits = snapshot.get("visits") or {}
+    
+    return {
+        "patient": patient_data,
+        "recent_encounters": encounters,
+        "upcoming_appointments": appointments,
+        "pending_lab_tests": snapshot.get("labs") or [],
+        "clinical_snapshot": {
+            "last_visit": visits.get("last_visit"),
+            "visit_count": visits.get("visit_count"),
+            "chronic_conditions": snapshot.get("conditions") or [],
+            "active_medications": [
+                medication for medication in mark_still_active(snapshot.get("medications") or [])
+                if medication["still_active"] is not False
+            ],
+            "latest_vitals": snapshot.get("vitals") or {}
+        },
+        # Window statistics instead of raw readings - compact enough for the prompt
+        "vital_trends": build_vital_trends(patient_id, include_series=False),
+        "alerts": build_patient_alerts(snapshot)
+    }
+
+
+def load_patient_summary(patient_id, refresh=False):
+    """
+    Summary from the patient cache, rebuilt (and re-cached) on a miss or a
+    forced refresh. Returns {"summary": ..., "version": ..., "etag": ...,
+    "cached": bool}. Both hashes are cached with the summary so hits don't
+    re-hash the chart.
+    """
+    cache_key = PATIENT_CACHE_PREFIX + patient_id
+    entry = None if refresh else cache_get(cache_key)
+    # Entries written before the hashes were cached hold the bare summary
+    cached = bool(entry) and "etag" in entry
+    
+    if cached:
+        record_cache_event("hits")
+    else:
+        record_cache_event("misses")
+        summary = build_patient_summary(patient_id)
+        entry = {
+            "summary": summary,
+            "version": patient_context_version(summary),
+            "etag": stable_hash(to_compact_json(summary))
+        }
+        cache_set(cache_key, entry, PATIENT_CACHE_TTL)
+    
+    return {"summary": entry["summary"], "version": entry["version"], "etag": entry["etag"], "cached": cached}
+
+
+def patient_context_version(summary):
+    """
+    Hash of the chart data in a summary - changes when a rebuild finds new data.
+    Parts worked out against today's date (the vital trend window and which
+    medications are still active) are left out, so a rebuild after midnight
+    does not make an unchanged chart stale. New prescriptions still change it
+    through recent_encounters, and new vitals through latest_vitals.
+    """
+    versioned = {k: v for k, v in summary.items() if k != "vital_trends"}
+    clinical_snapshot = {
+        k: v for k, v in (summary.get("clinical_snapshot") or {}).items()
+        if k != "active_medications"
+    }
+    versioned["clinical_snapshot"] = clinical_snapshot
+    return stable_hash(to_compact_json(versioned))
+
+
+# =============================================================================
+# PATIENT RETRIEVAL INDEX
+# =============================================================================
+
+LN2 = 0.6931471805599453
+
+
+def natural_log(x):
+    """ln(x) for x > 0 - Server Scripts cannot import math"""
+    exponent = 0
+    while x > 2:
+        x = x / 2
+        exponent = exponent + 1
+    while x < 1:
+        x = x * 2
+        exponent = exponent - 1
+    # ln(x) = 2 * atanh((x - 1) / (x + 1)), converging fast for x in [1, 2]
+    y = (x - 1) / (x + 1)
+    y_squared = y * y
+    term = y
+    total = 0.0
+    for n in range(1, 30, 2):
+        total = total + term / n
+        term = term * y_squared
+    return 2 * total + exponent * LN2
+
+
+def tokenize(text):
+    """Lower-case word tokens without stopwords, plural "s" stripped"""
+    cleaned = "".join(ch if ch.isalnum() else " " for ch in str(text or "").lower())
+    tokens = []
+    for word in cleaned.split():
+        if len(word) < 2 or word in RETRIEVAL_STOPWORDS:
+            continue
+        if len(word) > 4 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+def encounter_passage(encounter):
+    """One retrievable passage per encounter: note, symptoms, diagnoses, orders"""
+    parts = [f"Encounter on {encounter.get('encounter_date')} with {encounter.get('practitioner_name') or encounter.get('practitioner') or 'unknown practitioner'}"]
+    if encounter.get("medical_department"):
+        parts.append(f"Department: {encounter.get('medical_department')}")
+    if encounter.get("encounter_comment"):
+        parts.append(f"Note: {encounter.get('encounter_comment')}")
+    # (label, child table, name field, fallback name field, detail fields)
+    child_lines = [
+        ("Symptoms", "symptoms", "complaint", None, []),
+        ("Diagnosis", "diagnosis", "diagnosis", None, []),
+        ("Medications", "drug_prescription", "drug_name", "drug_code", ["dosage", "period"]),
+        ("Lab tests ordered", "lab_test_prescription", "lab_test_name", "lab_test_code", []),
+        ("Procedures", "procedure_prescription", "procedure_name", "procedure", [])
+    ]
+    for label, fieldname, name_field, fallback_field, detail_fields in child_lines:
+        items = []
+        for row in encounter.get(fieldname) or []:
+            name = row.get(name_field) or (row.get(fallback_field) if fallback_field else None)
+            if name:
+                details = [str(row.get(field)) for field in detail_fields if row.get(field)]
+                items.append(" ".join([str(name)] + details))
+        if items:
+            parts.append(f"{label}: {', '.join(items)}")
+    return ". ".join(parts)
+
+
+def lab_test_passage(lab_test):
+    """One retrievable passage per lab test with its result rows"""
+    parts = [f"Lab test {lab_test.get('lab_test_name') or lab_test.get('template')} ({lab_test.get('status')}) on {lab_test.get('result_date') or lab_test.get('creation')}"]
+    results = []
+    for row in lab_test.get("normal_test_items") or []:
+        if row.get("result_value") in (None, ""):
+            continue
+        result = f"{row.get('lab_test_name')} {row.get('result_value')} {row.get('lab_test_uom') or ''}".strip()
+        if row.get("normal_range"):
+            result = f"{result} (normal {row.get('normal_range')})"
+        results.append(result)
+    if results:
+        parts.append(f"Results: {', '.join(results)}")
+    if lab_test.get("lab_test_comment"):
+        parts.append(f"Comment: {lab_test.get('lab_test_comment')}")
+    return ". ".join(parts)
+
+
+def profile_passage(patient):
+    parts = [f"Patient profile of {patient.get('patient_name')}"]
+    for label, field in [("Allergies", "allergies"), ("Medical history", "medical_history"),
+                         ("Surgical history", "surgical_history"), ("Regular medication", "medication")]:
+        if patient.get(field):
+            parts.append(f"{label}: {patient.get(field)}")
+    return ". ".join(parts)
+
+
+def index_passage(index, key, version, date, text):
+    tokens = tokenize(text)
+    term_counts = {}
+    for token in tokens:
+        term_counts[token] = term_counts.get(token, 0) + 1
+    for term in term_counts:
+        index["df"][term] = index["df"].get(term, 0) + 1
+    index["total_length"] = index["total_length"] + len(tokens)
+    index["passages"][key] = {"version": version, "date": date, "text": text, "length": len(tokens), "tf": term_counts}
+
+
+def unindex_passage(index, key):
+    passage = index["passages"].pop(key)
+    for term in passage["tf"]:
+        remaining = index["df"].get(term, 0) - 1
+        if remaining > 0:
+            index["df"][term] = remaining
+        else:
+            index["df"].pop(term, None)
+    index["total_length"] = index["total_length"] - passage["length"]
+
+
+def index_source_versions(patient_id):
+    """
+    The profile plus the newest AI_INDEX_MAX_RECORDS encounters and lab tests
+    of the patient, newest first, keyed as in the index and mapped to "modified"
+    """
+    rows = db_sql(
+        """select 'profile' as kind, `name`, `modified`, 0 as `priority`, null as `record_date`
+            from `tabPatient` where `name` = %(patient)s
+        union all
+        select 'enc' as kind, `name`, `modified`, 1 as `priority`, `encounter_date` as `record_date`
+            from `tabPatient Encounter` where `patient` = %(patient)s and `docstatus` != 2
+        union all
+        select 'lab' as kind, `name`, `modified`, 1 as `priority`, coalesce(`result_date`, date(`creation`)) as `record_date`
+            from `tabLab Test` where `patient` = %(patient)s and `docstatus` != 2
+        order by `priority` asc, `record_date` desc
+        limit %(limit)s""",
+        {"patient": patient_id, "limit": AI_INDEX_MAX_RECORDS + 1},
+        as_dict=True
+    )
+    versions = {}
+    for row in rows:
+        key = "profile" if row.kind == "profile" else f"{row.kind}:{row.name}"
+        versions[key] = str(row.modified)
+    return versions
+
+
+def queue_patient_index_build(patient_id):
+    """Queue a build_patient_index job unless one is already queued for the patient"""
+    building_key = AI_INDEX_BUILDING_PREFIX + patient_id
+    if cache_get(building_key):
+        return
+    cache_set(building_key, True, AI_INDEX_JOB_TIMEOUT)
+    frappe.enqueue(
+        API_METHOD,
+        queue=AI_INDEX_QUEUE,
+        timeout=AI_INDEX_JOB_TIMEOUT,
+        query_type="build_patient_index",
+        parameters={"patient_id": patient_id}
+    )
+
+
+def load_patient_index(patient_id, max_updates=None):
+    """
+    The patient's retrieval index, updated incrementally: one query lists the
+    indexed records with their "modified"; only new or changed ones are loaded
+    (in batches of AI_INDEX_BATCH_SIZE, newest first) and re-tokenized, and
+    deleted ones dropped. Interactive callers pass max_updates: a missing index,
+    or one needing more updates than that, is left to a build_patient_index job
+    and the index is returned without them. Returns {"index", "updated", "pending"}.
+    """
+    cache_key = AI_INDEX_PREFIX + patient_id
+    index = cache_get(cache_key)
+    if not index and max_updates is not None:
+        queue_patient_index_build(patient_id)
+        return {"index": None, "updated": 0, "pending": True}
+    index = index or {"passages": {}, "df": {}, "total_length": 0}
+    
+    current = index_source_versions(patient_id)
+    stale = [key for key in index["passages"] if current.get(key) != index["passages"][key]["version"]]
+    for key in stale:
+        unindex_passage(index, key)
+    
+    missing = [key for key in current if key not in index["passages"]]
+    if max_updates is not None and len(missing) > max_updates:
+        queue_patient_index_build(patient_id)
+        return {"index": index, "updated": 0, "pending": True}
+    
+    if "profile" in missing:
+        patient = get_patient_doc(patient_id)
+        index_passage(index, "profile", current["profile"], "", profile_passage(patient))
+    encounter_names = [key[4:] for key in missing if key.startswith("enc:")]
+    lab_test_names = [key[4:] for key in missing if key.startswith("lab:")]
+    
+    for offset in range(0, len(encounter_names), AI_INDEX_BATCH_SIZE):
+        batch = encounter_names[offset:offset + AI_INDEX_BATCH_SIZE]
+        for encounter in load_docs_bulk("Patient Encounter", {"name": ["in", batch]}):
+            key = "enc:" + encounter.name
+            index_passage(index, key, current[key], str(encounter.encounter_date or ""),
+                          encounter_passage(encounter)[:AI_INDEX_PASSAGE_CHARS])
+    for offset in range(0, len(lab_test_names), AI_INDEX_BATCH_SIZE):
+        batch = lab_test_names[offset:offset + AI_INDEX_BATCH_SIZE]
+        for lab_test in load_docs_bulk("Lab Test", {"name": ["in", batch]}):
+            key = "lab:" + lab_test.name
+            index_passage(index, key, current[key], str(lab_test.result_date or lab_test.creation or "")[:10],
+                          lab_test_passage(lab_test)[:AI_INDEX_PASSAGE_CHARS])
+    
+    if stale or missing:
+        cache_set(cache_key, index, AI_INDEX_TTL)
+    return {"index": index, "updated": len(missing), "pending": False}
+
+
+def search_patient_index(index, query, top_k=AI_RETRIEVAL_TOP_K, token_budget=AI_RETRIEVAL_TOKEN_BUDGET):
+    """
+    BM25-ranked passages for the query within the token budget. A question
+    without indexed words (e.g. "anything new?") gets the most recent records.
+    """
+    passages = index["passages"]
+    count = len(passages)
+    if not count:
+        return []
+    average_length = (index["total_length"] / count) or 1
+    
+    weights = {}
+    for term in set(tokenize(query)):
+        df = index["df"].get(term)
+        if df:
+            weights[term] = natural_log(1 + (count - df + 0.5) / (df + 0.5))
+    
+    ranked = []
+    for key, passage in passages.items():
+        score = 0.0
+        for term, weight in weights.items():
+            tf = passage["tf"].get(term)
+            if tf:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * passage["length"] / average_length)
+                score = score + weight * tf * (BM25_K1 + 1) / (tf + norm)
+        if score > 0 or not weights:
+            ranked.append((score, passage["date"], key))
+    ranked = sorted(ranked, reverse=True)
+    
+    selected = []
+    used = 0
+    for score, date, key in ranked:
+        if len(selected) >= top_k:
+            break
+        tokens = estimate_tokens(passages[key]["text"])
+        if used + tokens > token_budget:
+            continue
+        selected.append({"key": key, "date": date, "score": round(score, 3), "text": passages[key]["text"]})
+        used = used + tokens
+    return selected
+
+
+# =============================================================================
+# APPOINTMENT PRE-ANALYSIS
+# =============================================================================
+
+def upcoming_appointment_patients(horizon_hours):
+    """Patients with an open appointment in the next horizon_hours, soonest first"""
+    now = frappe.utils.now_datetime()
+    horizon = frappe.utils.add_to_date(now, hours=horizon_hours)
+    appointments = db_get_all(
+        "Patient Appointment",
+        filters=[
+            ["appointment_date", ">=", now.date()],
+            ["appointment_date", "<=", horizon.date()],
+            ["status", "in", PREANALYSIS_APPOINTMENT_STATUSES]
+        ],
+        fields=["patient", "appointment_date", "appointment_time"],
+        order_by="appointment_date asc, appointment_time asc"
+    )
+    
+    patient_ids = []
+    for appointment in appointments:
+        starts_at = frappe.utils.get_datetime(
+            f"{appointment.appointment_date} {appointment.appointment_time or '00:00:00'}"
+        )
+        if now <= starts_at <= horizon and appointment.patient not in patient_ids:
+            patient_ids.append(appointment.patient)
+    return patient_ids[:PREANALYSIS_MAX_PATIENTS]
+
+
+def preanalyze_patient(patient_id):
+    """
+    Generate and store the initial-load overview of the patient's current
+    chart. Returns "fresh" if the stored one is still current, "skipped" if
+    another job is generating it, else "generated". The patient's retrieval
+    index is brought up to date as well, ready for the first follow-up.
+    """
+    loaded = load_patient_summary(patient_id)
+    if AI_CONTEXT_STRATEGY == "retrieval":
+        load_patient_index(patient_id)
+    stored = cache_get(PREANALYSIS_PREFIX + patient_id)
+    if stored and stored.get("context_version") == loaded["version"]:
+        return "fresh"
+    
+    running_key = PREANALYSIS_RUNNING_PREFIX + patient_id
+    if cache_get(running_key):
+        return "skipped"
+    cache_set(running_key, 1, AI_JOB_TIMEOUT)
+    
+    slot_id = None
+    try:
+        # The same prompt ai_query builds for an initial load in a new session
+        compaction = compact_patient_context(loaded["summary"], AI_CONTEXT_TOKEN_BUDGET, "")
+        context_hash = fingerprint_context(compaction["context"])["hash"]
+        chat_input = initial_load_chat_input(full_context_block(compaction["context"], context_hash))
+        
+        if AI_RATE_LIMIT_ENABLED:
+            slot_id = wait_for_webhook_slot(False, AI_JOB_SLOT_WAIT_SECONDS)
+            if not slot_id:
+                raise Exception("the AI assistant stayed busy, no webhook slot became free")
+        ai_response = call_rag_webhook(f"preanalysis_{patient_id}_{loaded['version']}", chat_input)
+    finally:
+        release_webhook_slot(slot_id)
+        cache_delete(running_key)
+    
+    cache_set(PREANALYSIS_PREFIX + patient_id, {
+        "context_version": loaded["version"],
+        "ai_response": ai_response,
+        "generated_at": str(frappe.utils.now_datetime())
+    }, PREANALYSIS_TTL)
+    return "generated"
+
+
+# =============================================================================
+# SEARCH PATIENTS
+# =============================================================================
+
+def handle_search_patients(parameters):
+    """Prefix search over patients with keyset (cursor) pagination"""
+    search_term = (parameters.get("search_term") or "").strip()
+    page_size = frappe.utils.cint(parameters.get("page_size") or parameters.get("limit")) or SEARCH_DEFAULT_PAGE_SIZE
+    page_size = min(max(page_size, 1), SEARCH_MAX_PAGE_SIZE)
+    
+    # Searching: alphabetical by name. Browsing: most recently modified first.
+    # Both orders end on the primary key so the keyset cursor is unambiguous.
+    sort_field = "patient_name" if search_term else "modified"
+    direction = "asc" if search_term else "desc"
+    comparison = ">" if search_term else "<"
+    
+    conditions = []
+    values = {}
+    
+    if search_term:
+        # Prefix (not %infix%) matching so each column can use its index
+        escaped = search_term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        values["prefix"] = f"{escaped}%"
+        conditions.append("(" + " or ".join(f"`{field}` like %(prefix)s" for field in SEARCH_MATCH_FIELDS) + ")")
+    
+    count_conditions = list(conditions)
+    
+    # Keyset pagination: continue strictly after the last row of the previous page
+    cursor = parameters.get("cursor")
+    if cursor:
+        try:
+            cursor_values = json.loads(cursor) if isinstance(cursor, str) else cursor
+            values["cursor_sort"] = cursor_values[0]
+            values["cursor_name"] = cursor_values[1]
+            conditions.append(
+                f"(`{sort_field}` {comparison} %(cursor_sort)s"
+                f" or (`{sort_field}` = %(cursor_sort)s and `name` {comparison} %(cursor_name)s))"
+            )
+        except Exception:
+            frappe.throw("Invalid search cursor")
+    
+    where_clause = f"where {' and '.join(conditions)}" if conditions else ""
+    rows = db_sql(
+        f"""select `name`, `patient_name`, `mobile`, `email`, `sex` as gender, `dob`, `blood_group`,
+            `{sort_field}` as sort_key
+        from `tabPatient`
+        {where_clause}
+        order by `{sort_field}` {direction}, `name` {direction}
+        limit {page_size + 1}""",
+        values,
+        as_dict=True
+    )
+    
+    # One extra row tells us whether another page exists without a COUNT(*)
+    has_more = len(rows) > page_size
+    patients = rows[:page_size]
+    next_cursor = None
+    if has_more and patients:
+        next_cursor = to_compact_json([str(patients[-1].sort_key), patients[-1].name])
+    for patient in patients:
+        patient.pop("sort_key", None)
+    
+    data = {
+        "results": patients,
+        "count": len(patients),
+        "has_more": has_more,
+        "next_cursor": next_cursor
+    }
+    
+    # Exact totals cost a full index range count - only when asked for
+    if parameters.get("with_total"):
+        count_where = f"where {' and '.join(count_conditions)}" if count_conditions else ""
+        data["total"] = db_sql(
+            f"select count(*) from `tabPatient` {count_where}",
+            values
+        )[0][0]
+    
+    return {
+        "status": "success",
+        "query_type": "search_patients",
+        "data": data
+    }
+
+
+# =============================================================================
+# GET PATIENT SUMMARY
+# =============================================================================
+
+def handle_get_patient_summary(parameters):
+    """Full patient summary, served from the patient cache when possible"""
+    patient_id = parameters.get("patient_id")
+    
+    if not patient_id:
+        frappe.throw("patient_id is required")
+    
+    loaded = load_patient_summary(patient_id, refresh=parameters.get("refresh"))
+    
+    # Conditional fetch: a client that already holds this exact summary gets a
+    # marker instead of the chart. The ETag hashes the whole summary, so unlike
+    # context_version it also moves when only the date-derived parts do.
+    if parameters.get("etag") and parameters.get("etag") == loaded["etag"]:
+        return {
+            "status": "success",
+            "query_type": "get_patient_summary",
+            "unchanged": True,
+            "cached": loaded["cached"],
+            "context_version": loaded["version"],
+            "etag": loaded["etag"]
+        }
+    
+    return {
+        "status": "success",
+        "query_type": "get_patient_summary",
+        "cached": loaded["cached"],
+        "context_version": loaded["version"],
+        "etag": loaded["etag"],
+        "data": loaded["summary"]
+    }
+
+
+# =============================================================================
+# CACHE STATS
+# =============================================================================
+
+def handle_get_cache_stats(parameters):
+    """Patient summary cache hit/miss counters"""
+    stats = cache_get(CACHE_STATS_KEY) or {"hits": 0, "misses": 0}
+    lookups = stats.get("hits", 0) + stats.get("misses", 0)
+    
+    return {
+        "status": "success",
+        "query_type": "get_cache_stats",
+        "data": {
+            "hits": stats.get("hits", 0),
+            "misses": stats.get("misses", 0),
+            "hit_ratio": round(stats.get("hits", 0) / lookups, 4) if lookups else None,
+            "ttl_seconds": PATIENT_CACHE_TTL
+        }
+    }
+
+
+# =============================================================================
+# GET PATIENT DETAILS
+# =============================================================================
+
+def handle_get_patient_details(parameters):
+    """Basic demographics for one patient"""
+    patient_id = parameters.get("patient_id")
+    
+    if not patient_id:
+        frappe.throw("patient_id is required")
+    
+    patient = get_patient_doc(patient_id)
+    
+    # Build patient data safely without hasattr/getattr
+    patient_info = {"name": patient.name, "patient_name": patient.patient_name}
+    
+    try:
+        patient_info["mobile"] = patient.mobile
+    except:
+        patient_info["mobile"] = None
+    
+    try:
+        patient_info["email"] = patient.email
+    except:
+        patient_info["email"] = None
+    
+    try:
+        patient_info["gender"] = patient.sex
+    except:
+        patient_info["gender"] = None
+    
+    try:
+        patient_info["blood_group"] = patient.blood_group
+    except:
+        patient_info["blood_group"] = None
+    
+    try:
+        patient_info["age"] = patient.age_html
+    except:
+        patient_info["age"] = None
+    
+    try:
+        patient_info["dob"] = str(patient.dob) if patient.dob else None
+    except:
+        patient_info["dob"] = None
+    
+    return {
+        "status": "success",
+        "query_type": "get_patient_details",
+        "data": patient_info
+    }
+
+
+# =============================================================================
+# ANALYZE PATIENT HISTORY
+# =============================================================================
+
+def handle_analyze_patient_history(parameters):
+    """Visit-frequency profile built from grouped SQL aggregates"""
+    patient_id = parameters.get("patient_id")
+    
+    if not patient_id:
+        frappe.throw("patient_id is required")
+    
+    patient_name = db_get_value("Patient", patient_id, "patient_name")
+    if patient_name is None:
+        frappe.throw(f"Patient {patient_id} not found", frappe.DoesNotExistError)
+    
+    values = {
+        "patient": patient_id,
+        "recent_since": str(frappe.utils.add_days(frappe.utils.nowdate(), -365))
+    }
+    
+    # Query 1: visits per month - totals, first/last visit and yearly counts are
+    # derived from these rows
+    months = db_sql(
+        """select date_format(`encounter_date`, '%%Y-%%m') as period,
+            count(*) as visits,
+            min(`encounter_date`) as first_visit,
+            max(`encounter_date`) as last_visit,
+            sum(case when `encounter_date` >= %(recent_since)s then 1 else 0 end) as recent_visits
+        from `tabPatient Encounter`
+        where `patient` = %(patient)s and `docstatus` = 1
+        group by period
+        order by period""",
+        values,
+        as_dict=True
+    )
+    
+    # Query 2: practitioner, diagnosis and medication counts in one round trip
+    ranked = db_sql(
+        """select 'practitioner' as kind, `practitioner` as label,
+                count(*) as occurrences, max(`encounter_date`) as last_seen
+            from `tabPatient Encounter`
+            where `patient` = %(patient)s and `docstatus` = 1
+            group by `practitioner`
+        union all
+        select 'diagnosis' as kind, d.`diagnosis` as label,
+                count(*) as occurrences, max(e.`encounter_date`) as last_seen
+            from `tabPatient Encounter Diagnosis` d
+            join `tabPatient Encounter` e on e.`name` = d.`parent`
+            where e.`patient` = %(patient)s and e.`docstatus` = 1
+                and d.`parenttype` = 'Patient Encounter'
+            group by d.`diagnosis`
+        union all
+        select 'medication' as kind, coalesce(dp.`drug_name`, dp.`drug_code`) as label,
+                count(*) as occurrences, max(e.`encounter_date`) as last_seen
+            from `tabDrug Prescription` dp
+            join `tabPatient Encounter` e on e.`name` = dp.`parent`
+            where e.`patient` = %(patient)s and e.`docstatus` = 1
+                and dp.`parenttype` = 'Patient Encounter'
+            group by coalesce(dp.`drug_name`, dp.`drug_code`)""",
+        values,
+        as_dict=True
+    )
+    
+    total_visits = sum(row.visits for row in months)
+    first_visit = min([row.first_visit for row in months]) if months else None
+    last_visit = max([row.last_visit for row in months]) if months else None
+    
+    visits_by_year = {}
+    for row in months:
+        year = row.period[:4]
+        visits_by_year[year] = visits_by_year.get(year, 0) + row.visits
+    
+    span_days = frappe.utils.date_diff(last_visit, first_visit) if months else 0
+    
+    # Most frequent first, most recent breaks ties
+    ranked = sorted(ranked, key=lambda row: (row.occurrences, str(row.last_seen)), reverse=True)
+    
+    top = {"practitioner": [], "diagnosis": [], "medication": []}
+    distinct_practitioners = 0
+    for row in ranked:
+        if not row.label:
+            continue
+        if row.kind == "practitioner":
+            distinct_practitioners = distinct_practitioners + 1
+        if len(top[row.kind]) < HISTORY_TOP_LIMIT:
+            top[row.kind].append({
+                row.kind: row.label,
+                "count": row.occurrences,
+                "last_seen": str(row.last_seen) if row.last_seen else None
+            })
+    
+    return {
+        "status": "success",
+        "query_type": "analyze_patient_history",
+        "data": {
+            "patient_profile": {
+                "name": patient_id,
+                "patient_name": patient_name,
+            },
+            "visit_frequency": {
+                "total_visits": total_visits,
+                "first_visit": str(first_visit) if first_visit else None,
+                "last_visit": str(last_visit) if last_visit else None,
+                "span_days": span_days,
+                "average_days_between_visits": round(span_days / (total_visits - 1), 1) if total_visits > 1 else None,
+                "visits_last_12_months": sum(frappe.utils.cint(row.recent_visits) for row in months),
+                "active_months": len(months),
+                "distinct_practitioners": distinct_practitioners,
+                "by_year": [{"year": year, "visits": visits_by_year[year]} for year in sorted(visits_by_year)],
+                "by_month": [{"period": row.period, "visits": row.visits} for row in months]
+            },
+            "top_practitioners": top["practitioner"],
+            "top_diagnoses": top["diagnosis"],
+            "top_medications": top["medication"]
+        }
+    }
+
+
+# =============================================================================
+# GET ACTIVE PRESCRIPTIONS
+# =============================================================================
+
+def handle_get_active_prescriptions(parameters):
+    """Medications from the last 90 days, one entry per drug"""
+    patient_id = parameters.get("patient_id")
+    
+    if not patient_id:
+        frappe.throw("patient_id is required")
+    
+    prescriptions = load_recent_prescriptions(patient_id)
+    
+    return {
+        "status": "success",
+        "query_type": "get_active_prescriptions",
+        "data": {
+            "active_prescriptions": prescriptions,
+            "count": len(prescriptions),
+            "still_active_count": len([p for p in prescriptions if p["still_active"]])
+        }
+    }
+
+
+# =============================================================================
+# GET LAB TESTS
+# =============================================================================
+
+def handle_get_lab_tests(parameters):
+    """Most recent lab tests for one patient"""
+    patient_id = parameters.get("patient_id")
+    
+    if not patient_id:
+        frappe.throw("patient_id is required")
+    
+    since = parameters.get("since")
+    
+    # Cancelled lab tests are listed too, so a cancellation is just a change
+    lab_tests = db_get_all(
+        "Lab Test",
+        filters=sync_filters(patient_id, since, exclude_cancelled=False),
+        fields=["name", "lab_test_name", "status", "result_date", "creation", "modified"],
+        order_by="creation desc",
+        limit=20
+    )
+    
+    return {
+        "status": "success",
+        "query_type": "get_lab_tests",
+        "data": sync_list_data("lab_tests", lab_tests, since, exclude_cancelled=False, bookkeeping_fields=["modified"])
+    }
+
+
+# =============================================================================
+# GET VITAL SIGNS HISTORY
+# =============================================================================
+
+def handle_get_vital_signs_history(parameters):
+    """Most recent vital signs for one patient, or window statistics in trend mode"""
+    patient_id = parameters.get("patient_id")
+    
+    if not patient_id:
+        frappe.throw("patient_id is required")
+    
+    # Trend mode: statistics and a downsampled series over a time window
+    if parameters.get("mode") == "trend":
+        days = frappe.utils.cint(parameters.get("days")) or VITALS_TREND_DAYS
+        points = frappe.utils.cint(parameters.get("points")) or VITALS_TREND_POINTS
+        return {
+            "status": "success",
+            "query_type": "get_vital_signs_history",
+            "data": build_vital_trends(
+                patient_id,
+                days=min(max(days, 1), VITALS_TREND_MAX_DAYS),
+                points=min(max(points, 2), VITALS_TREND_MAX_POINTS)
+            )
+        }
+    
+    since = parameters.get("since")
+    vitals = db_get_all(
+        "Vital Signs",
+        filters=sync_filters(patient_id, since),
+        fields=[
+            "name", "signs_date", "signs_time",
+            "temperature", "pulse", "respiratory_rate",
+            "bp_systolic", "bp_diastolic", "spo2", "modified"
+        ] + (["docstatus"] if since else []),
+        order_by="signs_date desc",
+            limit=20
+        )
+    
+    return {
+        "status": "success",
+        "query_type": "get_vital_signs_history",
+        "data": sync_list_data("vital_signs", vitals, since, bookkeeping_fields=["modified", "docstatus"])
+    }
+
+
+# =============================================================================
+# GET PATIENT ENCOUNTERS
+# =============================================================================
+
+def handle_get_patient_encounters(parameters):
+    """Most recent encounters with all child tables"""
+    patient_id = parameters.get("patient_id")
+    
+    if not patient_id:
+        frappe.throw("patient_id is required")
+    
+    since = parameters.get("since")
+    
+    # Get ALL encounter data as raw dicts (including all child tables) - NO TRANSFORMATION
+    # Bulk-loaded: one query for the encounters + one per child table
+    encounters = load_docs_bulk(
+        "Patient Encounter",
+        filters=sync_filters(patient_id, since),
+        order_by="encounter_date desc",
+        limit=10
+    )
+    
+    return {
+            "status": "success",
+        "query_type": "get_patient_encounters",
+        "data": sync_list_data("encounters", encounters, since)
+    }
+
+
+# =============================================================================
+# QUERY HANDLER REGISTRY
+# =============================================================================
+
+# Read-only query types. Each handler takes `parameters` and returns the
+# response dict. These are the only query types a batch may contain.
+QUERY_HANDLERS = {
+    "search_patients": handle_search_patients,
+    "get_patient_summary": handle_get_patient_summary,
+    "get_cache_stats": handle_get_cache_stats,
+    "get_patient_details": handle_get_patient_details,
+    "analyze_patient_history": handle_analyze_patient_history,
+    "get_active_prescriptions": handle_get_active_prescriptions,
+    "get_lab_tests": handle_get_lab_tests,
+    "get_vital_signs_history": handle_get_vital_signs_history,
+    "get_patient_encounters": handle_get_patient_encounters
+}
+
 
 # =============================================================================
 # MAIN ENTRY POINT
@@ -67,148 +3030,343 @@ if query_type == "ai_query":
     file_name = parameters.get("file_name")
     file_type = parameters.get("file_type")
     
+    # Server-held context: clients send just patient_id (plus the context_version
+    # of the summary they display) and the chart comes from the patient cache or
+    # a fresh bulk load, so requests stay small however large the chart is.
+    # An uploaded patient_context is still accepted for older clients.
+    context_version = None
+    stale_context = False
+    if not patient_context and patient_id and user_query:
+        loaded = load_patient_summary(patient_id)
+        patient_context = loaded["summary"]
+        context_version = loaded["version"]
+        client_version = parameters.get("context_version")
+        stale_context = bool(client_version) and client_version != context_version
+    
+    # Overview generated ahead of the appointment (see PREANALYSIS_PREFIX) for
+    # exactly this version of the chart
+    preanalysis = None
+    if is_initial_load and context_version and not file_url and not parameters.get("refresh"):
+        preanalysis = cache_get(PREANALYSIS_PREFIX + patient_id)
+        if preanalysis and preanalysis.get("context_version") != context_version:
+            preanalysis = None
+    
     if not user_query:
         frappe.response.update({
             "status": "error",
             "message": "user_query is required for AI queries"
         })
+    elif stale_context:
+        # The doctor would be asking about data they are not looking at
+        frappe.response.update({
+            "status": "error",
+            "code": "stale_context",
+            "message": "Patient data has changed since it was loaded. Reload the patient and ask again.",
+            "data": {"context_version": context_version}
+        })
     elif not patient_context or not patient_context.get("patient"):
         frappe.response.update({
             "status": "error",
-            "message": "patient_context is required for AI queries"
+            "message": "patient_id or patient_context is required for AI queries"
+        })
+    elif preanalysis:
+        remember_session_overview(session_id or f"patient_{patient_id}", preanalysis.get("ai_response"))
+        frappe.response.update({
+            "status": "success",
+            "query_type": query_type,
+            "data": {
+                "ai_response": preanalysis.get("ai_response"),
+                "user_query": user_query,
+                "patient_id": patient_id,
+                "model_used": "RAG (n8n)",
+                "precomputed": True,
+                "generated_at": preanalysis.get("generated_at"),
+                "context_version": context_version
+            }
         })
     else:
         try:
-            # Send COMPLETE raw patient data JSON to LLM - NO TRANSFORMATION
-            # Use simple JSON serialization - data comes from frontend already as clean JSON
-            try:
-                patient_data_json = json.dumps(patient_context, indent=2, default=str)
-            except:
-                # Fallback: convert to string if JSON serialization fails
-                patient_data_json = str(patient_context)
+            # Use session ID from frontend (generated with timestamp when patient is selected)
+            # Fallback to patient_id-based session if not provided (for backward compatibility)
+            if not session_id:
+                session_id = f"patient_{patient_id}"
             
-            # Build chat input for RAG webhook with FULL raw JSON
-            if is_initial_load:
-                chat_input = f"""I've just opened this patient's medical record. Please analyze their complete profile and provide:
-
-COMPLETE PATIENT DATA (RAW JSON):
-{patient_data_json}
-
-Please provide:
-1. A brief overview of the patient
-2. Key alerts or concerns (allergies, chronic conditions)
-3. Important points from their medical history
-4. Any recommendations for the doctor's attention
+            # Retrieval: follow-up questions get the core of the chart here and
+            # the records relevant to the question from the patient index below
+            context_strategy = parameters.get("context_strategy") or AI_CONTEXT_STRATEGY
+            use_retrieval = context_strategy == "retrieval" and bool(patient_id) and not is_initial_load
+            if use_retrieval:
+                patient_context = {k: v for k, v in patient_context.items() if k in AI_RETRIEVAL_CORE_SECTIONS}
+            else:
+                # Have the index ready by the first follow-up question
+                if context_strategy == "retrieval" and patient_id and not cache_get(AI_INDEX_PREFIX + patient_id):
+                    queue_patient_index_build(patient_id)
+                context_strategy = "full"
+            
+            # Compact the context (metadata, empties, repeats, budget) before it
+            # reaches the prompt so its size is bounded regardless of history
+            token_budget = frappe.utils.cint(parameters.get("token_budget")) or AI_CONTEXT_TOKEN_BUDGET
+            started = frappe.utils.now_datetime()
+            compaction = compact_patient_context(patient_context, token_budget, user_query)
+            patient_context = compaction["context"]
+            record_phase("compaction", started)
+            started = frappe.utils.now_datetime()
+            
+            # Session-aware context: send the COMPLETE patient JSON (compact, no
+            # indentation) once per session; later turns only send what changed
+            session_key = AI_SESSION_PREFIX + session_id
+            fingerprint = fingerprint_context(patient_context)
+            context_hash = fingerprint["hash"]
+            
+            previous = None
+            if AI_SESSION_CONTEXT_DEDUP and not parameters.get("resend_context"):
+                previous = cache_get(session_key)
+            if previous and compaction["omitted_names"]:
+                fingerprint = carry_omitted_records(fingerprint, previous, compaction["omitted_names"])
+                context_hash = fingerprint["hash"]
+            
+            # What the session will have seen after this turn. A retrieval turn
+            # only covers the core sections, so compare and record just those.
+            session_fingerprint = fingerprint
+            if use_retrieval:
+                session_fingerprint = merge_fingerprints(previous, fingerprint)
+                if previous:
+                    previous = restrict_fingerprint(previous, AI_RETRIEVAL_CORE_SECTIONS)
+            
+            if not previous:
+                context_mode = "full"
+                context_block = full_context_block(patient_context, context_hash)
+            elif previous.get("hash") == context_hash:
+                context_mode = "unchanged"
+                context_block = f"PATIENT DATA: unchanged since it was shared earlier in this conversation (context hash {context_hash})."
+            else:
+                context_mode = "delta"
+                context_block = f"""PATIENT DATA UPDATE (only what changed since it was shared earlier in this conversation, new context hash {context_hash}):
+{to_compact_json(build_context_delta(patient_context, fingerprint, previous))}"""
+            
+            retrieval = None
+            if use_retrieval:
+                retrieval_started = frappe.utils.now_datetime()
+                # Never builds a whole index here: until the queued job has
+                # built it the turn goes out with the core sections only
+                loaded_index = load_patient_index(patient_id, AI_INDEX_INLINE_UPDATES)
+                passages = []
+                indexed = 0
+                if loaded_index["index"]:
+                    passages = search_patient_index(loaded_index["index"], user_query)
+                    indexed = len(loaded_index["index"]["passages"])
+                record_phase("retrieval", retrieval_started)
+                records = "\n".join(f"- [{p['date'] or p['key']}] {p['text']}" for p in passages)
+                retrieval = {
+                    "passages": len(passages),
+                    "indexed": indexed,
+                    "reindexed": loaded_index["updated"],
+                    "index_pending": loaded_index["pending"],
+                    "hash": stable_hash(records)
+                }
+                if passages:
+                    context_block = f"""{context_block}
 
-Keep it concise and actionable."""
+RELEVANT RECORDS (the {len(passages)} of {indexed} records in the chart most relevant to this question):
+{records}"""
+            
+            # Build chat input for RAG webhook
+            if is_initial_load:
+                chat_input = initial_load_chat_input(context_block)
             else:
-                chat_input = f"""COMPLETE PATIENT DATA (RAW JSON):
-{patient_data_json}
+                chat_input = f"""{context_block}
 
 DOCTOR'S QUESTION:
 {user_query}
 
-Provide a helpful medical response based on the complete patient data above. Analyze all encounter details, symptoms, diagnosis, medications, lab tests, and procedures."""
+Provide a helpful medical response based on the complete patient data shared in this conversation. Analyze all encounter details, symptoms, diagnosis, medications, lab tests, and procedures."""
             
-            # Add file information to chat input if provided
+            # Add the uploaded file (its text, or its URL) to chat input if provided
             if file_url:
-                # Build full public URL if relative
-                if file_url.startswith('/'):
-                    frappe_base = frappe.utils.get_url()  # noqa: F821
-                    full_file_url = f"{frappe_base}{file_url}"
-                else:
-                    full_file_url = file_url
-                
-                # Determine file type for context
-                file_type_info = ""
-                if file_type:
-                    file_type_info = f" (type: {file_type})"
-                elif file_name:
-                    ext = file_name.split('.')[-1].lower()
-                    if ext in ['jpg', 'jpeg', 'png', 'gif', 'webp']:
-                        file_type_info = " (image)"
-                    elif ext == 'pdf':
-                        file_type_info = " (PDF document)"
-                    elif ext in ['doc', 'docx']:
-                        file_type_info = " (Word document)"
-                    elif ext == 'txt':
-                        file_type_info = " (text file)"
-                    elif ext in ['xls', 'xlsx']:
-                        file_type_info = " (Excel file)"
-                    else:
-                        file_type_info = " (file)"
-                
-                # Add file reference to chat input
-                file_context = f"""
-
-IMPORTANT: A file has been uploaded for analysis:
-- File Name: {file_name or 'Uploaded file'}{file_type_info}
-- File URL: {full_file_url}
+                chat_input = f"{chat_input}{build_file_context(file_url, file_name, file_type, user_query)}"
+            
+            # An overview this session was shown without n8n producing it here
+            seed_key = None
+            if not is_initial_load:
+                seed = cache_get(AI_SESSION_SEED_PREFIX + session_id)
+                if seed:
+                    seed_key = AI_SESSION_SEED_PREFIX + session_id
+                    chat_input = f"""EARLIER IN THIS CONVERSATION you gave the doctor this overview of the patient:
+{seed}
 
-Please analyze this file in the context of the patient's medical data."""
-                chat_input = f"{chat_input}{file_context}"
+{chat_input}"""
+            record_phase("prompt_build", started)
             
-            # Use session ID from frontend (generated with timestamp when patient is selected)
-            # Fallback to patient_id-based session if not provided (for backward compatibility)
-            if not session_id:
-                session_id = f"patient_{patient_id}"
+            # Background mode: hand the webhook call to a worker and return a job ID
+            # right away instead of pinning this web worker for the LLM latency
+            background = bool(parameters.get("background"))
             
-            # Call n8n RAG webhook
-            webhook_response = frappe.make_post_request(
-                N8N_WEBHOOK_URL,
-                headers={
-                    "Content-Type": "application/json"
-                },
-                data=json.dumps({
-                    "sessionId": session_id,
-                    "chatInput": chat_input
-                })
+            # Identical requests share one LLM call (see AI_MEMO_PREFIX). With
+            # retrieval the records pulled from the index are part of the prompt.
+            request_context_hash = context_hash
+            if retrieval:
+                request_context_hash = stable_hash(context_hash + "|" + retrieval["hash"])
+            request_key = ai_request_key(
+                frappe.session.user, session_id, patient_id, user_query,
+                request_context_hash, file_url, is_initial_load
             )
+            memo_key = AI_MEMO_PREFIX + request_key
+            inflight_key = AI_INFLIGHT_PREFIX + request_key
+            memo_ttl = AI_INITIAL_MEMO_TTL if is_initial_load else AI_MEMO_TTL
             
-            # Parse webhook response
-            if isinstance(webhook_response, str):
-                webhook_response = json.loads(webhook_response)
-            
-            # Extract AI response from webhook
-            # Expected format: {"output": "AI response text"}
-            ai_response = None
-            if isinstance(webhook_response, dict):
-                if "output" in webhook_response:
-                    ai_response = webhook_response["output"]
-                elif "message" in webhook_response:
-                    # Handle alternative response format
-                    ai_response = webhook_response["message"]
-                elif "response" in webhook_response:
-                    ai_response = webhook_response["response"]
-                else:
-                    # If response structure is unexpected, try to get any text field
-                    for key in ["text", "content", "result", "data"]:
-                        if key in webhook_response:
-                            value = webhook_response[key]
-                            if isinstance(value, str):
-                                ai_response = value
-                                break
-                            elif isinstance(value, dict) and "text" in value:
-                                ai_response = value["text"]
-                                break
+            memoized = None
+            inflight = None
+            if not parameters.get("refresh"):
+                memoized = cache_get(memo_key)
+                inflight = None if memoized else cache_get(inflight_key)
+            coalesced = bool(inflight and inflight.get("job_id"))
+            duplicate_pending = bool(inflight and not coalesced and not background and not memoized)
             
-            # If still no response, use the whole response as string
-            if not ai_response:
-                if isinstance(webhook_response, str):
-                    ai_response = webhook_response
-                else:
-                    ai_response = json.dumps(webhook_response)
+            # Admission control (see AI_RATE_LIMITS): only requests that will
+            # reach the webhook are charged. Background jobs take their webhook
+            # slot in the worker.
+            rate_retry_after = 0
+            slot_id = None
+            if AI_RATE_LIMIT_ENABLED and not memoized and not coalesced and not duplicate_pending:
+                rate_retry_after = take_rate_tokens(session_id)
+                if not rate_retry_after and not background:
+                    # A web request does not sit on its worker waiting for a slot: a
+                    # miss is a 429 and the client retries after AI_SLOT_RETRY_AFTER
+                    slot_id = acquire_webhook_slot(not is_initial_load)
             
-            frappe.response.update({
-                "status": "success",
-                "query_type": query_type,
-                "data": {
-                    "ai_response": ai_response,
-                    "user_query": user_query,
+            if memoized:
+                if is_initial_load:
+                    # Likely generated in another session (the memo is keyed on the chart)
+                    remember_session_overview(session_id, memoized.get("ai_response"))
+                frappe.response.update({
+                    "status": "success",
+                    "query_type": query_type,
+                    "data": {
+                        "ai_response": memoized.get("ai_response"),
+                        "user_query": user_query,
+                        "patient_id": patient_id,
+                        "model_used": "RAG (n8n)",
+                        "memoized": True,
+                        "context_hash": context_hash,
+                        "context_version": context_version
+                    }
+                })
+            elif coalesced:
+                # Attach to the identical job that is already queued or running
+                frappe.response.update({
+                    "status": "queued",
+                    "query_type": query_type,
+                    "data": {
+                        "job_id": inflight.get("job_id"),
+                        "coalesced": True,
+                        "poll_query_type": "ai_query_status",
+                        "realtime_event": AI_JOB_REALTIME_EVENT
+                    }
+                })
+            elif duplicate_pending:
+                # The identical call is still running: rather than hold this web
+                # worker, let the client ask again and pick up the memoised answer
+                frappe.response.update({
+                    "status": "pending",
+                    "query_type": query_type,
+                    "code": "duplicate_in_flight",
+                    "retry_after": AI_COALESCE_RETRY_AFTER,
+                    "data": {"coalesced": True}
+                })
+            elif rate_retry_after:
+                reject_rate_limited(
+                    query_type,
+                    f"Too many AI requests. Please wait {rate_retry_after}s and try again.",
+                    rate_retry_after
+                )
+            elif AI_RATE_LIMIT_ENABLED and not background and not slot_id:
+                # Nothing reached the webhook: the retry must not find the buckets drained
+                refund_rate_tokens(session_id)
+                reject_rate_limited(
+                    query_type,
+                    f"The AI assistant is busy. Please try again in {AI_SLOT_RETRY_AFTER}s.",
+                    AI_SLOT_RETRY_AFTER
+                )
+            elif background:
+                # Don't queue work the breaker would reject anyway - nor
+                # charge for it
+                if AI_RATE_LIMIT_ENABLED and rag_breaker_retry_after():
+                    refund_rate_tokens(session_id)
+                ensure_rag_circuit_closed()
+                
+                job_id = stable_hash(f"{session_id}|{user_query}|{frappe.utils.now_datetime()}")
+                cache_set(AI_JOB_PREFIX + job_id, {
+                    "status": "queued",
+                    "user": frappe.session.user,
                     "patient_id": patient_id,
-                    "model_used": "RAG (n8n)"
-                }
-            })
+                    "user_query": user_query,
+                    "context_mode": context_mode,
+                    "context_strategy": context_strategy,
+                    "retrieval": retrieval,
+                    "context_hash": context_hash,
+                    "context_size": compaction["report"],
+                    "context_version": context_version
+                }, AI_JOB_TTL)
+                cache_set(inflight_key, {"job_id": job_id}, AI_JOB_TIMEOUT)
+                
+                frappe.enqueue(
+                    API_METHOD,
+                    queue=AI_JOB_QUEUE,
+                    timeout=AI_JOB_TIMEOUT,
+                    query_type="ai_query_job",
+                    parameters={
+                        "job_id": job_id,
+                        "session_id": session_id,
+                        "chat_input": chat_input,
+                        "fingerprint": session_fingerprint,
+                        "interactive": not is_initial_load,
+                        "memo_key": memo_key,
+                        "memo_ttl": memo_ttl,
+                        "inflight_key": inflight_key,
+                        "seed_key": seed_key
+                    }
+                )
+                
+                frappe.response.update({
+                    "status": "queued",
+                    "query_type": query_type,
+                    "data": {
+                        "job_id": job_id,
+                        "poll_query_type": "ai_query_status",
+                        "realtime_event": AI_JOB_REALTIME_EVENT
+                    }
+                })
+            else:
+                cache_set(inflight_key, {"job_id": None}, AI_JOB_TIMEOUT)
+                try:
+                    ai_response = call_rag_webhook(session_id, chat_input, charged=AI_RATE_LIMIT_ENABLED)
+                finally:
+                    cache_delete(inflight_key)
+                    release_webhook_slot(slot_id)
+                cache_set(memo_key, {"ai_response": ai_response}, memo_ttl)
+                
+                # The LLM has now seen this version of the chart (and any seed) in this session
+                if AI_SESSION_CONTEXT_DEDUP:
+                    cache_set(session_key, session_fingerprint, AI_SESSION_TTL)
+                if seed_key:
+                    cache_delete(seed_key)
+                
+                frappe.response.update({
+                    "status": "success",
+                    "query_type": query_type,
+                    "data": {
+                        "ai_response": ai_response,
+                        "user_query": user_query,
+                        "patient_id": patient_id,
+                        "model_used": "RAG (n8n)",
+                        "context_mode": context_mode,
+                        "context_strategy": context_strategy,
+                        "retrieval": retrieval,
+                        "context_hash": context_hash,
+                        "context_size": compaction["report"],
+                        "context_version": context_version
+                    }
+                })
             
         except Exception as e:
             # Log the error for debugging
@@ -219,370 +3377,444 @@ Please analyze this file in the context of the patient's medical data."""
             frappe.response.update({
                 "status": "error",
                 "message": f"RAG processing failed: {str(e)}",
-                "fallback_message": "AI assistant temporarily unavailable. Please try again."
+                "fallback_message": AI_FALLBACK_MESSAGE
             })
 
 # =============================================================================
-# SEARCH PATIENTS
+# AI QUERY BACKGROUND JOB
 # =============================================================================
 
-elif query_type == "search_patients":
-    search_term = parameters.get("search_term", "")
-    limit = parameters.get("limit", 5000)  # Default to high limit to load all patients
+elif query_type == "ai_query_job":
+    # Worker half of ai_query background mode - enqueued above via frappe.enqueue,
+    # which re-runs this script in an RQ worker (where there is no HTTP request)
+    job_id = parameters.get("job_id")
+    session_id = parameters.get("session_id")
     
-    filters = []
-    if search_term:
-        filters.append(["patient_name", "like", f"%{search_term}%"])
+    if frappe.request:
+        fail_request(query_type, "ai_query_job can only run as a background job")
     
-    patients = frappe.get_all(
-        "Patient",
-        filters=filters,
-        fields=["name", "patient_name", "mobile", "email", "sex as gender", "dob", "blood_group"],
-        order_by="modified desc",
-        limit=limit
-    )
+    job_key = AI_JOB_PREFIX + job_id
+    job = cache_get(job_key) or {}
+    job["status"] = "running"
+    cache_set(job_key, job, AI_JOB_TTL)
     
-    frappe.response.update({
-        "status": "success",
-        "query_type": query_type,
-        "data": {
-            "results": patients,
-            "count": len(patients)
-        }
-    })
+    slot_id = None
+    try:
+        if AI_RATE_LIMIT_ENABLED:
+            slot_id = wait_for_webhook_slot(parameters.get("interactive"), AI_JOB_SLOT_WAIT_SECONDS)
+            if not slot_id:
+                # The job runs as the requesting user, so these are their buckets
+                refund_rate_tokens(session_id)
+                raise Exception("the AI assistant is busy, please try again shortly")
+        job["ai_response"] = call_rag_webhook(
+            session_id,
+            parameters.get("chat_input"),
+            charged=AI_RATE_LIMIT_ENABLED
+        )
+        job["status"] = "success"
+        
+        # Later identical requests are answered from the memo
+        if parameters.get("memo_key"):
+            cache_set(
+                parameters.get("memo_key"),
+                {"ai_response": job["ai_response"]},
+                parameters.get("memo_ttl") or AI_MEMO_TTL
+            )
+        
+        # The LLM has now seen this version of the chart (and any seed) in this session
+        if AI_SESSION_CONTEXT_DEDUP and parameters.get("fingerprint"):
+            cache_set(AI_SESSION_PREFIX + session_id, parameters.get("fingerprint"), AI_SESSION_TTL)
+        if parameters.get("seed_key"):
+            cache_delete(parameters.get("seed_key"))
+    except Exception as e:
+        frappe.log_error(
+            title="MediWise AI Bot - RAG Processing Error",
+            message=f"Error: {str(e)}\nPatient ID: {job.get('patient_id')}\nQuery: {job.get('user_query')}\nJob: {job_id}"
+        )
+        job["status"] = "error"
+        job["message"] = f"RAG processing failed: {str(e)}"
+    release_webhook_slot(slot_id)
+    
+    cache_set(job_key, job, AI_JOB_TTL)
+    if parameters.get("inflight_key"):
+        cache_delete(parameters.get("inflight_key"))
+    
+    # Push completion to the requesting user's browser; polling still works without it
+    publish_ai_event(AI_JOB_REALTIME_EVENT, {"job_id": job_id, "status": job["status"]}, job.get("user"))
+    
+    frappe.response.update({"status": job["status"], "query_type": query_type, "data": {"job_id": job_id}})
 
 # =============================================================================
-# GET PATIENT SUMMARY
+# AI QUERY STATUS
 # =============================================================================
 
-elif query_type == "get_patient_summary":
-    patient_id = parameters.get("patient_id")
-    
-    if not patient_id:
-        frappe.throw("patient_id is required")
-    
-    # Get patient - get ALL fields as raw dict
-    patient = frappe.get_doc("Patient", patient_id)
-    patient_data = patient.as_dict()
-    
-    # Get encounter names first
-    encounter_names = frappe.get_all(
-        "Patient Encounter",
-        filters={"patient": patient_id, "docstatus": ["!=", 2]},
-        fields=["name"],
-        order_by="encounter_date desc",
-        limit=5
-    )
-    
-    # Get ALL encounter data as raw dicts (including all child tables)
-    encounters = []
-    for enc_name in encounter_names:
-        try:
-            enc_doc = frappe.get_doc("Patient Encounter", enc_name.name)
-            # Use as_dict() to get ALL fields including child tables - NO TRANSFORMATION
-            enc_data = enc_doc.as_dict()
-            encounters.append(enc_data)
-        except Exception as e:
-            # If we can't get full doc, skip it
-            pass
-    
-    # Get appointment names first
-    appointment_names = frappe.get_all(
-        "Patient Appointment",
-        filters={
-            "patient": patient_id,
-            "appointment_date": [">=", frappe.utils.nowdate()],
-            "status": ["in", ["Open", "Scheduled", "Confirmed"]]
-        },
-        fields=["name"],
-        order_by="appointment_date asc",
-        limit=5
-    )
+elif query_type == "ai_query_status":
+    job_id = parameters.get("job_id")
     
-    # Get ALL appointment data as raw dicts (including all fields) - NO TRANSFORMATION
-    appointments = []
-    for apt_name in appointment_names:
-        try:
-            apt_doc = frappe.get_doc("Patient Appointment", apt_name.name)
-            # Use as_dict() to get ALL fields
-            apt_data = apt_doc.as_dict()
-            appointments.append(apt_data)
-        except Exception as e:
-            # If we can't get full doc, skip it
-            pass
+    if not job_id:
+        fail_request(query_type, "job_id is required")
     
-    # Get lab tests
-    lab_tests = frappe.get_all(
-        "Lab Test",
-        filters={"patient": patient_id},
-        fields=["name", "lab_test_name", "status", "result_date", "creation"],
-            order_by="creation desc",
-            limit=5
-        )
+    job = cache_get(AI_JOB_PREFIX + job_id)
     
-    # Patient data is already in patient_data from as_dict() above
-    # No need to manually extract fields - we have everything
+    if not job or job.get("user") != frappe.session.user:
+        frappe.response.update({
+            "status": "error",
+            "message": f"AI job '{job_id}' not found or expired"
+        })
+    elif job["status"] == "success":
+        # Same shape as a synchronous ai_query response
+        frappe.response.update({
+            "status": "success",
+            "query_type": "ai_query",
+            "data": {
+                "ai_response": job.get("ai_response"),
+                "user_query": job.get("user_query"),
+                "patient_id": job.get("patient_id"),
+                "model_used": "RAG (n8n)",
+                "context_mode": job.get("context_mode"),
+                "context_hash": job.get("context_hash"),
+                "context_size": job.get("context_size"),
+                "context_version": job.get("context_version"),
+                "job_id": job_id
+            }
+        })
+    elif job["status"] == "error":
+        frappe.response.update({
+            "status": "error",
+            "message": job.get("message"),
+            "fallback_message": AI_FALLBACK_MESSAGE
+        })
+    else:
+        frappe.response.update({
+            "status": "pending",
+            "query_type": query_type,
+            "data": {
+                "job_id": job_id,
+                "job_status": job["status"]
+            }
+        })
+
+# =============================================================================
+# SETUP SEARCH INDEXES
+# =============================================================================
+
+elif query_type == "setup_search_indexes":
+    # One-time maintenance: secondary indexes backing search_patients prefix matching
+    if not is_system_manager():
+        fail_request(query_type, "Only a System Manager can create search indexes")
     
-    # Build alerts
-    alerts = []
-    try:
-        if patient.allergies:
-            alerts.append({
-                "type": "allergy",
-                "severity": "high",
-                "message": f"Allergies: {patient.allergies}"
-            })
-    except:
-        pass
+    for field in SEARCH_INDEX_FIELDS:
+        frappe.db.add_index("Patient", [field], f"mediwise_{field}_index")
     
     frappe.response.update({
         "status": "success",
         "query_type": query_type,
-        "data": {
-            "patient": patient_data,
-            "recent_encounters": encounters,
-            "upcoming_appointments": appointments,
-            "pending_lab_tests": lab_tests,
-            "alerts": alerts
-        }
+        "data": {"indexed_fields": SEARCH_INDEX_FIELDS}
     })
 
 # =============================================================================
-# GET PATIENT DETAILS
+# SETUP PATIENT SNAPSHOTS
 # =============================================================================
 
-elif query_type == "get_patient_details":
-    patient_id = parameters.get("patient_id")
-    
-    if not patient_id:
-        frappe.throw("patient_id is required")
-    
-    patient = frappe.get_doc("Patient", patient_id)
-    
-    # Build patient data safely without hasattr/getattr
-    patient_info = {"name": patient.name, "patient_name": patient.patient_name}
-    
-    try:
-        patient_info["mobile"] = patient.mobile
-    except:
-        patient_info["mobile"] = None
-    
-    try:
-        patient_info["email"] = patient.email
-    except:
-        patient_info["email"] = None
-    
-    try:
-        patient_info["gender"] = patient.sex
-    except:
-        patient_info["gender"] = None
-    
-    try:
-        patient_info["blood_group"] = patient.blood_group
-    except:
-        patient_info["blood_group"] = None
+elif query_type == "setup_patient_snapshots":
+    # One-time maintenance: create the snapshot doctype and queue a backfill
+    if not is_system_manager():
+        fail_request(query_type, "Only a System Manager can set up patient snapshots")
     
-    try:
-        patient_info["age"] = patient.age_html
-    except:
-        patient_info["age"] = None
+    doctype_created = False
+    if not db_exists("DocType", SNAPSHOT_DOCTYPE):
+        # patient is a Data field (not a Link) so snapshots never block deleting a Patient
+        frappe.get_doc({
+            "doctype": "DocType",
+            "name": SNAPSHOT_DOCTYPE,
+            "module": "Custom",
+            "custom": 1,
+            "autoname": "field:patient",
+            "naming_rule": "By fieldname",
+            "read_only": 1,
+            "fields": [
+                {"fieldname": "patient", "label": "Patient", "fieldtype": "Data",
+                 "reqd": 1, "unique": 1, "in_list_view": 1},
+                {"fieldname": "patient_name", "label": "Patient Name", "fieldtype": "Data", "in_list_view": 1},
+                {"fieldname": "last_visit", "label": "Last Visit", "fieldtype": "Date"},
+                {"fieldname": "visit_count", "label": "Visit Count", "fieldtype": "Int"},
+                {"fieldname": "refreshed_on", "label": "Refreshed On", "fieldtype": "Datetime"},
+                {"fieldname": "snapshot", "label": "Snapshot", "fieldtype": "Long Text"}
+            ],
+            "permissions": [
+                {"role": "System Manager", "read": 1, "write": 1, "create": 1, "delete": 1}
+            ]
+        }).insert(ignore_permissions=True)
+        doctype_created = True
     
-    try:
-        patient_info["dob"] = str(patient.dob) if patient.dob else None
-    except:
-        patient_info["dob"] = None
+    frappe.enqueue(
+        API_METHOD,
+        queue=SNAPSHOT_QUEUE,
+        timeout=SNAPSHOT_BACKFILL_TIMEOUT,
+        query_type="backfill_patient_snapshots",
+        parameters={}
+    )
     
     frappe.response.update({
         "status": "success",
         "query_type": query_type,
-        "data": patient_info
+        "data": {
+            "doctype": SNAPSHOT_DOCTYPE,
+            "doctype_created": doctype_created,
+            "backfill": "queued"
+        }
     })
 
 # =============================================================================
-# ANALYZE PATIENT HISTORY
+# BACKFILL PATIENT SNAPSHOTS (BACKGROUND JOB)
 # =============================================================================
 
-elif query_type == "analyze_patient_history":
-    patient_id = parameters.get("patient_id")
-    
-    if not patient_id:
-        frappe.throw("patient_id is required")
+elif query_type == "backfill_patient_snapshots":
+    # Rebuilds every patient's snapshot, paging through Patient by name
+    if frappe.request:
+        fail_request(query_type, "backfill_patient_snapshots can only run as a background job")
     
-    patient = frappe.get_doc("Patient", patient_id)
-    encounters = frappe.get_all(
-        "Patient Encounter",
-        filters={"patient": patient_id, "docstatus": 1},
-        fields=["name", "encounter_date"]
-    )
+    refreshed = 0
+    last_name = ""
+    while True:
+        page = db_get_all(
+            "Patient",
+            filters={"name": [">", last_name]},
+            fields=["name"],
+            order_by="name asc",
+            limit=SNAPSHOT_BACKFILL_PAGE_SIZE
+        )
+        for row in page:
+            refresh_patient_snapshot(row.name)
+            refreshed = refreshed + 1
+        if len(page) < SNAPSHOT_BACKFILL_PAGE_SIZE:
+            break
+        last_name = page[-1].name
     
     frappe.response.update({
         "status": "success",
         "query_type": query_type,
-        "data": {
-            "patient_profile": {
-                "name": patient.name,
-                "patient_name": patient.patient_name,
-            },
-            "visit_frequency": {
-                "total_visits": len(encounters),
-                "last_visit": str(encounters[0]["encounter_date"]) if encounters else None
-            }
-        }
+        "data": {"refreshed": refreshed}
     })
 
 # =============================================================================
-# GET ACTIVE PRESCRIPTIONS
+# REFRESH PATIENT SNAPSHOT (BACKGROUND JOB)
 # =============================================================================
 
-elif query_type == "get_active_prescriptions":
+elif query_type == "refresh_patient_snapshot":
+    # Queued by doc_event_script.py with the sections the changed doc affects
     patient_id = parameters.get("patient_id")
     
+    if frappe.request:
+        fail_request(query_type, "refresh_patient_snapshot can only run as a background job")
     if not patient_id:
-        frappe.throw("patient_id is required")
-    
-    encounters = frappe.get_all(
-        "Patient Encounter",
-        filters={
-            "patient": patient_id,
-            "docstatus": 1,
-            "encounter_date": [">=", frappe.utils.add_days(frappe.utils.nowdate(), -90)]
-        },
-        fields=["name", "encounter_date", "practitioner"],
-        order_by="encounter_date desc"
-    )
+        fail_request(query_type, "patient_id is required")
     
-    prescriptions = []
-    for enc in encounters:
-        try:
-            enc_doc = frappe.get_doc("Patient Encounter", enc.name)
-            try:
-                drug_prescription = enc_doc.drug_prescription
-                if drug_prescription:
-                    for drug in drug_prescription:
-                        med_info = {"prescribed_date": str(enc.encounter_date)}
-                        try:
-                            med_info["medication"] = drug.drug_name
-                        except:
-                            med_info["medication"] = None
-                        try:
-                            med_info["dosage"] = drug.dosage
-                        except:
-                            med_info["dosage"] = None
-                        prescriptions.append(med_info)
-            except:
-                pass
-        except:
-            pass
+    if snapshot_doctype_installed():
+        refresh_patient_snapshot(patient_id, parameters.get("sections"))
+    cache_delete(SNAPSHOT_PENDING_PREFIX + patient_id)
     
     frappe.response.update({
         "status": "success",
         "query_type": query_type,
-        "data": {
-        "active_prescriptions": prescriptions,
-        "count": len(prescriptions)
-    }
+        "data": {"patient_id": patient_id}
     })
 
 # =============================================================================
-# GET LAB TESTS
+# BUILD PATIENT RETRIEVAL INDEX (BACKGROUND JOB)
 # =============================================================================
 
-elif query_type == "get_lab_tests":
+elif query_type == "build_patient_index":
+    # Queued by ai_query (see queue_patient_index_build): builds or catches up
+    # the patient's retrieval index outside the web request
     patient_id = parameters.get("patient_id")
     
+    if frappe.request:
+        fail_request(query_type, "build_patient_index can only run as a background job")
     if not patient_id:
-        frappe.throw("patient_id is required")
+        fail_request(query_type, "patient_id is required")
     
-    lab_tests = frappe.get_all(
-        "Lab Test",
-        filters={"patient": patient_id},
-        fields=["name", "lab_test_name", "status", "result_date", "creation"],
-        order_by="creation desc",
-        limit=20
-    )
+    try:
+        loaded_index = load_patient_index(patient_id)
+    finally:
+        cache_delete(AI_INDEX_BUILDING_PREFIX + patient_id)
     
     frappe.response.update({
         "status": "success",
         "query_type": query_type,
         "data": {
-            "lab_tests": lab_tests,
-            "count": len(lab_tests)
+            "patient_id": patient_id,
+            "indexed": len(loaded_index["index"]["passages"]),
+            "reindexed": loaded_index["updated"]
         }
     })
 
 # =============================================================================
-# GET VITAL SIGNS HISTORY
+# PRE-ANALYSE UPCOMING APPOINTMENTS (BACKGROUND JOB)
 # =============================================================================
 
-elif query_type == "get_vital_signs_history":
-    patient_id = parameters.get("patient_id")
-    
-    if not patient_id:
-        frappe.throw("patient_id is required")
+elif query_type == "preanalyze_appointments":
+    # Queued by scheduler_script.py; a System Manager can also start a run
+    horizon_hours = frappe.utils.cint(parameters.get("horizon_hours")) or PREANALYSIS_HORIZON_HOURS
     
-    vitals = frappe.get_all(
-        "Vital Signs",
-        filters={"patient": patient_id, "docstatus": ["!=", 2]},
-        fields=[
-            "name", "signs_date", "signs_time",
-            "temperature", "pulse", "respiratory_rate",
-            "bp_systolic", "bp_diastolic", "spo2"
-        ],
-        order_by="signs_date desc",
-            limit=20
+    if frappe.request:
+        if not is_system_manager():
+            fail_request(query_type, "Only a System Manager can start an appointment pre-analysis")
+        frappe.enqueue(
+            API_METHOD,
+            queue=PREANALYSIS_QUEUE,
+            timeout=AI_JOB_TIMEOUT,
+            query_type="preanalyze_appointments",
+            parameters={"horizon_hours": horizon_hours}
         )
+        frappe.response.update({
+            "status": "queued",
+            "query_type": query_type,
+            "data": {"horizon_hours": horizon_hours}
+        })
+    else:
+        # Bounded parallelism: at most PREANALYSIS_CONCURRENCY jobs, each taking
+        # every n-th patient so the soonest appointments are done first
+        patient_ids = upcoming_appointment_patients(horizon_hours)
+        jobs = 0
+        for index in range(min(PREANALYSIS_CONCURRENCY, len(patient_ids))):
+            frappe.enqueue(
+                API_METHOD,
+                queue=PREANALYSIS_QUEUE,
+                timeout=PREANALYSIS_JOB_TIMEOUT,
+                query_type="preanalyze_patients",
+                parameters={"patient_ids": patient_ids[index::PREANALYSIS_CONCURRENCY]}
+            )
+            jobs = jobs + 1
+        
+        frappe.response.update({
+            "status": "success",
+            "query_type": query_type,
+            "data": {"horizon_hours": horizon_hours, "patients": len(patient_ids), "jobs": jobs}
+        })
+
+elif query_type == "preanalyze_patients":
+    # One share of a pre-analysis run, patients handled one at a time
+    if frappe.request:
+        fail_request(query_type, "preanalyze_patients can only run as a background job")
+    
+    outcomes = {"generated": 0, "fresh": 0, "skipped": 0, "failed": 0}
+    for patient_id in parameters.get("patient_ids") or []:
+        # Leave n8n alone while the circuit breaker is open
+        if rag_breaker_retry_after():
+            outcomes["skipped"] = outcomes["skipped"] + 1
+            continue
+        try:
+            outcome = preanalyze_patient(patient_id)
+        except Exception as e:
+            frappe.log_error(
+                title="MediWise AI Bot - Pre-analysis Error",
+                message=f"Error: {str(e)}\nPatient ID: {patient_id}"
+            )
+            outcome = "failed"
+        outcomes[outcome] = outcomes[outcome] + 1
     
     frappe.response.update({
         "status": "success",
         "query_type": query_type,
-        "data": {
-            "vital_signs": vitals,
-            "count": len(vitals)
-        }
+        "data": outcomes
     })
 
 # =============================================================================
-# GET PATIENT ENCOUNTERS
+# BATCH (SEVERAL READ QUERIES IN ONE REQUEST)
 # =============================================================================
 
-elif query_type == "get_patient_encounters":
-    patient_id = parameters.get("patient_id")
-    
-    if not patient_id:
-        frappe.throw("patient_id is required")
+elif query_type == "batch":
+    # Runs several read-only sub-queries in one HTTP request. Top-level
+    # parameters (e.g. patient_id) are shared defaults for every sub-query;
+    # results and errors come back keyed by each sub-query's "id". Top-level
+    # options are merged the same way with each sub-query's "options".
+    sub_queries = parameters.get("queries")
     
-    filters = {"patient": patient_id, "docstatus": ["!=", 2]}
+    if not sub_queries or not isinstance(sub_queries, list):
+        fail_request(query_type, "queries must be a non-empty list")
+    if len(sub_queries) > BATCH_MAX_QUERIES:
+        fail_request(query_type, f"A batch can hold at most {BATCH_MAX_QUERIES} queries")
     
-    # Get encounter names first
-    encounter_names = frappe.get_all(
-        "Patient Encounter",
-        filters=filters,
-        fields=["name"],
-        order_by="encounter_date desc",
-        limit=10
-    )
+    shared_parameters = {key: value for key, value in parameters.items() if key != "queries"}
+    shared_options = options or {}
+    results = {}
     
-    # Get ALL encounter data as raw dicts (including all child tables) - NO TRANSFORMATION
-    encounters = []
-    for enc_name in encounter_names:
+    for index, sub_query in enumerate(sub_queries):
+        sub_type = sub_query.get("query_type")
+        result_key = sub_query.get("id") or sub_type or str(index)
+        if result_key in results:
+            result_key = f"{result_key}_{index}"
+        
+        if sub_type not in QUERY_HANDLERS:
+            results[result_key] = {
+                "status": "error",
+                "query_type": sub_type,
+                "message": f"Query type '{sub_type}' cannot be batched"
+            }
+            continue
+        
+        sub_parameters = dict(shared_parameters)
+        sub_parameters.update(sub_query.get("parameters") or {})
+        sub_options = dict(shared_options)
+        sub_options.update(sub_query.get("options") or {})
+        
+        # One failing sub-query must not sink the others
         try:
-            enc_doc = frappe.get_doc("Patient Encounter", enc_name.name)
-            # Use as_dict() to get ALL fields including child tables
-            enc_data = enc_doc.as_dict()
-            encounters.append(enc_data)
+            results[result_key] = shape_response(QUERY_HANDLERS[sub_type](sub_parameters), sub_options)
         except Exception as e:
-            # If we can't get full doc, skip it
-            pass
+            results[result_key] = {
+                "status": "error",
+                "query_type": sub_type,
+                "message": str(e) or "Query failed"
+            }
     
     frappe.response.update({
-            "status": "success",
+        "status": "success",
         "query_type": query_type,
         "data": {
-            "encounters": encounters,
-            "count": len(encounters)
+            "results": results,
+            "count": len(results)
         }
     })
 
+# =============================================================================
+# METRICS (PROMETHEUS SCRAPE TARGET)
+# =============================================================================
+
+elif query_type == "metrics":
+    # Aggregated request metrics. Prometheus scrapes this with a System
+    # Manager's API key; "format": "json" returns the raw aggregates instead.
+    if not is_system_manager():
+        fail_request(query_type, "Only a System Manager can read metrics")
+    
+    if parameters.get("format") == "json":
+        frappe.response.update({
+            "status": "success",
+            "query_type": query_type,
+            "data": {
+                query_type_name: cache_get(METRICS_PREFIX + query_type_name) or {}
+                for query_type_name in cache_get(METRICS_INDEX_KEY) or []
+            }
+        })
+    else:
+        # Plain-text body via Frappe's raw ("download") response type
+        frappe.response["type"] = "download"
+        frappe.response["filename"] = "metrics.txt"
+        frappe.response["content_type"] = "text/plain; version=0.0.4"
+        frappe.response["display_content_as"] = "inline"
+        frappe.response["filecontent"] = render_prometheus_metrics()
+    
+    # Scrapes are not worth recording
+    METRICS["record"] = False
+
+# =============================================================================
+# SINGLE READ QUERY
+# =============================================================================
+
+elif query_type in QUERY_HANDLERS:
+    frappe.response.update(shape_response(call_recorded(query_type, QUERY_HANDLERS[query_type], parameters), options))
+
 # =============================================================================
 # UNKNOWN QUERY TYPE
 # =============================================================================
@@ -592,6 +3824,14 @@ else:  # noqa
         "status": "error",
         "message": f"Query type '{query_type}' not implemented"
     })
+    # Unknown names would otherwise become metric labels
+    METRICS["record"] = False
+
+# =============================================================================
+# REQUEST METRICS
+# =============================================================================
+
+finish_request_metrics(query_type, payload.get("debug"))
 
 # =============================================================================
 # END OF SCRIPT